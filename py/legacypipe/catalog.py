@@ -2,7 +2,7 @@ from __future__ import print_function
 
 import numpy as np
 
-from tractor import PointSource
+from tractor import PointSource, RaDecPos
 
 from tractor.galaxy import ExpGalaxy, DevGalaxy
 from tractor.sersic import SersicGalaxy, SersicIndex
@@ -30,45 +30,34 @@ def prepare_fits_catalog(cat, invvars, T, bands, allbands=None,
     if allbands is None:
         allbands = bands
 
-    params0 = cat.getParams()
-
-    flux = np.zeros((len(T), len(allbands)), np.float32)
-    flux_ivar = np.zeros((len(T), len(allbands)), np.float32)
-
-    for band in bands:
-        i = allbands.index(band)
-        for j,src in enumerate(cat):
-            if src is not None:
-                flux[j,i] = sum(b.getFlux(band) for b in src.getBrightnesses())
-
-        if invvars is None:
-            continue
+    vals = _source_arrays(cat, bands)
+    if save_invvars:
         # Oh my, this is tricky... set parameter values to the variance
         # vector so that we can read off the parameter variances via the
         # python object apis.
-        cat.setParams(invvars)
-
-        for j,src in enumerate(cat):
-            if src is not None:
-                flux_ivar[j,i] = sum(b.getFlux(band) for b in src.getBrightnesses())
-
+        params0 = cat.getParams()
+        if invvars is not None:
+            cat.setParams(invvars)
+        else:
+            cat.setParams(np.zeros(cat.numberOfParams()))
+        ivs = _source_arrays(cat, bands)
         cat.setParams(params0)
 
+    ib = np.array([allbands.index(band) for band in bands], int)
+    flux = np.zeros((len(T), len(allbands)), np.float32)
+    flux[:,ib] = vals['flux']
     T.set('%sflux' % prefix, flux)
     if save_invvars:
+        flux_ivar = np.zeros((len(T), len(allbands)), np.float32)
+        if invvars is not None:
+            flux_ivar[:,ib] = ivs['flux']
         T.set('%sflux_ivar' % prefix, flux_ivar)
 
-    _get_tractor_fits_values(T, cat, '%s%%s' % prefix)
-
+    _set_tractor_fits_values(T, cat, '%s%%s' % prefix, vals)
     if save_invvars:
-        if invvars is not None:
-            cat.setParams(invvars)
-        else:
-            cat.setParams(np.zeros(cat.numberOfParams()))
-        _get_tractor_fits_values(T, cat, '%s%%s_ivar' % prefix)
+        _set_tractor_fits_values(T, cat, '%s%%s_ivar' % prefix, ivs)
         # Heh, "no uncertainty here!"
         T.delete_column('%stype_ivar' % prefix)
-    cat.setParams(params0)
 
     # mod RA
     ra = T.get('%sra' % prefix)
@@ -91,38 +80,146 @@ def prepare_fits_catalog(cat, invvars, T, bands, allbands=None,
 
     return T
 
-def _get_tractor_fits_values(T, cat, pat):
+def _source_arrays(srcs, bands):
+    '''
+    Reads the positions, fluxes in *bands*, shapes (r, e1, e2) and
+    Sersic indices of the tractor sources *srcs* (None entries get
+    zeros) into numpy arrays.
+
+    Sources are handled in groups with the same class, position class
+    and band order.  The parameters of a group are read with one
+    getAllParams() call per source into an (N x nparams) array, whose
+    columns are then sliced, using the layout of the group's first
+    source.  (Groups whose parameters don't have the expected layout
+    are read via the source objects' methods.)
+    '''
+    N = len(srcs)
+    A = dict(ra=np.zeros(N), dec=np.zeros(N),
+             flux=np.zeros((N, len(bands)), np.float32),
+             shape=np.zeros((N, 3), np.float32),
+             sersic=np.zeros(N, np.float32))
+    groups = {}
+    for i,src in enumerate(srcs):
+        if src is None:
+            continue
+        key = (type(src), type(getattr(src, 'pos', None)),
+               tuple(getattr(getattr(src, 'brightness', None), 'order', ())))
+        groups.setdefault(key, []).append(i)
+    for (clazz,posclass,order),I in groups.items():
+        S = [srcs[i] for i in I]
+        if not _source_arrays_batched(A, I, S, clazz, posclass, order, bands):
+            _source_arrays_slow(A, I, S, clazz, bands)
+    return A
+
+def _source_arrays_batched(A, I, S, clazz, posclass, order, bands):
+    # Returns False if the sources *S* don't have the expected layout.
+    if any(band not in order for band in bands):
+        return False
+    s0 = S[0]
+    subs = [s0.pos, s0.brightness]
+    galaxy = issubclass(clazz, (ExpGalaxy, DevGalaxy, SersicGalaxy))
+    if galaxy:
+        subs.append(s0.shape)
+    sersic = issubclass(clazz, SersicGalaxy)
+    if sersic:
+        subs.append(s0.sersicindex)
+    sizes = [len(sub.getAllParams()) for sub in subs]
+    if sizes[1] != len(order):
+        return False
+    if issubclass(clazz, RexGalaxy):
+        if sizes[2] < 1:
+            return False
+    elif galaxy and sizes[2] != 3:
+        return False
+    P = [src.getAllParams() for src in S]
+    if any(len(p) != sum(sizes) for p in P):
+        return False
+    P = np.array(P, dtype=float).reshape(len(S), sum(sizes))
+    i0 = np.cumsum([0] + sizes)
+    if issubclass(posclass, RaDecPos):
+        A['ra' ][I] = P[:, i0[0]]
+        A['dec'][I] = P[:, i0[0]+1]
+    else:
+        pos = [src.getPosition() for src in S]
+        A['ra' ][I] = [p.ra  for p in pos]
+        A['dec'][I] = [p.dec for p in pos]
+    if len(bands):
+        A['flux'][I,:] = P[:, [i0[1] + order.index(band) for band in bands]]
+    # Grab elliptical shapes
+    if issubclass(clazz, RexGalaxy):
+        A['shape'][I,0] = P[:, i0[2]]
+    elif galaxy:
+        A['shape'][I,:] = P[:, i0[2]:i0[2]+3]
+    # Grab Sersic index
+    if sersic:
+        A['sersic'][I] = P[:, i0[3]]
+    return True
+
+def _source_arrays_slow(A, I, S, clazz, bands):
+    pos = [src.getPosition() for src in S]
+    A['ra' ][I] = [p.ra  for p in pos]
+    A['dec'][I] = [p.dec for p in pos]
+    brights = [src.getBrightnesses() for src in S]
+    if len(bands):
+        A['flux'][I,:] = [[sum(b.getFlux(band) for b in br) for band in bands]
+                          for br in brights]
+    # Grab elliptical shapes
+    if issubclass(clazz, RexGalaxy):
+        A['shape'][I,0] = [src.shape.getAllParams()[0] for src in S]
+    elif issubclass(clazz, (ExpGalaxy, DevGalaxy, SersicGalaxy)):
+        A['shape'][I,:] = [src.shape.getAllParams() for src in S]
+    # Grab Sersic index
+    if issubclass(clazz, SersicGalaxy):
+        A['sersic'][I] = [src.sersicindex.getValue() for src in S]
+
+def _set_tractor_fits_values(T, cat, pat, A):
     typearray = np.array([fits_typemap[type(src)] for src in cat])
     typearray = typearray.astype('S3')
     T.set(pat % 'type', typearray)
+    T.set(pat % 'ra',  A['ra'])
+    T.set(pat % 'dec', A['dec'])
+    T.set(pat % 'sersic',  A['sersic'])
+    T.set(pat % 'shape_r',  A['shape'][:,0])
+    T.set(pat % 'shape_e1', A['shape'][:,1])
+    T.set(pat % 'shape_e2', A['shape'][:,2])
 
-    ra,dec = [],[]
-    for src in cat:
-        if src is None:
-            ra.append(0.)
-            dec.append(0.)
-        else:
-            pos = src.getPosition()
-            ra.append(pos.ra)
-            dec.append(pos.dec)
-    T.set(pat % 'ra',  np.array(ra))
-    T.set(pat % 'dec', np.array(dec))
-
-    shape = np.zeros((len(T), 3), np.float32)
-    sersic = np.zeros(len(T), np.float32)
-    for i,src in enumerate(cat):
-        # Grab elliptical shapes
-        if isinstance(src, RexGalaxy):
-            shape[i,0] = src.shape.getAllParams()[0]
-        elif isinstance(src, (ExpGalaxy, DevGalaxy, SersicGalaxy)):
-            shape[i,:] = src.shape.getAllParams()
-        # Grab Sersic index
-        if isinstance(src, SersicGalaxy):
-            sersic[i] = src.sersicindex.getValue()
-    T.set(pat % 'sersic',  sersic)
-    T.set(pat % 'shape_r',  shape[:,0])
-    T.set(pat % 'shape_e1', shape[:,1])
-    T.set(pat % 'shape_e2', shape[:,2])
+def _get_tractor_fits_values(T, cat, pat):
+    _set_tractor_fits_values(T, cat, pat, _source_arrays(cat, []))
+
+def get_source_params(srcs, bands, ivars=None):
+    '''
+    Reads the catalog quantities of the tractor sources *srcs* (a list
+    that may contain None entries, which get zeros) into a dict of
+    numpy arrays: type, ra, dec, flux (N x len(bands)), shape_r,
+    shape_e1, shape_e2, and sersic.
+
+    If *ivars* is given -- a list parallel to *srcs* of the sources'
+    parameter inverse-variance vectors, or None entries -- the
+    inverse-variance of each quantity (except type) is also returned,
+    under its name + "_ivar".
+    '''
+    P = dict(type=np.array([fits_typemap[type(src)] for src in srcs],
+                           dtype='S3'))
+    A = [('', _source_arrays(srcs, bands))]
+    if ivars is not None:
+        # Set the parameter values to the inverse-variance vectors so
+        # that we can read them off via the object APIs.
+        ivsrcs = [src if iv is not None else None
+                  for src,iv in zip(srcs, ivars)]
+        params0 = [None if src is None else src.getParams() for src in ivsrcs]
+        for src,iv in zip(ivsrcs, ivars):
+            if src is not None:
+                src.setParams(iv)
+        A.append(('_ivar', _source_arrays(ivsrcs, bands)))
+        for src,p in zip(ivsrcs, params0):
+            if src is not None:
+                src.setParams(p)
+    for suff,a in A:
+        shape = a.pop('shape')
+        a.update(shape_r=shape[:,0], shape_e1=shape[:,1], shape_e2=shape[:,2])
+        for k,v in a.items():
+            P[k + suff] = v
+    return P
 
 def read_fits_catalog(T, hdr=None, invvars=False, bands='grz',
                       ellipseClass=EllipseE, sersicIndexClass=SersicIndex):
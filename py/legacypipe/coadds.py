@@ -1,8 +1,10 @@
 from __future__ import print_function
+from contextlib import contextmanager
 import numpy as np
 import fitsio
 from astrometry.util.fits import fits_table
 from astrometry.util.resample import resample_with_wcs, OverlapError
+from legacypipe.resampmap import resample_map_with_wcs
 from legacypipe.bits import DQ_BITS
 from legacypipe.survey import tim_get_resamp
 from legacypipe.utils import copy_header_with_wcs
@@ -105,19 +107,18 @@ class SimpleCoadd(object):
             self.write_coadds(survey, brickname, hdr, band, coimg, comod, coiv, con)
 
             if apradec is not None:
-                import photutils
+                from legacypipe.apphot import aperture_photometry
                 mask = (coiv == 0)
                 with np.errstate(divide='ignore'):
                     imsigma = 1.0/np.sqrt(coiv)
                 imsigma[mask] = 0.
                 for irad,rad in enumerate(apertures):
-                    aper = photutils.CircularAperture(apxy, rad)
-                    p = photutils.aperture_photometry(coimg, aper, error=imsigma,
-                                                      mask=mask)
-                    ap_iphots[iband][:,irad] = p.field('aperture_sum')
-                    ap_dphots[iband][:,irad] = p.field('aperture_sum_err')
-                    p = photutils.aperture_photometry(coimg - comod, aper, mask=mask)
-                    ap_rphots[iband][:,irad] = p.field('aperture_sum')
+                    [(apimg,aperr), (apres,_)] = aperture_photometry(
+                        [coimg, coimg - comod], apxy, rad,
+                        errors=[imsigma, None], mask=mask)
+                    ap_iphots[iband][:,irad] = apimg
+                    ap_dphots[iband][:,irad] = aperr
+                    ap_rphots[iband][:,irad] = apres
 
         self.write_color_image(survey, brickname, coimgs, comods)
 
@@ -268,10 +269,33 @@ def make_coadds(tims, bands, targetwcs,
         # surface-brightness correction
         tim.sbscale = (targetwcs.pixel_scale() / tim.subwcs.pixel_scale())**2
 
+    # When running on a local process pool, the workers add their
+    # resampled images directly into per-band coadd arrays in shared
+    # memory, rather than sending them back here to be accumulated.
+    shared = (mp is not None and not plots and _is_local_pool(mp))
+    coadd_args = dict(H=H, W=W, detmaps=detmaps, mods=(mods is not None),
+                      blobmods=(blobmods is not None), ngood=ngood,
+                      masks=(xy or allmasks or anymasks), nobs=bool(xy),
+                      psfsize=psfsize)
+
+    if xy:
+        # To save the memory of 2 x float64 maps, we instead do arg min/max maps
+
+        # append a 0 to the list of mjds so that mjds[-1] gives 0.
+        mjds = np.array([tim.time.toMjd() for tim in tims] + [0])
+        mjd_argmins = np.empty((H,W), np.int16)
+        mjd_argmaxs = np.empty((H,W), np.int16)
+        mjd_argmins[:,:] = -1
+        mjd_argmaxs[:,:] = -1
+    else:
+        mjds = None
+
     # We create one iterator per band to do the tim resampling.  These all run in
-    # parallel when multi-processing.
-    imaps = []
-    for band in bands:
+    # parallel when multi-processing -- except that in shared mode, to
+    # bound the shared memory, only the current band and the next one
+    # are in flight, each with its own shared arrays.
+    band_args = []
+    for iband,band in enumerate(bands):
         args = []
         for itim,tim in enumerate(tims):
             if tim.band != band:
@@ -285,338 +309,212 @@ def make_coadds(tims, bands, targetwcs,
             else:
                 bmo = blobmods[itim]
             args.append((itim,tim,mo,bmo,lanczos,targetwcs,sbscale))
+        band_args.append(args)
+
+    shared_arrays = {}
+    def start_band(iband):
+        args = band_args[iband]
+        func = _resample_one
+        if shared:
+            sa = _SharedArrays()
+            shared_arrays[iband] = sa
+            _coadd_arrays(sa.alloc, **coadd_args)
+            if xy:
+                # per-band; merged below
+                sa.alloc('mjd_argmins', np.int16, (H,W), -1)
+                sa.alloc('mjd_argmaxs', np.int16, (H,W), -1)
+            args = [(a, sa, mjds, satur_val, psf_images) for a in args]
+            func = _resample_accumulate
         if mp is not None:
-            imaps.append(mp.imap_unordered(_resample_one, args))
-        else:
-            imaps.append(map(_resample_one, args))
+            return mp.imap_unordered(func, args)
+        return map(func, args)
+
+    imaps = {}
+    if not shared:
+        for iband in range(len(bands)):
+            imaps[iband] = start_band(iband)
 
     # Args for aperture photometry
     apargs = []
 
-    if xy:
-        # To save the memory of 2 x float64 maps, we instead do arg min/max maps
-
-        # append a 0 to the list of mjds so that mjds[-1] gives 0.
-        mjds = np.array([tim.time.toMjd() for tim in tims] + [0])
-        mjd_argmins = np.empty((H,W), np.int16)
-        mjd_argmaxs = np.empty((H,W), np.int16)
-        mjd_argmins[:,:] = -1
-        mjd_argmaxs[:,:] = -1
-
     if plots:
         allresids = []
 
     tinyw = 1e-30
-    for iband,(band,timiter) in enumerate(zip(bands, imaps)):
-        debug('Computing coadd for band', band)
-
-        # coadded weight map (moo)
-        cow    = np.zeros((H,W), np.float32)
-        # coadded weighted image map
-        cowimg = np.zeros((H,W), np.float32)
+    try:
+        for iband,band in enumerate(bands):
+            if shared:
+                for ib in [iband, iband+1]:
+                    if ib < len(bands) and ib not in imaps:
+                        imaps[ib] = start_band(ib)
+            timiter = imaps.pop(iband)
+            debug('Computing coadd for band', band)
+            if not shared:
+                A = _coadd_arrays(_alloc_array, **coadd_args)
+                if xy:
+                    A.update(mjd_argmins=mjd_argmins, mjd_argmaxs=mjd_argmaxs)
 
-        kwargs = dict(cowimg=cowimg, cow=cow)
+            if psf_images:
+                psf_img = 0.
+
+            for R in timiter:
+                if R is None:
+                    continue
+                if shared:
+                    # the worker has already added this tim into the coadds
+                    itim,copsf = R
+                    if psf_images:
+                        psf_img += copsf / tims[itim].sig1**2
+                    continue
+
+                itim,rmap,iv,im,mo,bmo,dq = R
+                tim = tims[itim]
+                Yo,Xo = rmap.out_indices()
+                del rmap
 
-        if detmaps:
-            # detection map inverse-variance (depth map)
-            psfdetiv = np.zeros((H,W), np.float32)
-            C.psfdetivs.append(psfdetiv)
-            kwargs.update(psfdetiv=psfdetiv)
-            # galaxy detection map inverse-variance (galdepth map)
-            galdetiv = np.zeros((H,W), np.float32)
-            C.galdetivs.append(galdetiv)
-            kwargs.update(galdetiv=galdetiv)
-
-        if mods is not None:
-            # model image
-            cowmod = np.zeros((H,W), np.float32)
-            # chi-squared image
-            cochi2 = np.zeros((H,W), np.float32)
-            kwargs.update(cowmod=cowmod, cochi2=cochi2)
-
-        if blobmods is not None:
-            # model image
-            cowblobmod = np.zeros((H,W), np.float32)
-            kwargs.update(cowblobmod=cowblobmod)
-
-        if unweighted:
-            # unweighted image
-            coimg  = np.zeros((H,W), np.float32)
+                if plots:
+                    _make_coadds_plots_1(im, band, mods, mo, iv, unweighted,
+                                         dq, satur_val, allresids, ps, H, W,
+                                         tim, Yo, Xo)
+                _accumulate_tim(A, itim, tim, Yo, Xo, iv, im, mo, bmo, dq,
+                                mjds, satur_val)
+                if psf_images:
+                    patch,copsf = _coadd_psf_image(tim, targetwcs)
+                    if plots:
+                        _make_coadds_plots_2(patch, copsf, psf_img, tim, band, ps)
+                    psf_img += copsf / tim.sig1**2
+                del Yo,Xo,im,iv,mo,bmo
+                # END of loop over tims
+
+            if shared:
+                A = shared_arrays.pop(iband).read()
+                if xy:
+                    _merge_mjd_argmin(mjd_argmins, A.pop('mjd_argmins'), mjds, np.less)
+                    _merge_mjd_argmin(mjd_argmaxs, A.pop('mjd_argmaxs'), mjds, np.greater)
+
+            cowimg = A['cowimg']
+            cow = A['cow']
+            coimg = A['coimg']
+            con = A['con']
+            kwargs = dict(cowimg=cowimg, cow=cow, coimg=coimg, coiv=A['coiv'])
+            if detmaps:
+                psfdetiv = A['psfdetiv']
+                galdetiv = A['galdetiv']
+                C.psfdetivs.append(psfdetiv)
+                C.galdetivs.append(galdetiv)
+                kwargs.update(psfdetiv=psfdetiv, galdetiv=galdetiv)
             if mods is not None:
-                # unweighted model
-                comod  = np.zeros((H,W), np.float32)
+                cowmod = A['cowmod']
+                comod = A['comod']
+                kwargs.update(cowmod=cowmod, cochi2=A['cochi2'])
             if blobmods is not None:
-                coblobmod  = np.zeros((H,W), np.float32)
-            # number of exposures
-            con    = np.zeros((H,W), np.int16)
-            # inverse-variance
-            coiv   = np.zeros((H,W), np.float32)
-            kwargs.update(coimg=coimg, coiv=coiv)
-
-        # Note that we have 'congood' as well as 'nobs':
-        # * 'congood' is used for the 'nexp' *image*.
-        #   It counts the number of "good" (unmasked) exposures
-        # * 'nobs' is used for the per-source measurements
-        #   It counts the total number of exposures, including masked pixels
-        #
-        # (you want to know the number of observations within the
-        # source footprint, not just the peak pixel which may be
-        # saturated, etc.)
-
-        if ngood:
-            congood = np.zeros((H,W), np.int16)
-            kwargs.update(congood=congood)
-
-        if xy or allmasks or anymasks:
-            # These match the type of the "DQ" images.
-            # "any" mask
-            ormask  = np.zeros((H,W), np.int16)
-            # "all" mask
-            andmask = np.empty((H,W), np.int16)
-            from functools import reduce
-            allbits = reduce(np.bitwise_or, DQ_BITS.values())
-            andmask[:,:] = allbits
-            kwargs.update(ormask=ormask, andmask=andmask)
-        if xy:
-            # number of observations
-            nobs = np.zeros((H,W), np.int16)
-            kwargs.update(nobs=nobs)
-
-        if psfsize:
-            psfsizemap = np.zeros((H,W), np.float32)
-            # like "cow", but constant invvar per-CCD;
-            # only required for psfsizemap
-            flatcow = np.zeros((H,W), np.float32)
-            kwargs.update(psfsize=psfsizemap)
-
-        if max:
-            maximg = np.zeros((H,W), np.float32)
-            C.maximgs.append(maximg)
-
-        if psf_images:
-            psf_img = 0.
-
-        for R in timiter:
-            if R is None:
-                continue
-            itim,Yo,Xo,iv,im,mo,bmo,dq = R
-            tim = tims[itim]
-
-            if plots:
-                _make_coadds_plots_1(im, band, mods, mo, iv, unweighted,
-                                     dq, satur_val, allresids, ps, H, W,
-                                     tim, Yo, Xo)
-            # invvar-weighted image
-            cowimg[Yo,Xo] += iv * im
-            cow   [Yo,Xo] += iv
-
-            goodpix = None
-            if unweighted:
-                if dq is None:
-                    goodpix = 1
-                else:
-                    # include SATUR pixels if no other
-                    # pixels exists
-                    okbits = 0
-                    for bitname in ['satur']:
-                        okbits |= DQ_BITS[bitname]
-                    brightpix = ((dq & okbits) != 0)
-                    if satur_val is not None:
-                        # HACK -- force SATUR pix to be bright
-                        im[brightpix] = satur_val
-                    # Include these pixels if none other exist??
-                    for bitname in ['interp']: #, 'bleed']:
-                        okbits |= DQ_BITS[bitname]
-                    goodpix = ((dq & ~okbits) == 0)
-
-                coimg[Yo,Xo] += goodpix * im
-                con  [Yo,Xo] += goodpix
-                coiv [Yo,Xo] += goodpix * 1./(tim.sig1 * tim.sbscale)**2  # ...ish
-
+                cowblobmod = A['cowblobmod']
+                coblobmod = A['coblobmod']
+                kwargs.update(cowblobmod=cowblobmod)
+            if ngood:
+                kwargs.update(congood=A['congood'])
             if xy or allmasks or anymasks:
-                if dq is not None:
-                    ormask [Yo,Xo] |= dq
-                    andmask[Yo,Xo] &= dq
+                ormask = A['ormask']
+                andmask = A['andmask']
+                kwargs.update(ormask=ormask, andmask=andmask)
             if xy:
-                # raw exposure count
-                nobs[Yo,Xo] += 1
-                # mjd_min/max
-                update = np.logical_or(mjd_argmins[Yo,Xo] == -1,
-                                       (mjd_argmins[Yo,Xo] > -1) *
-                                       (mjds[itim] < mjds[mjd_argmins[Yo,Xo]]))
-                mjd_argmins[Yo[update],Xo[update]] = itim
-                update = np.logical_or(mjd_argmaxs[Yo,Xo] == -1,
-                                       (mjd_argmaxs[Yo,Xo] > -1) *
-                                       (mjds[itim] > mjds[mjd_argmaxs[Yo,Xo]]))
-                mjd_argmaxs[Yo[update],Xo[update]] = itim
-                del update
-
+                nobs = A['nobs']
+                kwargs.update(nobs=nobs)
             if psfsize:
-                # psfnorm is in units of 1/pixels.
-                # (eg, psfnorm for a gaussian is 1./(2.*sqrt(pi) * psf_sigma) )
-                # Neff is in pixels**2
-                neff = 1./tim.psfnorm**2
-                # Narcsec is in arcsec**2
-                narcsec = neff * tim.wcs.pixel_scale()**2
-                # Make smooth maps -- don't ignore CRs, saturated pix, etc
-                iv1 = 1./tim.sig1**2
-                psfsizemap[Yo,Xo] += iv1 * (1. / narcsec)
-                flatcow   [Yo,Xo] += iv1
+                psfsizemap = A['psfsizemap']
+                flatcow = A['flatcow']
+                kwargs.update(psfsize=psfsizemap)
+            C.maximgs.append(A['maximg'])
+            del A
+
+            # Per-band:
+            cowimg /= np.maximum(cow, tinyw)
+            C.coimgs.append(cowimg)
+            C.cowimgs.append(cow)
+            if mods is not None:
+                cowmod  /= np.maximum(cow, tinyw)
+                C.comods.append(cowmod)
+                coresid = cowimg - cowmod
+                coresid[cow == 0] = 0.
+                C.coresids.append(coresid)
 
-            if psf_images:
-                from astrometry.util.util import lanczos3_interpolate
-                h,w = tim.shape
-                patch = tim.psf.getPointSourcePatch(w//2, h//2).patch
-                patch /= np.sum(patch)
-                # In case the tim and coadd have different pixel scales,
-                # resample the PSF stamp.
-                ph,pw = patch.shape
-                pscale = tim.imobj.pixscale / targetwcs.pixel_scale()
-                coph = int(np.ceil(ph * pscale))
-                copw = int(np.ceil(pw * pscale))
-                coph = 2 * (coph//2) + 1
-                copw = 2 * (copw//2) + 1
-                # want input image pixel coords that change by 1/pscale
-                # and are centered on pw//2, ph//2
-                cox = np.arange(copw) * 1./pscale
-                cox += pw//2 - cox[copw//2]
-                coy = np.arange(coph) * 1./pscale
-                coy += ph//2 - coy[coph//2]
-                fx,fy = np.meshgrid(cox,coy)
-                fx = fx.ravel()
-                fy = fy.ravel()
-                ix = (fx + 0.5).astype(np.int32)
-                iy = (fy + 0.5).astype(np.int32)
-                dx = (fx - ix).astype(np.float32)
-                dy = (fy - iy).astype(np.float32)
-                copsf = np.zeros(coph*copw, np.float32)
-                rtn = lanczos3_interpolate(ix, iy, dx, dy, [copsf], [patch])
-                assert(rtn == 0)
-                copsf = copsf.reshape((coph,copw))
-                copsf /= copsf.sum()
-                if plots:
-                    _make_coadds_plots_2(patch, copsf, psf_img, tim, band, ps)
+            if blobmods is not None:
+                cowblobmod  /= np.maximum(cow, tinyw)
+                C.coblobmods.append(cowblobmod)
+                coblobresid = cowimg - cowblobmod
+                coblobresid[cow == 0] = 0.
+                C.coblobresids.append(coblobresid)
 
-                psf_img += copsf / tim.sig1**2
+            if allmasks:
+                C.allmasks.append(andmask)
+            if anymasks:
+                C.anymasks.append(ormask)
 
-            if detmaps:
-                # point-source depth
-                detsig1 = tim.sig1 / tim.psfnorm
-                psfdetiv[Yo,Xo] += (iv > 0) * (1. / detsig1**2)
-                # Galaxy detection map
-                gdetsig1 = tim.sig1 / tim.galnorm
-                galdetiv[Yo,Xo] += (iv > 0) * (1. / gdetsig1**2)
+            if psf_images:
+                C.psf_imgs.append(psf_img / np.sum(psf_img))
 
-            if ngood:
-                congood[Yo,Xo] += (iv > 0)
+            if unweighted:
+                coimg  /= np.maximum(con, 1)
+                del con
 
-            if mods is not None:
-                # straight-up
-                comod[Yo,Xo] += goodpix * mo
-                # invvar-weighted
-                cowmod[Yo,Xo] += iv * mo
-                # chi-squared
-                cochi2[Yo,Xo] += iv * (im - mo)**2
-                del mo
+                if plots:
+                    _make_coadds_plots_3(cowimg, cow, coimg, band, ps)
 
-            if blobmods is not None:
-                # straight-up
-                coblobmod[Yo,Xo] += goodpix * bmo
-                # invvar-weighted
-                cowblobmod[Yo,Xo] += iv * bmo
-                del bmo
-            del goodpix
-
-            if max:
-                maximg[Yo,Xo] = np.maximum(maximg[Yo,Xo], im * (iv>0))
-
-            del Yo,Xo,im,iv
-            # END of loop over tims
-        # Per-band:
-        cowimg /= np.maximum(cow, tinyw)
-        C.coimgs.append(cowimg)
-        C.cowimgs.append(cow)
-        if mods is not None:
-            cowmod  /= np.maximum(cow, tinyw)
-            C.comods.append(cowmod)
-            coresid = cowimg - cowmod
-            coresid[cow == 0] = 0.
-            C.coresids.append(coresid)
-
-        if blobmods is not None:
-            cowblobmod  /= np.maximum(cow, tinyw)
-            C.coblobmods.append(cowblobmod)
-            coblobresid = cowimg - cowblobmod
-            coblobresid[cow == 0] = 0.
-            C.coblobresids.append(coblobresid)
-
-        if allmasks:
-            C.allmasks.append(andmask)
-        if anymasks:
-            C.anymasks.append(ormask)
-
-        if psf_images:
-            C.psf_imgs.append(psf_img / np.sum(psf_img))
-
-        if unweighted:
-            coimg  /= np.maximum(con, 1)
-            del con
-
-            if plots:
-                _make_coadds_plots_3(cowimg, cow, coimg, band, ps)
-
-            cowimg[cow == 0] = coimg[cow == 0]
-            if mods is not None:
-                cowmod[cow == 0] = comod[cow == 0]
-            if blobmods is not None:
-                cowblobmod[cow == 0] = coblobmod[cow == 0]
-
-        if xy:
-            C.T.nobs   [:,iband] = nobs   [iy,ix]
-            C.T.anymask[:,iband] = ormask [iy,ix]
-            C.T.allmask[:,iband] = andmask[iy,ix]
-            # unless there were no images there...
-            C.T.allmask[nobs[iy,ix] == 0, iband] = 0
-            if detmaps:
-                C.T.psfdepth[:,iband] = psfdetiv[iy, ix]
-                C.T.galdepth[:,iband] = galdetiv[iy, ix]
+                cowimg[cow == 0] = coimg[cow == 0]
+                if mods is not None:
+                    cowmod[cow == 0] = comod[cow == 0]
+                if blobmods is not None:
+                    cowblobmod[cow == 0] = coblobmod[cow == 0]
 
-        if psfsize:
-            # psfsizemap is accumulated in units of iv * (1 / arcsec**2)
-            # take out the weighting
-            psfsizemap /= np.maximum(flatcow, tinyw)
-            # Correction factor to get back to equivalent of Gaussian sigma
-            tosigma = 1./(2. * np.sqrt(np.pi))
-            # Conversion factor to FWHM (2.35)
-            tofwhm = 2. * np.sqrt(2. * np.log(2.))
-            # Scale back to units of linear arcsec.
-            with np.errstate(divide='ignore'):
-                psfsizemap[:,:] = (1. / np.sqrt(psfsizemap)) * tosigma * tofwhm
-            psfsizemap[flatcow == 0] = 0.
             if xy:
-                C.T.psfsize[:,iband] = psfsizemap[iy,ix]
+                C.T.nobs   [:,iband] = nobs   [iy,ix]
+                C.T.anymask[:,iband] = ormask [iy,ix]
+                C.T.allmask[:,iband] = andmask[iy,ix]
+                # unless there were no images there...
+                C.T.allmask[nobs[iy,ix] == 0, iband] = 0
+                if detmaps:
+                    C.T.psfdepth[:,iband] = psfdetiv[iy, ix]
+                    C.T.galdepth[:,iband] = galdetiv[iy, ix]
 
-        if apertures is not None:
-            # Aperture photometry
-            # photutils.aperture_photometry: mask=True means IGNORE
-            mask = (cow == 0)
-            with np.errstate(divide='ignore'):
-                imsigma = 1.0/np.sqrt(cow)
-            imsigma[mask] = 0.
+            if psfsize:
+                # psfsizemap is accumulated in units of iv * (1 / arcsec**2)
+                # take out the weighting
+                psfsizemap /= np.maximum(flatcow, tinyw)
+                # Correction factor to get back to equivalent of Gaussian sigma
+                tosigma = 1./(2. * np.sqrt(np.pi))
+                # Conversion factor to FWHM (2.35)
+                tofwhm = 2. * np.sqrt(2. * np.log(2.))
+                # Scale back to units of linear arcsec.
+                with np.errstate(divide='ignore'):
+                    psfsizemap[:,:] = (1. / np.sqrt(psfsizemap)) * tosigma * tofwhm
+                psfsizemap[flatcow == 0] = 0.
+                if xy:
+                    C.T.psfsize[:,iband] = psfsizemap[iy,ix]
+
+            if apertures is not None:
+                # Aperture photometry
+                # aperture_photometry: mask=True means IGNORE
+                mask = (cow == 0)
+                with np.errstate(divide='ignore'):
+                    imsigma = 1.0/np.sqrt(cow)
+                imsigma[mask] = 0.
 
-            for irad,rad in enumerate(apertures):
-                apargs.append((irad, band, rad, cowimg, imsigma, mask,
-                               True, apxy))
+                # The image, residual and blob-residual images share the
+                # aperture weights, so are photometered in one task.
+                apimgs = [cowimg]
                 if mods is not None:
-                    apargs.append((irad, band, rad, coresid, None, None,
-                                   False, apxy))
+                    apimgs.append(coresid)
                 if blobmods is not None:
-                    apargs.append((irad, band, rad, coblobresid, None, None,
-                                   False, apxy))
+                    apimgs.append(coblobresid)
+                for irad,rad in enumerate(apertures):
+                    apargs.append((irad, band, rad, apimgs, imsigma, mask, apxy))
 
-        if callback is not None:
-            callback(band, *callback_args, **kwargs)
-        # END of loop over bands
+            if callback is not None:
+                callback(band, *callback_args, **kwargs)
+            # END of loop over bands
+    finally:
+        for sa in shared_arrays.values():
+            sa.remove()
 
     t2 = Time()
     debug('coadds: images:', t2-t0)
@@ -648,31 +546,16 @@ def make_coadds(tims, bands, targetwcs,
             if blobmods is not None:
                 apblobres = []
             for irad,rad in enumerate(apertures):
-                (airad, aband, isimg, ap_img, ap_err, ap_mask) = next(apresults)
+                (airad, aband, ap_imgs, ap_err, ap_mask) = next(apresults)
                 assert(airad == irad)
                 assert(aband == band)
-                assert(isimg)
-                apimg.append(ap_img)
+                apimg.append(ap_imgs[0])
                 apimgerr.append(ap_err)
                 apmask.append(ap_mask)
-
                 if mods is not None:
-                    (airad, aband, isimg, ap_img, ap_err, ap_mask) = next(apresults)
-                    assert(airad == irad)
-                    assert(aband == band)
-                    assert(not isimg)
-                    apres.append(ap_img)
-                    assert(ap_err is None)
-                    assert(ap_mask is None)
-
+                    apres.append(ap_imgs[1])
                 if blobmods is not None:
-                    (airad, aband, isimg, ap_img, ap_err, ap_mask) = next(apresults)
-                    assert(airad == irad)
-                    assert(aband == band)
-                    assert(not isimg)
-                    apblobres.append(ap_img)
-                    assert(ap_err is None)
-                    assert(ap_mask is None)
+                    apblobres.append(ap_imgs[-1])
 
             ap = np.vstack(apimg).T
             ap[np.logical_not(np.isfinite(ap))] = 0.
@@ -886,11 +769,11 @@ def _resample_one(args):
         imgs = []
 
     try:
-        Yo,Xo,Yi,Xi,rimgs = resample_with_wcs(
+        rmap,rimgs = resample_map_with_wcs(
             targetwcs, tim.subwcs, imgs, 3, intType=np.int16)
     except OverlapError:
         return None
-    if len(Yo) == 0:
+    if len(rmap) == 0:
         return None
     mo = None
     bmo = None
@@ -905,12 +788,12 @@ def _resample_one(args):
             inext += 1
         del patched,imgs,rimgs
     else:
-        im = tim.getImage ()[Yi,Xi]
+        im = rmap.gather_in(tim.getImage())
         if mod is not None:
-            mo = mod[Yi,Xi]
+            mo = rmap.gather_in(mod)
         if blobmod is not None:
-            bmo = blobmod[Yi,Xi]
-    iv = tim.getInvvar()[Yi,Xi]
+            bmo = rmap.gather_in(blobmod)
+    iv = rmap.gather_in(tim.getInvvar())
     if sbscale:
         fscale = tim.sbscale
         debug('Applying surface-brightness scaling of %.3f to' % fscale, tim.name)
@@ -923,32 +806,324 @@ def _resample_one(args):
     if tim.dq is None:
         dq = None
     else:
-        dq = tim.dq[Yi,Xi]
-    return itim,Yo,Xo,iv,im,mo,bmo,dq
+        dq = rmap.gather_in(tim.dq)
+    # The (run-length encoded) map is much smaller to send back than
+    # the output pixel indices.
+    return itim,rmap,iv,im,mo,bmo,dq
 
-def _apphot_one(args):
-    (irad, band, rad, img, sigma, mask, isimage, apxy) = args
-    import photutils
-    result = [irad, band, isimage]
-    aper = photutils.CircularAperture(apxy, rad)
-    p = photutils.aperture_photometry(img, aper, error=sigma, mask=mask)
-    result.append(p.field('aperture_sum'))
-    if sigma is not None:
-        result.append(p.field('aperture_sum_err'))
-    else:
-        result.append(None)
-
-    # If a mask is passed, also photometer it!
-    if mask is not None:
-        p = photutils.aperture_photometry(mask, aper)
-        maskedpix = p.field('aperture_sum')
-        # normalize by number of pixels (pi * rad**2)
-        maskedpix /= (np.pi * rad**2)
-        result.append(maskedpix)
+def _is_local_pool(mp):
+    '''
+    Is *mp* (a multiproc object) backed by a process pool on this
+    machine (rather than, eg, MPI)?
+    '''
+    from multiprocessing.pool import Pool
+    return isinstance(getattr(mp, 'pool', None), Pool)
+
+class _SharedArrays(object):
+    '''
+    A set of named arrays in memory-mapped files (in /dev/shm, where
+    it exists) that worker processes can open by name and update in
+    place, with a file lock to serialize the updates.  Only the
+    directory name and array specs are pickled.
+    '''
+    def __init__(self):
+        import os
+        import tempfile
+        tmpdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.dirnm = tempfile.mkdtemp(prefix='coadd-', dir=tmpdir)
+        self.specs = {}
+
+    def _fn(self, name):
+        import os
+        return os.path.join(self.dirnm, name)
+
+    def alloc(self, name, dtype, shape, fill=0):
+        a = np.memmap(self._fn(name), dtype=dtype, mode='w+', shape=shape)
+        if fill:
+            a[:] = fill
+        a.flush()
+        del a
+        self.specs[name] = (np.dtype(dtype).str, shape)
+
+    def _open(self):
+        return dict([(name, np.memmap(self._fn(name), dtype=dt, mode='r+',
+                                      shape=shape))
+                     for name,(dt,shape) in self.specs.items()])
+
+    @contextmanager
+    def locked(self):
+        '''
+        Yields a dict of the arrays, holding the lock.
+        '''
+        import fcntl
+        with open(self._fn('lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield self._open()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self):
+        '''
+        Returns a dict of (in-memory copies of) the arrays, deleting
+        each file as it is read (so that only one array at a time is
+        held twice), and then the directory.
+        '''
+        import os
+        A = {}
+        for name,(dt,shape) in self.specs.items():
+            fn = self._fn(name)
+            A[name] = np.fromfile(fn, dtype=dt).reshape(shape)
+            os.remove(fn)
+        self.remove()
+        return A
+
+    def remove(self):
+        import shutil
+        shutil.rmtree(self.dirnm, ignore_errors=True)
+
+def _alloc_array(name, dtype, shape, fill=0):
+    if fill:
+        a = np.empty(shape, dtype)
+        a[:] = fill
+        return a
+    return np.zeros(shape, dtype)
+
+def _coadd_arrays(alloc, H=None, W=None, detmaps=False, mods=False,
+                  blobmods=False, ngood=False, masks=False, nobs=False,
+                  psfsize=False):
+    '''
+    Allocates the arrays that the tims of one band are accumulated into
+    (see _accumulate_tim), with *alloc(name, dtype, shape, fill)*.
+    Returns a dict of the results of *alloc*.
+    '''
+    from functools import reduce
+    A = {}
+    def add(name, dtype, fill=0):
+        A[name] = alloc(name, dtype, (H,W), fill)
+    # coadded weight map (moo)
+    add('cow', np.float32)
+    # coadded weighted image map
+    add('cowimg', np.float32)
+    # unweighted image, number of exposures, and inverse-variance
+    add('coimg', np.float32)
+    add('con', np.int16)
+    add('coiv', np.float32)
+    add('maximg', np.float32)
+    if detmaps:
+        # detection map inverse-variance (depth map)
+        add('psfdetiv', np.float32)
+        # galaxy detection map inverse-variance (galdepth map)
+        add('galdetiv', np.float32)
+    if mods:
+        # model image (weighted and unweighted) and chi-squared image
+        add('cowmod', np.float32)
+        add('comod', np.float32)
+        add('cochi2', np.float32)
+    if blobmods:
+        add('cowblobmod', np.float32)
+        add('coblobmod', np.float32)
+    # Note that we have 'congood' as well as 'nobs':
+    # * 'congood' is used for the 'nexp' *image*.
+    #   It counts the number of "good" (unmasked) exposures
+    # * 'nobs' is used for the per-source measurements
+    #   It counts the total number of exposures, including masked pixels
+    #
+    # (you want to know the number of observations within the
+    # source footprint, not just the peak pixel which may be
+    # saturated, etc.)
+    if ngood:
+        add('congood', np.int16)
+    if masks:
+        # These match the type of the "DQ" images.
+        # "any" mask
+        add('ormask', np.int16)
+        # "all" mask
+        allbits = reduce(np.bitwise_or, DQ_BITS.values())
+        add('andmask', np.int16, allbits)
+    if nobs:
+        # number of observations
+        add('nobs', np.int16)
+    if psfsize:
+        add('psfsizemap', np.float32)
+        # like "cow", but constant invvar per-CCD;
+        # only required for psfsizemap
+        add('flatcow', np.float32)
+    return A
+
+def _accumulate_tim(A, itim, tim, Yo, Xo, iv, im, mo, bmo, dq, mjds,
+                    satur_val):
+    '''
+    Adds one resampled tim (from _resample_one) into the coadd arrays
+    in dict *A* (from _coadd_arrays).
+    '''
+    # invvar-weighted image
+    A['cowimg'][Yo,Xo] += iv * im
+    A['cow']   [Yo,Xo] += iv
+
+    if dq is None:
+        goodpix = 1
     else:
-        result.append(None)
+        # include SATUR pixels if no other
+        # pixels exists
+        okbits = 0
+        for bitname in ['satur']:
+            okbits |= DQ_BITS[bitname]
+        brightpix = ((dq & okbits) != 0)
+        if satur_val is not None:
+            # HACK -- force SATUR pix to be bright
+            im[brightpix] = satur_val
+        # Include these pixels if none other exist??
+        for bitname in ['interp']: #, 'bleed']:
+            okbits |= DQ_BITS[bitname]
+        goodpix = ((dq & ~okbits) == 0)
+
+    A['coimg'][Yo,Xo] += goodpix * im
+    A['con']  [Yo,Xo] += goodpix
+    A['coiv'] [Yo,Xo] += goodpix * 1./(tim.sig1 * tim.sbscale)**2  # ...ish
+
+    if 'ormask' in A:
+        if dq is not None:
+            A['ormask'] [Yo,Xo] |= dq
+            A['andmask'][Yo,Xo] &= dq
+    if 'nobs' in A:
+        # raw exposure count
+        A['nobs'][Yo,Xo] += 1
+        # mjd_min/max
+        mjd_argmins = A['mjd_argmins']
+        mjd_argmaxs = A['mjd_argmaxs']
+        update = np.logical_or(mjd_argmins[Yo,Xo] == -1,
+                               (mjd_argmins[Yo,Xo] > -1) *
+                               (mjds[itim] < mjds[mjd_argmins[Yo,Xo]]))
+        mjd_argmins[Yo[update],Xo[update]] = itim
+        update = np.logical_or(mjd_argmaxs[Yo,Xo] == -1,
+                               (mjd_argmaxs[Yo,Xo] > -1) *
+                               (mjds[itim] > mjds[mjd_argmaxs[Yo,Xo]]))
+        mjd_argmaxs[Yo[update],Xo[update]] = itim
+        del update
+
+    if 'psfsizemap' in A:
+        # psfnorm is in units of 1/pixels.
+        # (eg, psfnorm for a gaussian is 1./(2.*sqrt(pi) * psf_sigma) )
+        # Neff is in pixels**2
+        neff = 1./tim.psfnorm**2
+        # Narcsec is in arcsec**2
+        narcsec = neff * tim.wcs.pixel_scale()**2
+        # Make smooth maps -- don't ignore CRs, saturated pix, etc
+        iv1 = 1./tim.sig1**2
+        A['psfsizemap'][Yo,Xo] += iv1 * (1. / narcsec)
+        A['flatcow']   [Yo,Xo] += iv1
+
+    if 'psfdetiv' in A:
+        # point-source depth
+        detsig1 = tim.sig1 / tim.psfnorm
+        A['psfdetiv'][Yo,Xo] += (iv > 0) * (1. / detsig1**2)
+        # Galaxy detection map
+        gdetsig1 = tim.sig1 / tim.galnorm
+        A['galdetiv'][Yo,Xo] += (iv > 0) * (1. / gdetsig1**2)
+
+    if 'congood' in A:
+        A['congood'][Yo,Xo] += (iv > 0)
+
+    if 'cowmod' in A:
+        # straight-up
+        A['comod'][Yo,Xo] += goodpix * mo
+        # invvar-weighted
+        A['cowmod'][Yo,Xo] += iv * mo
+        # chi-squared
+        A['cochi2'][Yo,Xo] += iv * (im - mo)**2
+
+    if 'cowblobmod' in A:
+        # straight-up
+        A['coblobmod'][Yo,Xo] += goodpix * bmo
+        # invvar-weighted
+        A['cowblobmod'][Yo,Xo] += iv * bmo
+
+    maximg = A['maximg']
+    maximg[Yo,Xo] = np.maximum(maximg[Yo,Xo], im * (iv>0))
+
+def _merge_mjd_argmin(argmin, bandargmin, mjds, better):
+    '''
+    Merges the per-band arg-min (or max, with *better* = np.greater)
+    MJD map *bandargmin* into *argmin*.
+    '''
+    update = (bandargmin > -1) * np.logical_or(
+        argmin == -1, better(mjds[bandargmin], mjds[argmin]))
+    argmin[update] = bandargmin[update]
+
+def _coadd_psf_image(tim, targetwcs):
+    '''
+    Returns the tim's PSF stamp at the center of the image, and that
+    stamp resampled to the coadd pixel scale.
+    '''
+    from astrometry.util.util import lanczos3_interpolate
+    h,w = tim.shape
+    patch = tim.psf.getPointSourcePatch(w//2, h//2).patch
+    patch /= np.sum(patch)
+    # In case the tim and coadd have different pixel scales,
+    # resample the PSF stamp.
+    ph,pw = patch.shape
+    pscale = tim.imobj.pixscale / targetwcs.pixel_scale()
+    coph = int(np.ceil(ph * pscale))
+    copw = int(np.ceil(pw * pscale))
+    coph = 2 * (coph//2) + 1
+    copw = 2 * (copw//2) + 1
+    # want input image pixel coords that change by 1/pscale
+    # and are centered on pw//2, ph//2
+    cox = np.arange(copw) * 1./pscale
+    cox += pw//2 - cox[copw//2]
+    coy = np.arange(coph) * 1./pscale
+    coy += ph//2 - coy[coph//2]
+    fx,fy = np.meshgrid(cox,coy)
+    fx = fx.ravel()
+    fy = fy.ravel()
+    ix = (fx + 0.5).astype(np.int32)
+    iy = (fy + 0.5).astype(np.int32)
+    dx = (fx - ix).astype(np.float32)
+    dy = (fy - iy).astype(np.float32)
+    copsf = np.zeros(coph*copw, np.float32)
+    rtn = lanczos3_interpolate(ix, iy, dx, dy, [copsf], [patch])
+    assert(rtn == 0)
+    copsf = copsf.reshape((coph,copw))
+    copsf /= copsf.sum()
+    return patch, copsf
+
+def _resample_accumulate(args):
+    '''
+    Resamples one tim and adds it directly into the shared coadd
+    arrays for its band; returns only (itim, PSF stamp or None).
+    '''
+    (rargs, arrays, mjds, satur_val, psf_images) = args
+    R = _resample_one(rargs)
+    if R is None:
+        return None
+    itim,rmap,iv,im,mo,bmo,dq = R
+    tim = rargs[1]
+    Yo,Xo = rmap.out_indices()
+    with arrays.locked() as A:
+        _accumulate_tim(A, itim, tim, Yo, Xo, iv, im, mo, bmo, dq, mjds,
+                        satur_val)
+    copsf = None
+    if psf_images:
+        targetwcs = rargs[5]
+        _,copsf = _coadd_psf_image(tim, targetwcs)
+    return itim, copsf
 
-    return result
+def _apphot_one(args):
+    (irad, band, rad, imgs, sigma, mask, apxy) = args
+    from legacypipe.apphot import aperture_photometry
+    # Also photometer the mask itself (unmasked!), sharing the
+    # aperture weights.
+    n = len(imgs)
+    P = aperture_photometry(imgs + [mask.astype(np.float32)], apxy, rad,
+                            errors=[sigma] + [None]*n,
+                            mask=[mask]*n + [None])
+    apsums = [apsum for apsum,_ in P[:n]]
+    aperr = P[0][1]
+    maskedpix = P[n][0]
+    # normalize by number of pixels (pi * rad**2)
+    maskedpix /= (np.pi * rad**2)
+    return [irad, band, apsums, aperr, maskedpix]
 
 def get_coadd_headers(hdr, tims, band, coadd_headers={}):
     # Grab these keywords from all input files for this band...
@@ -1,4 +1,5 @@
 from __future__ import print_function
+from collections import OrderedDict
 import numpy as np
 
 from legacypipe.image import LegacySurveyImage, validate_version
@@ -17,6 +18,75 @@ def debug(*args):
 Code specific to images from the Dark Energy Camera (DECam).
 '''
 
+# Process-wide caches for the sky-scales tables, so that the CCDs of
+# an exposure (in calibration jobs), or the exposures of a brick, do
+# not re-read them:
+#  - sky-scales kd-trees, filename -> kd-tree
+#  - sky-scales table rows, (filename, expnum) -> {ccdname: row}
+# The latter is a least-recently-used cache of limited size.  (The
+# template images themselves are not cached: each CCD reads its own
+# template HDU, or just the part of it that it needs.)
+_sky_scales_kd_cache = {}
+_sky_scales_cache = OrderedDict()
+_sky_scales_cache_size = 16
+
+def _lru_get(cache, key):
+    val = cache.get(key)
+    if val is not None:
+        cache.move_to_end(key)
+    return val
+
+def _lru_put(cache, key, val, size):
+    cache[key] = val
+    while len(cache) > size:
+        cache.popitem(last=False)
+
+def get_sky_scales(fn, expnum):
+    '''
+    Returns a dict of ccdname -> row of the sky-scales table *fn*, for
+    the given exposure number.
+    '''
+    from astrometry.util.fits import fits_table
+    key = (fn, expnum)
+    rows = _lru_get(_sky_scales_cache, key)
+    if rows is not None:
+        return rows
+    kd = _sky_scales_kd_cache.get(fn)
+    if kd is None:
+        from astrometry.libkd.spherematch import tree_open
+        kd = tree_open(fn, 'expnum')
+        _sky_scales_kd_cache[fn] = kd
+    I = kd.search(np.array([expnum]), 0.5, 0, 0)
+    rows = {}
+    if len(I):
+        # Read only the CCD-table rows within range.
+        S = fits_table(fn, rows=I)
+        ccdnames = np.array([c.strip() for c in S.ccdname])
+        for c in np.unique(ccdnames):
+            rows[c] = S[ccdnames == c]
+    _lru_put(_sky_scales_cache, key, rows, _sky_scales_cache_size)
+    return rows
+
+def read_sky_template(tfn, ccdname, slc=None):
+    '''
+    Returns (template image, SKYTMPL version) for CCD *ccdname* from
+    the sky template file *tfn*.  With *slc*, only that part of the
+    template is read.
+    '''
+    import fitsio
+    F = fitsio.FITS(tfn)
+    ver = F[0].read_header().get('SKYTMPL', -1)
+    if slc is not None:
+        return F[ccdname][slc],ver
+    return F[ccdname].read(),ver
+
+def clear_sky_template_cache():
+    '''
+    Drops the cached sky-scales tables.
+    '''
+    _sky_scales_kd_cache.clear()
+    _sky_scales_cache.clear()
+
 class DecamImage(LegacySurveyImage):
     '''
     A LegacySurveyImage subclass to handle images from the Dark Energy
@@ -29,7 +99,6 @@ class DecamImage(LegacySurveyImage):
 
     def get_sky_template_filename(self, old_calibs_ok=False):
         import os
-        from astrometry.util.fits import fits_table
         dirnm = os.environ.get('SKY_TEMPLATE_DIR', None)
         if dirnm is None:
             info('decam: no SKY_TEMPLATE_DIR environment variable set.')
@@ -43,16 +112,12 @@ class DecamImage(LegacySurveyImage):
         if not os.path.exists(fn):
             info('decam: no $SKY_TEMPLATE_DIR/sky-scales.kd.fits file.')
             return None
-        from astrometry.libkd.spherematch import tree_open
-        kd = tree_open(fn, 'expnum')
-        I = kd.search(np.array([self.expnum]), 0.5, 0, 0)
-        if len(I) == 0:
+        rows = get_sky_scales(fn, self.expnum)
+        if len(rows) == 0:
             info('decam: expnum %i not found in file %s' % (self.expnum, fn))
             return None
-        # Read only the CCD-table rows within range.
-        S = fits_table(fn, rows=I)
-        S.cut(np.array([c.strip() == self.ccdname for c in S.ccdname]))
-        if len(S) == 0:
+        S = rows.get(self.ccdname)
+        if S is None:
             info('decam: ccdname %s, expnum %i not found in file %s' %
                   (self.ccdname, self.expnum, fn))
             return None
@@ -79,8 +144,6 @@ class DecamImage(LegacySurveyImage):
         return dict(template_filename=tfn, sky_template_dir=dirnm, sky_obj=sky, skyscales_fn=fn)
 
     def get_sky_template(self, slc=None, old_calibs_ok=False):
-        import os
-        import fitsio
         d = self.get_sky_template_filename(old_calibs_ok=old_calibs_ok)
         if d is None:
             return None
@@ -88,14 +151,7 @@ class DecamImage(LegacySurveyImage):
         sky_template_dir = d['sky_template_dir']
         tfn = d['template_filename']
         sky = d['sky_obj']
-        F = fitsio.FITS(tfn)
-        f = F[self.ccdname]
-        if slc is None:
-            template = f.read()
-        else:
-            template = f[slc]
-        hdr = F[0].read_header()
-        ver = hdr.get('SKYTMPL', -1)
+        template,ver = read_sky_template(tfn, self.ccdname, slc=slc)
         meta = dict(sky_scales_fn=skyscales_fn, template_fn=tfn, sky_template_dir=sky_template_dir,
                     run=sky.run, scale=sky.skyscale, version=ver)
         return template * sky.skyscale, meta
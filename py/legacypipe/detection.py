@@ -16,7 +16,7 @@ def _detmap(X):
     (tim, targetwcs, apodize) = X
     R = tim_get_resamp(tim, targetwcs)
     if R is None:
-        return None,None,None,None,None
+        return None,None,None,None
     assert(tim.psf_sigma > 0)
     psfnorm = 1./(2. * np.sqrt(np.pi) * tim.psf_sigma)
     ie = tim.getInvError()
@@ -30,13 +30,13 @@ def _detmap(X):
     detiv = np.zeros((subh,subw), np.float32) + (1. / detsig1**2)
     detiv[ie == 0] = 0.
 
-    (Yo,Xo,Yi,Xi) = R
     if tim.dq is None:
         sat = None
     else:
-        sat = ((tim.dq[Yi,Xi] & tim.dq_saturation_bits) > 0)
+        sat = ((R.gather_in(tim.dq) & tim.dq_saturation_bits) > 0)
         # Replace saturated pixels by the brightest (non-masked) pixel in the image
         if np.any(sat):
+            Yi,Xi = R.in_indices()
             I, = np.nonzero(sat)
             debug('Filling', len(I), 'saturated detmap pixels with max')
             detim[Yi[I],Xi[I]] = np.max(detim)
@@ -57,7 +57,7 @@ def _detmap(X):
         detiv[-len(ramp):,:] *= ramp[::-1][:,np.newaxis]
         detiv[:,-len(ramp):] *= ramp[::-1][np.newaxis,:]
 
-    return Yo, Xo, detim[Yi,Xi], detiv[Yi,Xi], sat
+    return R, R.gather_in(detim), R.gather_in(detiv), sat
 
 def detection_maps(tims, targetwcs, bands, mp, apodize=None):
     # Render the detection maps
@@ -68,15 +68,15 @@ def detection_maps(tims, targetwcs, bands, mp, apodize=None):
     detmaps = [np.zeros((H,W), np.float32) for b in bands]
     detivs  = [np.zeros((H,W), np.float32) for b in bands]
     satmaps = [np.zeros((H,W), bool)       for b in bands]
-    for tim, (Yo,Xo,incmap,inciv,sat) in zip(
+    for tim, (rmap,incmap,inciv,sat) in zip(
         tims, mp.map(_detmap, [(tim, targetwcs, apodize) for tim in tims])):
-        if Yo is None:
+        if rmap is None:
             continue
         ib = ibands[tim.band]
-        detmaps[ib][Yo,Xo] += incmap * inciv
-        detivs [ib][Yo,Xo] += inciv
+        rmap.scatter_add(detmaps[ib], incmap * inciv)
+        rmap.scatter_add(detivs [ib], inciv)
         if sat is not None:
-            satmaps[ib][Yo,Xo] |= sat
+            rmap.scatter(satmaps[ib], sat, np.logical_or)
     for detmap,detiv in zip(detmaps, detivs):
         detmap /= np.maximum(1e-16, detiv)
     return detmaps, detivs, satmaps
@@ -109,6 +109,58 @@ def sed_matched_filters(bands):
 
     return SEDs
 
+def sed_matched_maps(SEDs, detmaps, detivs, saturated_pix=None):
+    '''
+    Computes the significance maps of a list of SED-matched filters
+    together, in one pass over the per-band detection maps.
+
+    Parameters
+    ----------
+    SEDs : list of (name, sed) tuples
+    detmaps, detivs : lists of numpy arrays
+        The per-band detection maps and their inverse-variances.
+    saturated_pix : None or list of numpy arrays, boolean
+        Per-band saturated-pixel maps.
+
+    Returns
+    -------
+    sedsn : numpy array, float, shape (len(SEDs), H, W)
+        The S/N map of each SED.
+    sediv : numpy array, float, shape (len(SEDs), H, W)
+        The inverse-variance of each SED's map; all zero for SEDs with
+        all zero weight.
+    satur : None or numpy array, boolean, shape (len(SEDs), H, W)
+        Saturated pixels in any of each SED's bands.
+    '''
+    seds = np.array([sed for _,sed in SEDs], np.float32)
+    nsed = len(seds)
+    H,W = detmaps[0].shape
+    sedmap = np.zeros((nsed,H,W), np.float32)
+    sediv  = np.zeros((nsed,H,W), np.float32)
+    satur = None
+    if saturated_pix is not None:
+        satur = np.zeros((nsed,H,W), bool)
+    for iband,(detmap,detiv) in enumerate(zip(detmaps, detivs)):
+        I, = np.nonzero(seds[:,iband])
+        if len(I) == 0:
+            continue
+        # We convert the detmap to canonical band via
+        #   detmap * w
+        # And the corresponding change to sig1 is
+        #   sig1 * w
+        # So the invvar-weighted sum is
+        #    (detmap * w) / (sig1**2 * w**2)
+        #  = detmap / (sig1**2 * w)
+        w = seds[I,iband][:,np.newaxis,np.newaxis]
+        sedmap[I] += (detmap * detiv)[np.newaxis] / w
+        sediv [I] += detiv[np.newaxis] / w**2
+        if satur is not None:
+            satur[I] |= saturated_pix[iband][np.newaxis]
+    sedmap /= np.maximum(1e-16, sediv)
+    sedsn = sedmap
+    sedsn *= np.sqrt(sediv)
+    return sedsn, sediv, satur
+
 def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
                             targetwcs, nsigma=5,
                             saddle_fraction=0.1,
@@ -116,6 +168,7 @@ def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
                             saturated_pix=None,
                             exclusion_radius=4.,
                             veto_map=None,
+                            single_pass=False,
                             mp=None,
                             plots=False, ps=None, rgbimg=None):
     '''
@@ -146,6 +199,10 @@ def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
         existing source.
     exclusion_radius: int
         How many pixels around an existing source to veto
+    single_pass : boolean, optional
+        Rather than running the SEDs one after another (each avoiding
+        the sources found by the ones before), run the detection once,
+        on the per-pixel maximum S/N over all the SEDs.
     plots : boolean, optional
         Create plots?
     ps : PlotSequence object
@@ -156,7 +213,8 @@ def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
     Returns
     -------
     Tnew : fits_table
-        Table of new sources detected
+        Table of new sources detected; the `sedname` column gives the
+        SED that found each one.
     newcat : list of PointSource objects
         Newly detected objects, with positions and fluxes, as Tractor
         PointSource objects.
@@ -183,16 +241,40 @@ def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
 
     peaksn = []
     apsn = []
+    sednames = []
 
-    for sedname,sed in SEDs:
-        if plots:
-            pps = ps
-        else:
-            pps = None
+    if plots:
+        pps = ps
+    else:
+        pps = None
+
+    if single_pass:
+        sedsn,sediv,satur = sed_matched_maps(SEDs, detmaps, detivs,
+                                             saturated_pix=saturated_pix)
+        # Drop SEDs with all zero weight
+        I = np.flatnonzero([np.any(iv > 0) for iv in sediv])
+        names = np.array([name for name,_ in SEDs])[I]
+        runs = []
+        if len(I):
+            sedsn = sedsn[I]
+            sediv = sediv[I]
+            if satur is not None:
+                satur = np.any(satur[I], axis=0)
+            # Per pixel, which SED gives the largest S/N?
+            which = np.argmax(sedsn, axis=0)[np.newaxis]
+            sedsn = np.take_along_axis(sedsn, which, axis=0)[0]
+            sediv = np.take_along_axis(sediv, which, axis=0)[0]
+            which = which[0]
+            runs.append(('max', None, (sedsn, sediv, satur)))
+        del sedsn, sediv
+    else:
+        runs = [(sedname, sed, None) for sedname,sed in SEDs]
+
+    for sedname,sed,sedmaps in runs:
         sedhot,px,py,peakval,apval = sed_matched_detection(
             sedname, sed, detmaps, detivs, bands, xx, yy, rr,
             nsigma=nsigma, saddle_fraction=saddle_fraction, saddle_min=saddle_min,
-            saturated_pix=saturated_pix, veto_map=veto_map,
+            saturated_pix=saturated_pix, veto_map=veto_map, sedmaps=sedmaps,
             ps=pps, rgbimg=rgbimg)
         if sedhot is None:
             continue
@@ -204,6 +286,10 @@ def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
         rr = np.append(rr, np.zeros_like(px) + exclusion_radius).astype(int)
         peaksn.extend(peakval)
         apsn.extend(apval)
+        if sedmaps is None:
+            sednames.extend([sedname] * len(px))
+        else:
+            sednames.extend(names[which[py,px]])
 
     # New peaks:
     peakx = xx[n0:]
@@ -225,6 +311,7 @@ def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
         assert(len(apsn) == len(Tnew))
         Tnew.peaksn = np.array(peaksn)
         Tnew.apsn = np.array(apsn)
+        Tnew.sedname = np.array(sednames)
         for r,d,x,y in zip(pr,pd,peakx,peaky):
             fluxes = dict([(band, detmap[y, x])
                            for band,detmap in zip(bands,detmaps)])
@@ -264,6 +351,8 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
                           saturated_pix=None,
                           veto_map=None,
                           cutonaper=True,
+                          sedmaps=None,
+                          saddle_grid=True,
                           ps=None, rgbimg=None):
     '''
     Runs a single SED-matched detection filter.
@@ -299,6 +388,14 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
         Apply a cut that the source's detection strength must be greater
         than `nsigma` above the 16th percentile of the detection strength in
         an annulus (from 10 to 20 pixels) around the source.
+    sedmaps : None or (sedsn, sediv, satur) tuple, optional
+        This SED's S/N map, inverse-variance map and saturated-pixel map
+        (None if `saturated_pix` is None), if already computed (see
+        sed_matched_maps); `sed` is then not used.
+    saddle_grid : bool, optional
+        Decide most saddle tests by lookups in a grid of saddle levels;
+        if False, run the full saddle test for every peak.  The results
+        are the same.
     ps : PlotSequence object, optional
         Create plots?
 
@@ -320,43 +417,22 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
     run_sed_matched_filters : calls this method
     '''
     from scipy.ndimage.measurements import label, find_objects
-    from scipy.ndimage.morphology import binary_dilation, binary_fill_holes
+    from scipy.ndimage.morphology import (binary_dilation, binary_fill_holes,
+                                          grey_dilation, generate_binary_structure)
 
     H,W = detmaps[0].shape
-    allzero = True
-    for iband in range(len(bands)):
-        if sed[iband] == 0:
-            continue
-        if np.all(detivs[iband] == 0):
-            continue
-        allzero = False
-        break
-    if allzero:
+    if sedmaps is None:
+        sedsn,sediv,satur = sed_matched_maps([(sedname, sed)], detmaps, detivs,
+                                             saturated_pix=saturated_pix)
+        sedsn,sediv = sedsn[0],sediv[0]
+        if satur is not None:
+            satur = satur[0]
+    else:
+        sedsn,sediv,satur = sedmaps
+    if not np.any(sediv > 0):
         info('SED', sedname, 'has all zero weight')
         return None,None,None,None,None
 
-    sedmap = np.zeros((H,W), np.float32)
-    sediv  = np.zeros((H,W), np.float32)
-    if saturated_pix is not None:
-        satur  = np.zeros((H,W), bool)
-
-    for iband in range(len(bands)):
-        if sed[iband] == 0:
-            continue
-        # We convert the detmap to canonical band via
-        #   detmap * w
-        # And the corresponding change to sig1 is
-        #   sig1 * w
-        # So the invvar-weighted sum is
-        #    (detmap * w) / (sig1**2 * w**2)
-        #  = detmap / (sig1**2 * w)
-        sedmap += detmaps[iband] * detivs[iband] / sed[iband]
-        sediv  += detivs [iband] / sed[iband]**2
-        if saturated_pix is not None:
-            satur |= saturated_pix[iband]
-    sedmap /= np.maximum(1e-16, sediv)
-    sedsn   = sedmap * np.sqrt(sediv)
-    del sedmap
     peaks = (sedsn > nsigma)
 
     def saddle_level(Y):
@@ -428,18 +504,20 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
     # We dilate the blobs a bit too, to
     # catch slight differences in centroid positions.
     dilate = 1
+    # The saddle map at level L, binary_dilation(sedsn > L) | satur, is
+    # (dilsn > L), where dilsn is the S/N map grey-dilated by the same
+    # structuring element, with saturated pixels always above.
+    dilsn = grey_dilation(sedsn, footprint=generate_binary_structure(2, 1),
+                          mode='constant', cval=-np.inf)
+    if satur is not None:
+        dilsn[satur] = np.inf
 
     # For efficiency, segment at the minimum saddle level to compute
     # slices; the operations described above need only happen within
     # the slice.
-    saddlemap = (sedsn > lowest_saddle)
-    saddlemap = binary_dilation(saddlemap, iterations=dilate)
-    if saturated_pix is not None:
-        saddlemap |= satur
+    saddlemap = (dilsn > lowest_saddle)
     allblobs,_ = label(saddlemap)
     allslices = find_objects(allblobs)
-    ally0 = [sy.start for sy,sx in allslices]
-    allx0 = [sx.start for sy,sx in allslices]
 
     # brightest peaks first
     py,px = np.nonzero(peaks)
@@ -454,14 +532,7 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
     apin = 10
     apout = 20
 
-    # Map of pixels that are vetoed by sources found so far.  The veto
-    # area is based on saddle height.  We go from brightest to
-    # faintest pixels.  Thus the saddle level decreases, and the
-    # saddlemap areas become larger; the saddlemap when a source is
-    # found is a lower bound on the pixels that it will veto based on
-    # the saddle heights of fainter sources.  Thus the vetomap isn't
-    # the final word, it is just a quick veto of pixels we know for
-    # sure will be vetoed.
+    # Map of pixels that are vetoed by existing sources.
     if veto_map is None:
         this_veto_map = np.zeros(sedsn.shape, bool)
     else:
@@ -499,56 +570,48 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
     # For each peak, determine whether it is isolated enough --
     # separated by a low enough saddle from other sources.  Need only
     # search within its "allblob", which is defined by the lowest
-    # saddle.
+    # saddle.  Most peaks are decided by array lookups in labellings of
+    # the saddle map at a grid of levels (see _SaddleLevels); the rest
+    # get the full test at their own saddle level.
     info('Found', len(px), 'potential peaks')
+    levels = np.array([saddle_level(v) for v in sedsn[py,px]])
+    saddles = _SaddleLevels(dilsn, allblobs, allslices, px, py, levels,
+                            lowest_saddle)
+    xo = np.array(xomit).astype(int)
+    yo = np.array(yomit).astype(int)
+    ok = (xo >= 0) * (xo < W) * (yo >= 0) * (yo < H)
+    saddles.add_sources(xo[ok], yo[ok])
+    def veto_blob(x, y, level):
+        slc,blobs,thisblob = _saddle_blob(dilsn, allblobs, allslices, x, y, level)
+        this_veto_map[slc] |= (blobs == thisblob)
     nveto = 0
     nsaddle = 0
     naper = 0
+    nfull = 0
     for i,(x,y) in enumerate(zip(px, py)):
         if this_veto_map[y,x]:
             nveto += 1
             continue
-        level = saddle_level(sedsn[y,x])
-        ablob = allblobs[y,x]
-        index = int(ablob - 1)
-        slc = allslices[index]
-        saddlemap = (sedsn[slc] > level)
-        saddlemap = binary_dilation(saddlemap, iterations=dilate)
-        if saturated_pix is not None:
-            saddlemap |= satur[slc]
-        saddlemap *= (allblobs[slc] == ablob)
-        saddlemap = binary_fill_holes(saddlemap)
-        blobs,_ = label(saddlemap)
-        x0,y0 = allx0[index], ally0[index]
-        thisblob = blobs[y-y0, x-x0]
-        saddlemap *= (blobs == thisblob)
-
-        # previously found sources:
-        ox = np.append(xomit, px[:i][keep[:i]]) - x0
-        oy = np.append(yomit, py[:i][keep[:i]]) - y0
-        h,w = blobs.shape
-        cut = False
-        if len(ox):
-            ox = ox.astype(int)
-            oy = oy.astype(int)
-            cut = any((ox >= 0) * (ox < w) * (oy >= 0) * (oy < h) *
-                      (blobs[np.clip(oy,0,h-1), np.clip(ox,0,w-1)] == thisblob))
+        cut = None
+        if saddle_grid:
+            cut = saddles.is_cut(i)
+        if cut is None:
+            # previously found sources:
+            ox = np.append(xomit, px[:i][keep[:i]])
+            oy = np.append(yomit, py[:i][keep[:i]])
+            cut = _saddle_cut(dilsn, allblobs, allslices, x, y, levels[i], ox, oy)
+            nfull += 1
 
         # one plot per peak is a little excessive!
         if ps is not None and i<10:
             _peak_plot_1(this_veto_map, x, y, px, py, keep, i, xomit, yomit, sedsn, allblobs,
-                         level, dilate, saturated_pix, satur, ps, rgbimg, cut)
-        if False and cut and ps is not None:
-            _peak_plot_2(ox, oy, w, h, blobs, thisblob, sedsn, x0, y0,
-                         x, y, level, ps)
-        if False and (not cut) and ps is not None:
-            _peak_plot_3(sedsn, nsigma, x, y, x0, y0, slc, saddlemap,
-                         xomit, yomit, px, py, keep, i, cut, ps)
+                         levels[i], dilate, saturated_pix, satur, ps, rgbimg, cut)
 
         if cut:
             # in same blob as previously found source.
             # update vetomap
-            this_veto_map[slc] |= saddlemap
+            if saddles.veto_group[i] or not saddle_grid:
+                veto_blob(x, y, levels[i])
             nsaddle += 1
             continue
 
@@ -576,7 +639,9 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
         aper.append(m)
         peakval.append(sedsn[y,x])
         keep[i] = True
-        this_veto_map[slc] |= saddlemap
+        saddles.add_sources([x], [y])
+        if saddles.veto_group[i] or not saddle_grid:
+            veto_blob(x, y, levels[i])
 
         if False and ps is not None:
             plt.clf()
@@ -592,6 +657,7 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
 
     info('Of', len(px), 'potential peaks:', nveto, 'in veto map,', nsaddle, 'cut by saddle test,',
           naper, 'cut by aper test,', np.sum(keep), 'kept')
+    debug('Saddle test:', nfull, 'of', len(px), 'peaks needed the full test')
 
     if ps is not None:
         pxdrop = px[np.logical_not(keep)]
@@ -629,6 +695,185 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
 
     return hotblobs, px, py, aper, peakval
 
+def _fill_holes(mask):
+    '''
+    Same as binary_fill_holes(mask), via one labelling of the background.
+    '''
+    from scipy.ndimage.measurements import label
+    bg,nbg = label(np.logical_not(mask))
+    hole = np.ones(nbg+1, bool)
+    hole[0] = False
+    hole[bg[0,:]] = False
+    hole[bg[-1,:]] = False
+    hole[bg[:,0]] = False
+    hole[bg[:,-1]] = False
+    return mask | hole[bg]
+
+def _saddle_blob(dilsn, allblobs, allslices, x, y, level):
+    '''
+    Segments the saddle map at *level*, within the "allblob" of the
+    peak at *x*,*y*, and fills holes.  Returns (slc, blobs, thisblob):
+    the allblob slice, the labelled blobs, and the peak's blob label.
+    '''
+    from scipy.ndimage.measurements import label
+    ablob = allblobs[y,x]
+    slc = allslices[ablob - 1]
+    saddlemap = (dilsn[slc] > level) * (allblobs[slc] == ablob)
+    saddlemap = _fill_holes(saddlemap)
+    blobs,_ = label(saddlemap)
+    y0,x0 = slc[0].start, slc[1].start
+    return slc, blobs, blobs[y-y0, x-x0]
+
+def _saddle_cut(dilsn, allblobs, allslices, x, y, level, ox, oy):
+    '''
+    The full saddle test: is any of the sources *ox*,*oy* in the same
+    blob as the peak at *x*,*y*, at *level*?
+    '''
+    slc,blobs,thisblob = _saddle_blob(dilsn, allblobs, allslices, x, y, level)
+    if len(ox) == 0:
+        return False
+    ox = np.array(ox).astype(int) - slc[1].start
+    oy = np.array(oy).astype(int) - slc[0].start
+    h,w = blobs.shape
+    return any((ox >= 0) * (ox < w) * (oy >= 0) * (oy < h) *
+               (blobs[np.clip(oy,0,h-1), np.clip(ox,0,w-1)] == thisblob))
+
+class _SaddleLevels(object):
+    '''
+    Saddle tests for detection peaks, answered by array lookups in
+    labellings of the saddle map at a geometric grid of levels (a
+    coarse "component tree"), rather than by labelling the saddle map
+    at each peak's own level.
+
+    *dilsn* is the dilated S/N map, so that the saddle map at level L
+    is (dilsn > L).  Blobs only merge as the level drops, so for a peak
+    whose saddle level L lies between grid levels lo <= L <= hi:
+
+    - if a source is in the peak's blob at level hi, it is also in
+      its blob at level L: the peak is cut;
+    - if no source is in the peak's blob (with holes filled) at level
+      lo, none is at level L: the peak survives;
+    - otherwise, is_cut() returns None and the full test is needed.
+
+    Peaks must be queried in order of decreasing saddle level; sources
+    (existing and newly kept) are registered with add_sources().
+
+    Within an allblob, the veto map of earlier peaks' blobs adds
+    nothing to the saddle test: a peak in an earlier peak's blob is
+    also cut.  But an allblob lying in a hole of another can be vetoed
+    by the hole-filled blob of a peak in the enclosing one.  Peaks in
+    such groups of allblobs (a connected component of the allblobs,
+    with holes filled) are flagged in *veto_group*; for them, the veto
+    map must be kept up to date peak by peak, as in the full test, so
+    that the same peaks are vetoed.
+    '''
+    def __init__(self, dilsn, allblobs, allslices, px, py, levels, lowest,
+                 step=0.05):
+        from scipy.ndimage.measurements import label
+        from scipy.ndimage.morphology import binary_dilation
+        self.dilsn = dilsn
+        self.lowest = lowest
+        self.logstep = np.log1p(step)
+        # Grid levels: lowest + ((1+step)**k - 1)
+        self.ibin = np.floor(np.log1p(np.maximum(0., levels - lowest)) /
+                             self.logstep).astype(int)
+        self.px = px
+        self.py = py
+        # Each grid level is labelled only within the bounding box of
+        # the "allblobs" of the peaks that use it.
+        ab = allblobs[py,px] - 1
+        sy0 = np.array([s[0].start for s in allslices])[ab]
+        sy1 = np.array([s[0].stop  for s in allslices])[ab]
+        sx0 = np.array([s[1].start for s in allslices])[ab]
+        sx1 = np.array([s[1].stop  for s in allslices])[ab]
+        self.regions = {}
+        for k in np.unique(self.ibin):
+            I = (self.ibin == k)
+            box = [sy0[I].min(), sy1[I].max(), sx0[I].min(), sx1[I].max()]
+            # this bin uses grid levels k and k+1
+            for kk in [k, k+1]:
+                r = self.regions.get(kk)
+                if r is not None:
+                    box = [min(box[0], r[0]), max(box[1], r[1]),
+                           min(box[2], r[2]), max(box[3], r[3])]
+                self.regions[kk] = box
+        self.labels = {}
+        self.sx = []
+        self.sy = []
+
+        # Peaks in allblobs that do not touch the background connected
+        # to the edge of the image (and so may lie in a hole of another
+        # allblob).
+        mask = (allblobs > 0)
+        bg,nbg = label(np.logical_not(mask))
+        outside = np.zeros(nbg+1, bool)
+        for edge in [bg[0,:], bg[-1,:], bg[:,0], bg[:,-1]]:
+            outside[edge] = True
+        outside[0] = False
+        enclosed = np.ones(len(allslices)+1, bool)
+        enclosed[allblobs[binary_dilation(outside[bg])]] = False
+        enclosed = enclosed[allblobs[py,px]]
+        self.veto_group = np.zeros(len(px), bool)
+        if np.any(enclosed):
+            outer,_ = label(_fill_holes(mask))
+            outer = outer[py,px]
+            self.veto_group = np.isin(outer, outer[enclosed])
+
+    def grid_level(self, k):
+        return self.lowest + np.expm1(k * self.logstep)
+
+    def _flag(self, lab, x, y, keys=('unfilled', 'filled')):
+        y0,y1,x0,x1 = lab['box']
+        x = np.atleast_1d(x)
+        y = np.atleast_1d(y)
+        I = (x >= x0) * (x < x1) * (y >= y0) * (y < y1)
+        for key in keys:
+            if key not in lab:
+                continue
+            blobs,flag = lab[key]
+            flag[blobs[y[I]-y0, x[I]-x0]] = True
+            flag[0] = False
+
+    def _get_labels(self, k, key):
+        # Labellings of grid level k -- 'unfilled' or (with holes
+        # filled) 'filled' -- computed on demand.
+        from scipy.ndimage.measurements import label
+        lab = self.labels.get(k)
+        if lab is None:
+            lab = self.labels[k] = dict(box=self.regions[k])
+        if key not in lab:
+            y0,y1,x0,x1 = lab['box']
+            mask = (self.dilsn[y0:y1, x0:x1] > self.grid_level(k))
+            if key == 'filled':
+                mask = _fill_holes(mask)
+            blobs,n = label(mask)
+            lab[key] = (blobs, np.zeros(n+1, bool))
+            self._flag(lab, np.array(self.sx, int), np.array(self.sy, int),
+                       keys=[key])
+        blobs,flag = lab[key]
+        return lab['box'], blobs, flag
+
+    def add_sources(self, x, y):
+        self.sx.extend(x)
+        self.sy.extend(y)
+        for lab in self.labels.values():
+            self._flag(lab, np.array(x, int), np.array(y, int))
+
+    def is_cut(self, i):
+        k = self.ibin[i]
+        # Drop the labellings no longer needed.
+        for kk in list(self.labels.keys()):
+            if kk > k+1:
+                del self.labels[kk]
+        x,y = self.px[i], self.py[i]
+        (y0,_,x0,_),unfilled,uflag = self._get_labels(k+1, 'unfilled')
+        if uflag[unfilled[y-y0, x-x0]]:
+            return True
+        (y0,_,x0,_),filled,fflag = self._get_labels(k, 'filled')
+        if not fflag[filled[y-y0, x-x0]]:
+            return False
+        return None
+
 def _peak_plot_1(vetomap, x, y, px, py, keep, i, xomit, yomit, sedsn, allblobs,
                  level, dilate, saturated_pix, satur, ps, rgbimg, cut):
     from scipy.ndimage.morphology import binary_dilation, binary_fill_holes
@@ -6,7 +6,10 @@ time-consuming phase, "blob-fitting", where we fit forward models of
 stars and galaxies to overlapping images.
 
 Farm.py uses QDO to read the list of "bricks" it is going to process
-and to keep track of their status (ready / running / finished).
+and to keep track of their status (ready / running / finished).  If
+the queue name is a filename (eg, "bricks.sqlite"), a local SQLite
+queue (legacypipe/taskqueue.py) is used instead, so no QDO server is
+required.
 
 For each brick, the input is a "pickle" file containing the results of
 the pipeline up to the blob-fitting stage.  The stage just before the
@@ -138,6 +141,7 @@ import queue
 import zmq
 
 from legacypipe.runbrick import _blob_iter, _write_checkpoint
+from legacypipe.taskqueue import connect_queue
 
 import logging
 logger = logging.getLogger('farm')
@@ -152,11 +156,13 @@ def main():
     import argparse
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('queue', help='QDO queue name to get brick names from')
+    parser.add_argument('queue', help='QDO queue name to get brick names from, or a local SQLite queue filename (*.sqlite)')
     parser.add_argument('--pickle', default='pickles/runbrick-%(brick)s-srcs.pickle',
-                        help='Pickle pattern for "srcs" (source detection) stage pickles, default %(default)s')
+                        help='Pickle pattern for "srcs" (source detection) stage pickles (or, with runbrick --stage-store, their ".store" directories), default %(default)s')
     parser.add_argument('--checkpoint', default='checkpoints/checkpoint-%(brick)s.pickle',
                         help='Checkpoint filename pattern')
+    parser.add_argument('--max-retries', type=int, default=0,
+                        help='For local SQLite queues: number of times to re-queue a failed brick')
     parser.add_argument('--checkpoint-period', type=int, default=300,
                         help='Time between writing checkpoints')
     parser.add_argument('--inthreads', type=int, default=1,
@@ -548,8 +554,7 @@ def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
     except:
         pass
 
-    import qdo
-    q = qdo.connect(queuename)
+    q,Task = connect_queue(queuename, max_retries=opt.max_retries)
 
     allresults = {}
 
@@ -584,7 +589,7 @@ def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
         print('Writing final checkpoint', checkpoint_fn)
         _write_checkpoint(R, checkpoint_fn)
         print('Setting QDO task to Succeeded:', brick)
-        q.set_task_state(taskid, qdo.Task.SUCCEEDED)
+        q.set_task_state(taskid, Task.SUCCEEDED)
         del allresults[brick]
         finished_bricks.put((brick, len(R)))
 
@@ -737,12 +742,16 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
     Called from the input thread to generate work packets for the given *brickname*.
     '''
     from astrometry.util.file import unpickle_from_file
+    from legacypipe.stagestore import read_stage, StageStore, stage_arg_names
 
     pickle_fn = opt.pickle % dict(brick=brickname, brickpre=brickname[:3])
     print('Looking for', pickle_fn)
-    if not os.path.exists(pickle_fn):
+    kwargs = read_stage(pickle_fn)
+    if kwargs is None:
         raise RuntimeError('Input pickle does not exist: ' + pickle_fn)
-    kwargs = unpickle_from_file(pickle_fn)
+    if isinstance(kwargs, StageStore):
+        # Only load the keys we need.
+        kwargs = kwargs.subset(stage_arg_names(get_blob_iter))
     debug('Unpickled:', kwargs.keys())
 
     # Total blobs includes checkpointed ones.
@@ -821,8 +830,7 @@ def input_thread(queuename, inqueue, bigqueue, checkpointqueue, blobsizes, opt,
         pass
 
     print('Input process', os.getpid(), 'starting')
-    import qdo
-    q = qdo.connect(queuename)
+    q,Task = connect_queue(queuename, max_retries=opt.max_retries)
 
     while True:
         task = q.get(timeout=10)
@@ -841,7 +849,7 @@ def input_thread(queuename, inqueue, bigqueue, checkpointqueue, blobsizes, opt,
             print('Oops')
             import traceback
             traceback.print_exc()
-            task.set_state(qdo.Task.FAILED, err=1)
+            task.set_state(Task.FAILED, err=1)
 
 if __name__ == '__main__':
     #mp.set_start_method('spawn')
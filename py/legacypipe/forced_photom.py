@@ -974,7 +974,7 @@ def run_forced_phot(cat, tim, ceres=True, derivs=False, agn=False,
             tlast = t
 
     if do_apphot:
-        import photutils
+        from legacypipe.apphot import aperture_photometry
 
         img = tim.getImage()
         ie = tim.getInvError()
@@ -998,10 +998,10 @@ def run_forced_phot(cat, tim, ceres=True, derivs=False, agn=False,
         print('Aperture photometry for', len(Iap), 'of', len(apxy[:,0]), 'sources within image bounds')
 
         for rad in apertures:
-            aper = photutils.CircularAperture(apxy[Iap,:], rad)
-            p = photutils.aperture_photometry(img, aper, error=imsigma)
-            apimg.append(p.field('aperture_sum'))
-            apimgerr.append(p.field('aperture_sum_err'))
+            [(apsum,aperr)] = aperture_photometry([img], apxy[Iap,:], rad,
+                                                  errors=[imsigma])
+            apimg.append(apsum)
+            apimgerr.append(aperr)
         ap = np.vstack(apimg).T
         ap[np.logical_not(np.isfinite(ap))] = 0.
         F.apflux = np.zeros((len(F), len(apertures)), np.float32)
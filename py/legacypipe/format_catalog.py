@@ -330,8 +330,7 @@ def format_catalog(T, hdr, primhdr, bands, allbands, outfn, release,
 def format_all_models(T, newcat, BB, bands, allbands, force_keep=None):
     import fitsio
     from astrometry.util.fits import fits_table
-    from tractor import Catalog
-    from legacypipe.catalog import prepare_fits_catalog, fits_typemap
+    from legacypipe.catalog import fits_typemap
     from legacypipe.oneblob import MODEL_NAMES
 
     TT = fits_table()
@@ -352,40 +351,45 @@ def format_all_models(T, newcat, BB, bands, allbands, force_keep=None):
 
     hdr = fitsio.FITSHDR()
 
-    for srctype in MODEL_NAMES:
-        # Create catalog with the fit results for each source type
-        xcat = Catalog(*[m.get(srctype,None) for m in BB.all_models])
+    # pad the all-model results to match length of T (for dups)
+    npad = len(T) - len(BB)
+    for imod,srctype in enumerate(MODEL_NAMES):
+        # The fit results for each source type are columns in BB.
         # NOTE that for REX, the shapes have been converted to EllipseE
         # and the e1,e2 params are frozen.
         prefix = srctype
-
-        allivs = np.hstack([m.get(srctype,[]) for m in BB.all_model_ivs])
-        assert(len(allivs) == xcat.numberOfParams())
-
-        # pad 'xcat' to match length of T (for dups)
-        npad = len(T) - len(xcat)
-        if npad:
-            xcat.extend([None] * npad)
-
-        TT = prepare_fits_catalog(xcat, allivs, TT, bands,
-                                  prefix=prefix+'_', force_keep=force_keep)
+        def get(key):
+            X = np.array(BB.get('all_model_' + key)[:,imod])
+            if npad:
+                X = np.append(X, np.zeros((npad,) + X.shape[1:], X.dtype), axis=0)
+            return X
+
+        # Zero out unconstrained values
+        flux = get('flux')
+        flux_ivar = get('flux_ivar')
+        if force_keep is not None:
+            flux[(flux_ivar == 0) * np.logical_not(force_keep[:,np.newaxis])] = 0.
+        else:
+            flux[flux_ivar == 0] = 0.
+        TT.set('%s_flux' % prefix, flux)
+        TT.set('%s_flux_ivar' % prefix, flux_ivar)
+        ra = get('ra')
+        ra += (ra <   0) * 360.
+        ra -= (ra > 360) * 360.
+        TT.set('%s_ra' % prefix, ra)
+        for k in ['dec', 'sersic', 'shape_r', 'shape_e1', 'shape_e2']:
+            TT.set('%s_%s' % (prefix, k), get(k))
+        for k in ['ra', 'dec', 'sersic', 'shape_r', 'shape_e1', 'shape_e2']:
+            TT.set('%s_%s_ivar' % (prefix, k), get(k + '_ivar').astype(np.float32))
 
         # # Expand out FLUX and related fields from grz arrays to 'allbands'
         keys = ['%s_flux' % prefix, '%s_flux_ivar' % prefix]
         _expand_flux_columns(TT, bands, allbands, keys)
 
-        TT.set('%s_cpu' % prefix,
-               np.array([m.get(srctype,0)
-                         for m in BB.all_model_cpu] + [0.]*npad).astype(np.float32))
-        TT.set('%s_hit_limit' % prefix,
-               np.array([m.get(srctype,0)
-                         for m in BB.all_model_hit_limit] + [False]*npad).astype(bool))
-        TT.set('%s_hit_r_limit' % prefix,
-               np.array([m.get(srctype,0)
-                         for m in BB.all_model_hit_r_limit] + [False]*npad).astype(bool))
-        TT.set('%s_opt_steps' % prefix,
-               np.array([m.get(srctype,-1)
-                         for m in BB.all_model_opt_steps] + [0]*npad).astype(np.int16))
+        TT.set('%s_cpu' % prefix, get('cpu'))
+        TT.set('%s_hit_limit' % prefix, get('hit_limit'))
+        TT.set('%s_hit_r_limit' % prefix, get('hit_r_limit'))
+        TT.set('%s_opt_steps' % prefix, get('opt_steps'))
 
     # remove silly columns
     for col in TT.columns():
@@ -23,16 +23,22 @@ def debug(*args):
     from legacypipe.utils import log_debug
     log_debug(logger, args)
 
+_galex_psf_cache = {}
+
 def galex_psf(band, galex_dir):
     band2file = {
         'f': os.path.join(galex_dir, 'PSFfuv.fits'),
         'n': os.path.join(galex_dir, 'PSFnuv_faint.fits')
         }
-    debug('Reading {}'.format(band2file[band]))
-    psfimg = fitsio.read(band2file[band])
-    psfimg = psfimg[:psfimg.shape[0] -1, :psfimg.shape[0] -1] # make odd
-    psfimg /= psfimg.sum()
-    return psfimg
+    fn = band2file[band]
+    psfimg = _galex_psf_cache.get(fn)
+    if psfimg is None:
+        debug('Reading {}'.format(fn))
+        psfimg = fitsio.read(fn)
+        psfimg = psfimg[:psfimg.shape[0] -1, :psfimg.shape[0] -1] # make odd
+        psfimg /= psfimg.sum()
+        _galex_psf_cache[fn] = psfimg
+    return psfimg.copy()
 
 def stage_galex_forced(
     survey=None,
@@ -480,46 +486,88 @@ def _galex_rgb_moustakas(imgs, **kwargs):
     rgb = np.clip(np.dstack((red, green, blue)), 0., 1.)
     return rgb
 
-def galex_tiles_touching_wcs(targetwcs, galex_dir):
-    """Find and read the overlapping GALEX FUV/NUV tiles."""
+# GALEX tiles are 3840 x 3840 pixels of 1.5 arcsec.
+galex_tile_size = 3840*1.5/3600.
 
-    H, W = targetwcs.shape
-    
-    ralo, declo = targetwcs.pixelxy2radec(W, 1)
-    rahi, dechi = targetwcs.pixelxy2radec(1, H)
-    #print('RA',  ralo,rahi)
-    #print('Dec', declo,dechi)
+_galex_tiles_cache = {}
 
+def read_galex_tiles(galex_dir):
+    '''
+    Returns (tiles, kd, maxrad): the table of GALEX tiles, with RA,Dec
+    boxes and visit names added; a kd-tree of the tile centers; and the
+    largest distance (in degrees) from a tile center to a corner of
+    its RA,Dec box.  These are read once and cached per process.
+    '''
+    from astrometry.libkd.spherematch import tree_build_radec
+    from astrometry.util.starutil_numpy import degrees_between
     fn = os.path.join(galex_dir, 'galex-images.fits')
-    #print('Reading', fn)
+    cached = _galex_tiles_cache.get(fn)
+    if cached is not None:
+        return cached
+    debug('Reading', fn)
     # galex "bricks" (actually just GALEX tiles)
     galex_tiles = fits_table(fn)
     galex_tiles.rename('ra_cent', 'ra')
     galex_tiles.rename('dec_cent', 'dec')
     galex_tiles.rename('have_n', 'has_n')
     galex_tiles.rename('have_f', 'has_f')
-    
+
     cosd = np.cos(np.deg2rad(galex_tiles.dec))
-    galex_tiles.ra1 = galex_tiles.ra - 3840*1.5/3600./2./cosd
-    galex_tiles.ra2 = galex_tiles.ra + 3840*1.5/3600./2./cosd
-    galex_tiles.dec1 = galex_tiles.dec - 3840*1.5/3600./2.
-    galex_tiles.dec2 = galex_tiles.dec + 3840*1.5/3600./2.
-    visnames = []
-    for tile, subvis in zip(galex_tiles.tilename, galex_tiles.subvis):
-        if subvis == -999:
-            visnames.append(tile.strip())
-        else:
-            visnames.append('%s_sg%02i' % (tile.strip(), subvis))
-    galex_tiles.visitname = np.array(visnames)
+    galex_tiles.ra1 = galex_tiles.ra - galex_tile_size/2./cosd
+    galex_tiles.ra2 = galex_tiles.ra + galex_tile_size/2./cosd
+    galex_tiles.dec1 = galex_tiles.dec - galex_tile_size/2.
+    galex_tiles.dec2 = galex_tiles.dec + galex_tile_size/2.
+    tilenames = np.char.strip(galex_tiles.tilename)
+    subvis = galex_tiles.subvis
+    galex_tiles.visitname = np.where(
+        subvis == -999, tilenames,
+        np.char.add(np.char.add(tilenames, '_sg'),
+                    np.char.zfill(subvis.astype(str), 2)))
+
+    kd = tree_build_radec(galex_tiles.ra, galex_tiles.dec)
+    maxrad = 0.
+    if len(galex_tiles):
+        maxrad = max([np.max(degrees_between(galex_tiles.ra, galex_tiles.dec,
+                                             galex_tiles.get(r), galex_tiles.get(d)))
+                      for r in ['ra1', 'ra2'] for d in ['dec1', 'dec2']])
+    cached = (galex_tiles, kd, maxrad)
+    _galex_tiles_cache[fn] = cached
+    return cached
 
-    # bricks_touching_radec_box(self, ralo, rahi, declo, dechi, scale=None):
-    I, = np.nonzero((galex_tiles.dec1 <= dechi) * (galex_tiles.dec2 >= declo))
+def galex_tiles_touching_wcs(targetwcs, galex_dir):
+    """Find and read the overlapping GALEX FUV/NUV tiles."""
+    from astrometry.libkd.spherematch import tree_search_radec
+
+    H, W = targetwcs.shape
+    
+    ralo, declo = targetwcs.pixelxy2radec(W, 1)
+    rahi, dechi = targetwcs.pixelxy2radec(1, H)
+    #print('RA',  ralo,rahi)
+    #print('Dec', declo,dechi)
+
+    galex_tiles, kd, maxrad = read_galex_tiles(galex_dir)
+
+    # Candidates from the kd-tree, then the exact RA,Dec box cut.
+    rc,dc = targetwcs.radec_center()
+    I = tree_search_radec(kd, rc, dc, targetwcs.radius() + maxrad)
+    I = I[(galex_tiles.dec1[I] <= dechi) * (galex_tiles.dec2[I] >= declo)]
     ok = _ra_ranges_overlap(ralo, rahi, galex_tiles.ra1[I], galex_tiles.ra2[I])
-    I = I[ok]
-    galex_tiles.cut(I)
-    # print('-> bricks', galex_tiles.brickname, flush=True, file=log)
+    I = np.sort(I[ok])
+    return galex_tiles[I]
 
-    return galex_tiles
+def galex_image_filename(galex_dir, tile, band, converted=True):
+    '''
+    Returns the filename of the GALEX *band* image for *tile*: the
+    version written by convert_galex_tiles(), if present (and
+    *converted*), else the original gzipped image.
+    '''
+    base = os.path.join(galex_dir, tile.tilename.strip(),
+                        '%s-%sd-intbgsub' % (tile.visitname.strip(), band))
+    if converted:
+        for ext in ['.fits.fz', '.fits']:
+            if os.path.exists(base + ext):
+                return base + ext
+    return base + '.fits.gz'
 
 def galex_tractor_image(tile, band, galex_dir, radecbox, bandname):
     from tractor import (NanoMaggies, Image, LinearPhotoCal,
@@ -531,8 +579,7 @@ def galex_tractor_image(tile, band, galex_dir, radecbox, bandname):
     #zps = dict(n=20.08, f=18.82)
     #zp = zps[band]
     
-    imfn = os.path.join(galex_dir, tile.tilename.strip(),
-                        '%s-%sd-intbgsub.fits.gz' % (tile.visitname.strip(), band))
+    imfn = galex_image_filename(galex_dir, tile, band)
     gwcs = Tan(*[float(f) for f in
                  [tile.crval1, tile.crval2, tile.crpix1, tile.crpix2,
                   tile.cdelt1, 0., 0., tile.cdelt2, 3840., 3840.]])
@@ -555,9 +602,13 @@ def galex_tractor_image(tile, band, galex_dir, radecbox, bandname):
     twcs = ConstantFitsWcs(gwcs)
     roislice = (slice(y0, y1), slice(x0, x1))
     
-    fitsimg = fitsio.FITS(imfn)[0]
-    hdr = fitsimg.read_header()
-    img = fitsimg[roislice]
+    # Tiles converted by convert_galex_tiles() are tile-compressed
+    # (in HDU 1) or uncompressed, so that only the ROI is read.
+    ext = 1 if imfn.endswith('.fz') else 0
+    with fitsio.FITS(imfn) as F:
+        fitsimg = F[ext]
+        hdr = fitsimg.read_header()
+        img = fitsimg[roislice]
 
     inverr = np.ones_like(img)
     inverr[img == 0.] = 0.
@@ -795,3 +846,83 @@ def galex_coadds(onegal, galaxy=None, radius_mosaic=30, radius_mask=None,
         imsave_jpeg(jpgfile, rgb, origin='lower')
 
     return 1
+
+def _convert_one(X):
+    (infn, outfn, compress) = X
+    if os.path.exists(outfn):
+        return 0
+    F = fitsio.FITS(infn)
+    hdr = F[0].read_header()
+    img = F[0].read()
+    F.close()
+    kwargs = {}
+    if compress:
+        # lossless
+        kwargs.update(compress='GZIP_2', qlevel=None)
+    tmpfn = outfn + '.tmp'
+    fitsio.write(tmpfn, img, header=hdr, clobber=True, **kwargs)
+    os.rename(tmpfn, outfn)
+    return 1
+
+def convert_galex_tiles(galex_dir, out_dir=None, compress=True, bands=['n','f'],
+                        mp=None):
+    '''
+    One-time conversion of the gzipped GALEX "intbgsub" images into
+    tile-compressed (".fits.fz") or uncompressed (".fits") FITS files,
+    which fitsio can read a sub-image from without decompressing the
+    whole 3840 x 3840 tile.  galex_tractor_image() uses the converted
+    files when they exist in the GALEX directory.
+
+    If *out_dir* is given, the converted images are written there (with
+    the same layout), along with links to the tile table and PSF files,
+    so that *out_dir* can be used as the GALEX directory.
+    '''
+    if out_dir is None:
+        out_dir = galex_dir
+    tiles,_,_ = read_galex_tiles(galex_dir)
+    ext = '.fits.fz' if compress else '.fits'
+    args = []
+    for band in bands:
+        for tile in tiles[tiles.get('has_%s' % band)]:
+            infn = galex_image_filename(galex_dir, tile, band, converted=False)
+            outfn = galex_image_filename(out_dir, tile, band, converted=False)
+            outfn = outfn.replace('.fits.gz', ext)
+            os.makedirs(os.path.dirname(outfn), exist_ok=True)
+            args.append((infn, outfn, compress))
+    if out_dir != galex_dir:
+        for fn in ['galex-images.fits', 'PSFfuv.fits', 'PSFnuv_faint.fits']:
+            dest = os.path.join(out_dir, fn)
+            if not os.path.exists(dest):
+                os.symlink(os.path.abspath(os.path.join(galex_dir, fn)), dest)
+    if mp is None:
+        n = sum(map(_convert_one, args))
+    else:
+        n = sum(mp.map(_convert_one, args))
+    info('Converted', n, 'of', len(args), 'GALEX images')
+    return n
+
+def main():
+    import argparse
+    from astrometry.util.multiproc import multiproc
+    parser = argparse.ArgumentParser(description='Convert the gzipped GALEX images into tile-compressed or uncompressed FITS files, for fast sub-image reads.')
+    parser.add_argument('--galex-dir', default=os.environ.get('GALEX_DIR'),
+                        help='GALEX directory, default $GALEX_DIR')
+    parser.add_argument('--out-dir', default=None,
+                        help='Write converted images to this directory, default --galex-dir')
+    parser.add_argument('--uncompressed', action='store_true',
+                        help='Write uncompressed FITS files rather than (lossless) tile-compressed')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of parallel processes')
+    opt = parser.parse_args()
+    if opt.galex_dir is None:
+        parser.print_help()
+        return -1
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    mp = multiproc(opt.threads)
+    convert_galex_tiles(opt.galex_dir, out_dir=opt.out_dir,
+                        compress=not opt.uncompressed, mp=mp)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
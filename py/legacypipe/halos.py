@@ -10,10 +10,32 @@ def debug(*args):
     log_debug(logger, args)
 
 def subtract_halos(tims, refs, bands, mp, plots, ps, moffat=True):
-    args = [(tim, refs, moffat) for tim in tims]
-    haloimgs = mp.map(subtract_one, args)
+    # Send the workers only what they need to evaluate the halo model
+    # (not the tim pixels), and get back only the region touched by halos.
+    args = []
+    for tim in tims:
+        if tim.imobj.camera != 'decam':
+            print('Warning: Stellar halo subtraction is only implemented for DECam')
+            args.append(None)
+            continue
+        inner = None
+        if moffat:
+            # The tim's PSF model was read from the same PsfEx row.
+            inner = get_inner_moffat(tim.imobj, psf=tim.psf)
+        args.append((refs, tim.time.toMjd(), tim.subwcs, tim.imobj.pixscale,
+                     tim.band, tim.imobj.ccdname, inner))
+    haloimgs = mp.map(_halo_cutout_one, args)
     for tim,h in zip(tims, haloimgs):
-        tim.data -= h
+        if h is None:
+            continue
+        y0,x0,img = h
+        hh,ww = img.shape
+        tim.data[y0:y0+hh, x0:x0+ww] -= img
+
+def _halo_cutout_one(X):
+    if X is None:
+        return None
+    return halo_model_cutout(*X)
 
 def subtract_one(X):
     tim, refs, moffat = X
@@ -26,96 +48,180 @@ def subtract_one(X):
 def moffat(rr, alpha, beta):
     return (beta-1.)/(np.pi * alpha**2)*(1. + (rr/alpha)**2)**(-beta)
 
+def get_inner_moffat(imobj, psf=None):
+    '''
+    Returns the inner Moffat parameters (alpha, beta) from the PsfEx
+    model, or None if the PsfEx file does not have them.  If *psf* (a
+    PsfEx model already read for this image) is given, the PsfEx file
+    is not re-read; other PSF models (eg, with --gpsf) do not carry the
+    Moffat parameters, so the PsfEx file is read for them.
+    '''
+    if psf is None or not (hasattr(psf, 'moffat') or hasattr(psf, 'psfex')):
+        psf = imobj.read_psf_model(0,0, pixPsf=True)
+    if not hasattr(psf, 'moffat'):
+        return None
+    inner_alpha, inner_beta = psf.moffat
+    debug('Read inner Moffat parameters', (inner_alpha, inner_beta),
+          'from PsfEx file')
+    return (float(inner_alpha), float(inner_beta))
+
 def decam_halo_model(refs, mjd, wcs, pixscale, band, imobj, include_moffat):
+    inner = None
+    if include_moffat:
+        inner = get_inner_moffat(imobj)
+    H,W = wcs.shape
+    halo = np.zeros((int(H),int(W)), np.float32)
+    h = halo_model_cutout(refs, mjd, wcs, pixscale, band, imobj.ccdname, inner)
+    if h is not None:
+        y0,x0,img = h
+        hh,ww = img.shape
+        halo[y0:y0+hh, x0:x0+ww] = img
+    return halo
+
+# Approximate spacing, in pixels**2, of the squared-radius grid on
+# which the halo profiles are tabulated.
+halo_lut_step = 4.
+# Halos are only applied within this radius (arcsec).
+halo_max_radius = 400.
+
+_halo_luts = {}
+
+def halo_profile_lut(band, pixscale, ccdname, inner_moffat):
+    '''
+    Returns (u0, step, onchip, offchip): the radial halo profile (per
+    unit flux, in flux per pixel), including the inner apodization,
+    tabulated at squared radii (in pixels**2) u0, u0 + step, u0 +
+    2*step, ..., out to the maximum halo radius.  The profile is zero
+    inside u0.  *onchip* and *offchip* are for stars whose centers are
+    on and off the chip (the z-band outer halo gets half the weight for
+    stars off the chip).  Tables are cached per (band, pixel scale, CCD
+    type, inner Moffat parameters).
+    '''
+    compact = (band == 'z' and
+               ccdname.strip() in ['N20', 'S8', 'S10', 'S18', 'S21', 'S27'])
+    key = (band, pixscale, compact, inner_moffat)
+    lut = _halo_luts.get(key)
+    if lut is not None:
+        return lut
+
+    # Inner apodization: ramp from 0 up to 1 between Rongpu's "R3"
+    # and "R4" radii
+    apr_i0 = 7. / pixscale
+    apr_i1 = 8. / pixscale
+    # Place both ends of the inner apodization ramp on grid points, so
+    # that linear interpolation does not smear out its corners.
+    u0 = apr_i0**2
+    step = (apr_i1**2 - u0) / np.ceil((apr_i1**2 - u0) / halo_lut_step)
+    maxr = np.ceil(halo_max_radius / pixscale)
+    n = int(np.ceil(((maxr + 1.)**2 - u0) / step)) + 2
+    rr = u0 + np.arange(n) * step
+    r = np.sqrt(rr)
+    rarcsec = r * pixscale
+    if band == 'z':
+        '''
+        For z band, the outer PSF is a weighted Moffat profile. For most
+        CCDs, the Moffat parameters (with radius in arcsec and SB in nmgy per
+        sq arcsec) and the weight are (for a 22.5 magnitude star):
+            alpha, beta, weight = 17.650, 1.7, 0.0145
+
+        However, a small subset of DECam CCDs (which are N20, S8,
+        S10, S18, S21 and S27) have a more compact outer PSF in z
+        band, which can still be characterized by a weigthed
+        Moffat with the following parameters:
+            alpha, beta, weight = 16, 2.3, 0.0095
+        '''
+        if compact:
+            alpha, beta, weight = 16, 2.3, 0.0095
+        else:
+            alpha, beta, weight = 17.650, 1.7, 0.0145
+        outer = weight * moffat(rarcsec, alpha, beta)
+        # Reduce the weight by half for z-band halos that are off the chip.
+        offweight = 0.5
+    else:
+        fd = dict(g=0.00045,
+                  r=0.00033)
+        outer = fd[band] * rarcsec**-2
+        offweight = 1.
+    if inner_moffat is not None:
+        inner_alpha, inner_beta = inner_moffat
+        inner = moffat(rarcsec, inner_alpha, inner_beta)
+    else:
+        inner = 0.
+    apodize = np.clip((r - apr_i0) / (apr_i1 - apr_i0), 0., 1.)
+    # The 'pixscale**2' is because Rongpu's formulae are in nanomaggies/arcsec^2
+    onchip  = apodize * (outer + inner) * pixscale**2
+    offchip = apodize * (offweight * outer + inner) * pixscale**2
+    lut = (u0, step, onchip, offchip)
+    _halo_luts[key] = lut
+    return lut
+
+def halo_model_cutout(refs, mjd, wcs, pixscale, band, ccdname, inner_moffat):
+    '''
+    Evaluates the DECam stellar halo model for reference stars *refs*
+    on the image with WCS *wcs*.  *inner_moffat*: None or
+    (alpha, beta) of the inner Moffat component from the PsfEx model.
+
+    Returns None if no halo touches the image, or (y0, x0, img): the
+    halo image (in nanomaggies) of the bounding box of all halos,
+    whose first pixel is at (x0, y0).
+    '''
     from legacypipe.survey import radec_at_mjd
+    if len(refs) == 0:
+        return None
     assert(np.all(refs.ref_epoch > 0))
     rr,dd = radec_at_mjd(refs.ra, refs.dec, refs.ref_epoch.astype(float),
                          refs.pmra, refs.pmdec, refs.parallax, mjd)
     mag = refs.get('decam_mag_%s' % band)
     fluxes = 10.**((mag - 22.5) / -2.5)
 
-    have_inner_moffat = False
-    if include_moffat:
-        psf = imobj.read_psf_model(0,0, pixPsf=True)
-        if hasattr(psf, 'moffat'):
-            have_inner_moffat = True
-            inner_alpha, inner_beta = psf.moffat
-            debug('Read inner Moffat parameters', (inner_alpha, inner_beta),
-                  'from PsfEx file')
-
     H,W = wcs.shape
     H = int(H)
     W = int(W)
-    halo = np.zeros((H,W), np.float32)
-    for ref,flux,ra,dec in zip(refs, fluxes, rr, dd):
-        _,x,y = wcs.radec2pixelxy(ra, dec)
-        x -= 1.
-        y -= 1.
-
-        rad_arcsec = ref.radius * 3600.
-        # We subtract halos out to N x their masking radii.
-        rad_arcsec *= 4.0
-        # Rongpu says only apply within:
-        rad_arcsec = np.minimum(rad_arcsec, 400.)
-        pixrad = int(np.ceil(rad_arcsec / pixscale))
-
-        xlo = int(np.clip(np.floor(x - pixrad), 0, W-1))
-        xhi = int(np.clip(np.ceil (x + pixrad), 0, W-1))
-        ylo = int(np.clip(np.floor(y - pixrad), 0, H-1))
-        yhi = int(np.clip(np.ceil (y + pixrad), 0, H-1))
-        if xlo == xhi or ylo == yhi:
+    _,xx,yy = wcs.radec2pixelxy(rr, dd)
+    xx = np.atleast_1d(xx) - 1.
+    yy = np.atleast_1d(yy) - 1.
+
+    # We subtract halos out to N x their masking radii.
+    rad_arcsec = refs.radius * 3600. * 4.0
+    # Rongpu says only apply within:
+    rad_arcsec = np.minimum(rad_arcsec, halo_max_radius)
+    pixrad = np.ceil(rad_arcsec / pixscale).astype(int)
+
+    xlo = np.clip(np.floor(xx - pixrad), 0, W-1).astype(int)
+    xhi = np.clip(np.ceil (xx + pixrad), 0, W-1).astype(int)
+    ylo = np.clip(np.floor(yy - pixrad), 0, H-1).astype(int)
+    yhi = np.clip(np.ceil (yy + pixrad), 0, H-1).astype(int)
+    # Keep only stars whose boxes overlap the chip
+    I, = np.nonzero((xlo != xhi) * (ylo != yhi) * np.isfinite(fluxes))
+    debug(len(I), 'of', len(refs), 'halo stars overlap the image')
+    if len(I) == 0:
+        return None
+
+    u0,step,onchip,offchip = halo_profile_lut(band, pixscale, ccdname, inner_moffat)
+    offchip_star = ((xx < 0) | (yy < 0) | (xx > W-1) | (yy > H-1))
+
+    x0 = xlo[I].min()
+    y0 = ylo[I].min()
+    halo = np.zeros((yhi[I].max()+1 - y0, xhi[I].max()+1 - x0), np.float32)
+    for i in I:
+        maxr = pixrad[i]
+        if maxr**2 <= u0:
+            # entirely within the inner apodization radius
             continue
-
-        rads = np.hypot(np.arange(ylo, yhi+1)[:,np.newaxis] - y,
-                        np.arange(xlo, xhi+1)[np.newaxis,:] - x)
-        maxr = pixrad
-        # Outer apodization
+        # Fold this star's outer apodization into (the part of) the
+        # profile table out to its maximum radius; the last entry is zero.
+        lut = offchip if offchip_star[i] else onchip
+        n = min(len(lut), int(np.ceil((maxr**2 - u0) / step)) + 2)
         apr = maxr*0.5
-        apodize = np.clip((rads - maxr) / (apr - maxr), 0., 1.)
-
-        # Inner apodization: ramp from 0 up to 1 between Rongpu's "R3"
-        # and "R4" radii
-        apr_i0 = 7. / pixscale
-        apr_i1 = 8. / pixscale
-        apodize *= np.clip((rads - apr_i0) / (apr_i1 - apr_i0), 0., 1.)
-
-        if band == 'z':
-            '''
-            For z band, the outer PSF is a weighted Moffat profile. For most
-            CCDs, the Moffat parameters (with radius in arcsec and SB in nmgy per
-            sq arcsec) and the weight are (for a 22.5 magnitude star):
-                alpha, beta, weight = 17.650, 1.7, 0.0145
-
-            However, a small subset of DECam CCDs (which are N20, S8,
-            S10, S18, S21 and S27) have a more compact outer PSF in z
-            band, which can still be characterized by a weigthed
-            Moffat with the following parameters:
-                alpha, beta, weight = 16, 2.3, 0.0095
-            '''
-            if imobj.ccdname.strip() in ['N20', 'S8', 'S10', 'S18', 'S21', 'S27']:
-                alpha, beta, weight = 16, 2.3, 0.0095
-            else:
-                alpha, beta, weight = 17.650, 1.7, 0.0145
-
-            if x < 0 or y < 0 or x > W-1 or y > H-1:
-                # Reduce the weight by half for z-band halos that are off the chip.
-                weight *= 0.5
-
-            # The 'pixscale**2' is because Rongpu's formula is in nanomaggies/arcsec^2
-            halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * weight *
-                                           moffat(rads*pixscale, alpha, beta) * pixscale**2)
-
-        else:
-             fd = dict(g=0.00045,
-                       r=0.00033)
-             f = fd[band]
-
-             halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * f * (rads*pixscale)**-2
-                                            * pixscale**2)
-
-        if have_inner_moffat:
-            weight = 1.
-            halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * weight *
-                                           moffat(rads*pixscale, inner_alpha, inner_beta) * pixscale**2)
-
-    return halo
+        apodize = np.clip((np.sqrt(u0 + np.arange(n) * step) - maxr) / (apr - maxr),
+                          0., 1.)
+        prof = (fluxes[i] * apodize * lut[:n]).astype(np.float32)
+        slope = np.append(np.diff(prof), np.float32(0.))
+        # Linear interpolation in the table on the squared-radius grid
+        r2 = ((np.arange(ylo[i], yhi[i]+1)[:,np.newaxis] - yy[i])**2 +
+              (np.arange(xlo[i], xhi[i]+1)[np.newaxis,:] - xx[i])**2)
+        u = np.clip((r2 - u0) / step, 0., n-1.)
+        iu = u.astype(np.int32)
+        halo[ylo[i]-y0:yhi[i]+1-y0, xlo[i]-x0:xhi[i]+1-x0] += (
+            prof[iu] + (u - iu) * slope[iu])
+    return y0, x0, halo
@@ -204,6 +204,9 @@ class LegacySurveyImage(object):
             raise
         self.procdate = getattr(ccd, 'procdate', 'xxxxxxx').strip()
         self.plprocid = getattr(ccd, 'plprocid', 'xxxxxxx').strip()
+        # Primary header, if it has already been read for this exposure
+        # (see run_exposure_calibs)
+        self.primhdr = None
 
         # Which Data Quality bits mark saturation?
         self.dq_saturation_bits = DQ_BITS['satur'] # | DQ_BITS['bleed']
@@ -236,6 +239,8 @@ class LegacySurveyImage(object):
         # not used by this code -- here for the sake of legacyzpts/merge_calibs.py
         self.old_single_psffn = os.path.join(calibdir, imgdir, basename, calname + '-psfex.fits')
         self.old_single_skyfn = os.path.join(calibdir, imgdir, basename, calname + '-splinesky.fits')
+        # Pre-read calibration tables, filename -> table; see read_calib_table.
+        self.calib_tables = None
         # for debugging purposes
         self.print_imgpath = '/'.join(self.imgfn.split('/')[-5:])
 
@@ -734,6 +739,10 @@ class LegacySurveyImage(object):
         return galnorm
 
     def _read_fits(self, fn, hdu, slice=None, header=None, **kwargs):
+        # Node-local cache of decompressed pixels, if enabled.
+        pixcache = getattr(self.survey, 'pixel_cache', None)
+        if pixcache is not None and len(kwargs) == 0:
+            return pixcache.read(fn, hdu, slice=slice, header=header)
         if slice is not None:
             f = fitsio.FITS(fn)[hdu]
             img = f[slice]
@@ -788,6 +797,9 @@ class LegacySurveyImage(object):
         primary_header : fitsio header
             The FITS header
         '''
+        if self.primhdr is not None:
+            # (callers may add cards)
+            return fitsio.FITSHDR(self.primhdr)
         return read_primary_header(self.imgfn)
 
     def read_image_header(self, **kwargs):
@@ -896,6 +908,16 @@ class LegacySurveyImage(object):
         wcs.plver = phdr.get('PLVER', '').strip()
         return wcs
 
+    def read_calib_table(self, fn):
+        '''
+        Reads the (merged or single-CCD) calibration table *fn*, unless
+        the caller has already read it into self.calib_tables (as is
+        done when processing all the CCDs of an exposure together).
+        '''
+        if self.calib_tables is not None and fn in self.calib_tables:
+            return self.calib_tables[fn]
+        return fits_table(fn)
+
     def read_sky_model(self, slc=None, old_calibs_ok=False,
                        template_meta=None, **kwargs):
         '''
@@ -909,7 +931,7 @@ class LegacySurveyImage(object):
         for fn in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
+            T = self.read_calib_table(fn)
             I, = np.nonzero((T.expnum == self.expnum) *
                             np.array([c.strip() == self.ccdname
                                       for c in T.ccdname]))
@@ -990,7 +1012,7 @@ class LegacySurveyImage(object):
         for fn in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
+            T = self.read_calib_table(fn)
             I, = np.nonzero((T.expnum == self.expnum) *
                             np.array([c.strip() == self.ccdname
                                       for c in T.ccdname]))
@@ -1112,7 +1134,12 @@ class LegacySurveyImage(object):
             raise RuntimeError('Command failed: ' + cmd)
         os.rename(tmpfn, self.sefn)
 
-    def run_psfex(self, git_version=None, ps=None):
+    def run_psfex(self, git_version=None, ps=None, write=True):
+        '''
+        Runs PsfEx on the SourceExtractor catalog, writing the
+        single-CCD "merged psfex" format table to self.psffn (if
+        *write*).  Returns the table.
+        '''
         from astrometry.util.file import trymakedirs
         from legacypipe.survey import get_git_version
         sedir = self.survey.get_se_dir()
@@ -1152,14 +1179,27 @@ class LegacySurveyImage(object):
                 ]:
             T.set(k, np.array([v]))
 
+        if not write:
+            os.remove(psftmpfn)
+            return T
         psftmpfn2 = os.path.join(psfdir, os.path.basename(self.sefn).replace('.fits','') + '.psf.tmp2')
         T.writeto(psftmpfn2)
         os.remove(psftmpfn)
         os.rename(psftmpfn2, self.psffn)
+        return T
 
     def run_sky(self, splinesky=True, git_version=None, ps=None, survey=None,
                 gaia=True, release=0, survey_blob_mask=None,
-                halos=True, subtract_largegalaxies=True):
+                halos=True, subtract_largegalaxies=True,
+                refcat=None, write=True):
+        '''
+        Fits the sky model, writing it to self.skyfn (if *write*).
+        For splinesky, returns the one-row table.
+
+        *refcat*: reference-catalog table from
+         legacypipe.reference.read_reference_catalogs covering this
+         CCD (eg, for the whole exposure); read if None.
+        '''
         from scipy.ndimage.morphology import binary_dilation
         from astrometry.util.file import trymakedirs
         from astrometry.util.miscutils import estimate_mode
@@ -1305,11 +1345,15 @@ class LegacySurveyImage(object):
             x0,x1 = sx.start, sx.stop
             wcs = wcs.get_subimage(x0, y0, int(x1-x0), int(y1-y0))
         # Grab reference sources
-        refs,_ = get_reference_sources(survey, wcs, self.pixscale, None,
-                                       tycho_stars=True, gaia_stars=gaia,
-                                       large_galaxies=True,
-                                       star_clusters=True,
-                                       clean_columns=False)
+        if refcat is not None:
+            from legacypipe.reference import cut_reference_sources
+            refs,_ = cut_reference_sources(refcat, wcs, self.pixscale)
+        else:
+            refs,_ = get_reference_sources(survey, wcs, self.pixscale, None,
+                                           tycho_stars=True, gaia_stars=gaia,
+                                           large_galaxies=True,
+                                           star_clusters=True,
+                                           clean_columns=False)
         refgood = (get_reference_map(wcs, refs) == 0)
 
         sub_sga_version = '  '
@@ -1627,12 +1671,15 @@ class LegacySurveyImage(object):
                     ] + [('sky_p%i' % p, v) for p,v in zip(pcts, pctvals)]:
             T.set(k, np.array([v]))
 
+        if not write:
+            return T
         trymakedirs(self.skyfn, dir=True)
         tmpfn = os.path.join(os.path.dirname(self.skyfn),
                          'tmp-' + os.path.basename(self.skyfn))
         T.writeto(tmpfn)
         os.rename(tmpfn, self.skyfn)
         debug('Wrote sky model', self.skyfn)
+        return T
 
     def run_calibs(self, psfex=True, sky=True, se=False,
                    fcopy=False, use_mask=True,
@@ -1681,6 +1728,138 @@ class LegacySurveyImage(object):
         if sky:
             self.run_sky(splinesky=splinesky, git_version=git_version, ps=ps, survey=survey, gaia=gaia, survey_blob_mask=survey_blob_mask, halos=halos, subtract_largegalaxies=subtract_largegalaxies)
 
+def read_exposure_reference_catalog(survey, ccds, pixscale, gaia=True):
+    '''
+    Reads the reference catalogs (as used for masking in run_sky) once
+    for the whole footprint of the CCDs *ccds* of one exposure.
+    Returns the table from read_reference_catalogs, or None.
+    '''
+    from astrometry.util.util import Tan
+    from astrometry.util.starutil_numpy import (radectoxyz, xyztoradec,
+                                                degrees_between)
+    from legacypipe.reference import read_reference_catalogs
+    # Center of the focal plane
+    xyz = np.mean(radectoxyz(ccds.ra, ccds.dec), axis=0)
+    r,d = xyztoradec(xyz.reshape(1,3))
+    rc,dc = r[0],d[0]
+    # Radius of the focal plane, as in ccds_touching_wcs
+    ccdrad = max(np.sqrt(np.abs(ccds.cd1_1 * ccds.cd2_2 -
+                                ccds.cd1_2 * ccds.cd2_1)) *
+                 np.hypot(ccds.width, ccds.height) / 2.)
+    rad = max(degrees_between(rc, dc, ccds.ra, ccds.dec)) + ccdrad
+    W = H = int(np.ceil(2. * rad * 3600. / pixscale))
+    ps = pixscale / 3600.
+    wcs = Tan(rc, dc, W/2.+0.5, H/2.+0.5, -ps, 0., 0., ps,
+              float(W), float(H))
+    return read_reference_catalogs(survey, wcs, pixscale, None,
+                                   tycho_stars=True, gaia_stars=gaia,
+                                   large_galaxies=True,
+                                   star_clusters=True,
+                                   clean_columns=False)
+
+def run_exposure_calibs(survey, ccds, psfex=True, sky=True, se=False,
+                        force=False, git_version=None, ps=None,
+                        gaia=True, survey_blob_mask=None, halos=True,
+                        subtract_largegalaxies=True):
+    '''
+    Runs the PsfEx and splinesky calibrations for all the CCDs *ccds*
+    (rows of the CCDs table) of one exposure in this process, and
+    writes the merged (per-exposure) calibration files directly,
+    without the single-CCD files.
+
+    The primary header, the reference catalogs for the focal plane,
+    and the git version are read once for the exposure rather than
+    once per CCD.
+
+    If any CCD fails, the merged file is not written; instead, the
+    single-CCD files are written for the CCDs that succeeded (so that
+    only the failed CCDs need to be re-run before merging), and a
+    RuntimeError is raised.
+    '''
+    from legacyzpts.merge_calibs import (merge_psfex_tables,
+                                         merge_splinesky_tables,
+                                         write_merged_table)
+    assert(len(np.unique(ccds.expnum)) == 1)
+    ims = [survey.get_image_object(ccd) for ccd in ccds]
+    im0 = ims[0]
+    if psfex and not force and os.path.exists(im0.merged_psffn):
+        debug('Merged PsfEx file exists:', im0.merged_psffn)
+        psfex = False
+    if sky and not force and os.path.exists(im0.merged_skyfn):
+        debug('Merged sky file exists:', im0.merged_skyfn)
+        sky = False
+    if not (psfex or sky):
+        return
+
+    if git_version is None:
+        from legacypipe.survey import get_git_version
+        git_version = get_git_version()
+    primhdr = im0.read_image_primary_header()
+    for im in ims:
+        im.primhdr = primhdr
+    refcat = None
+    if sky:
+        refcat = read_exposure_reference_catalog(survey, ccds, im0.pixscale,
+                                                 gaia=gaia)
+
+    psfs = []
+    skies = []
+    failed = []
+    for im in ims:
+        if psfex:
+            try:
+                if force or se or not os.path.exists(im.sefn):
+                    todelete = []
+                    imgfn,maskfn = im.funpack_files(im.imgfn, im.dqfn,
+                                                    im.hdu, todelete)
+                    im.run_se(imgfn, maskfn)
+                    for fn in todelete:
+                        os.unlink(fn)
+                psfs.append((im, im.run_psfex(git_version=git_version, ps=ps,
+                                              write=False)))
+            except Exception:
+                print('PsfEx failed for', im, ':')
+                import traceback
+                traceback.print_exc()
+                failed.append(('PsfEx', im))
+        if sky:
+            try:
+                skies.append((im, im.run_sky(git_version=git_version, ps=ps,
+                                             survey=survey, gaia=gaia,
+                                             survey_blob_mask=survey_blob_mask,
+                                             halos=halos,
+                                             subtract_largegalaxies=subtract_largegalaxies,
+                                             refcat=refcat, write=False)))
+            except Exception:
+                print('Sky fit failed for', im, ':')
+                import traceback
+                traceback.print_exc()
+                failed.append(('Sky fit', im))
+
+    if len(failed) == 0:
+        if psfex:
+            write_merged_table(merge_psfex_tables([T for _,T in psfs]),
+                               im0.merged_psffn)
+        if sky:
+            write_merged_table(merge_splinesky_tables([T for _,T in skies]),
+                               im0.merged_skyfn)
+        return
+
+    from astrometry.util.file import trymakedirs
+    for im,T in psfs:
+        trymakedirs(im.psffn, dir=True)
+        T.writeto(im.psffn + '.tmp')
+        os.rename(im.psffn + '.tmp', im.psffn)
+    for im,T in skies:
+        trymakedirs(im.skyfn, dir=True)
+        tmpfn = os.path.join(os.path.dirname(im.skyfn),
+                             'tmp-' + os.path.basename(im.skyfn))
+        T.writeto(tmpfn)
+        os.rename(tmpfn, im.skyfn)
+    raise RuntimeError('Calibrations failed for expnum %i: %s' % (
+        im0.expnum, ', '.join(['%s for %s' % (what, im.ccdname)
+                               for what,im in failed])))
+
 def psfex_single_to_merged(infn, expnum, ccdname):
     # returns table T
     T = fits_table(infn)
@@ -30,28 +30,62 @@ def global_init(loglevel):
 
 # This is an adapter class that provides an iterator over
 # imap_unordered results with a next(timeout) function, required
-# for checkpointing.
-from concurrent.futures import wait as cfwait, FIRST_COMPLETED
+# for checkpointing.  It submits tasks to the executor lazily, keeping
+# at most *window* of them outstanding, so that a generator of
+# arguments (eg, runbrick's blob iterator) is not consumed -- and all
+# its arguments pickled and held in memory -- up front.  Completed
+# futures are put on a queue by a done-callback, so next() does not
+# have to scan the outstanding futures.
+#
+# *prepare* and *finish*, if given, are applied to each argument before
+# it is submitted and to each result before it is returned.
 class result_iter(object):
-    def __init__(self, futures):
-        self.futures = futures
-        self.n = len(futures)
+    def __init__(self, executor, func, args, window=None,
+                 prepare=None, finish=None):
+        import queue
+        self.executor = executor
+        self.func = func
+        self.prepare = prepare
+        self.finish = finish
+        try:
+            self.n = len(args)
+        except TypeError:
+            self.n = None
+        self.args = iter(args)
+        self.window = window
+        self.outstanding = 0
+        self.exhausted = False
+        self.done = queue.Queue()
+        self._submit()
+    def _submit(self):
+        while (not self.exhausted and
+               (self.window is None or self.outstanding < self.window)):
+            try:
+                a = next(self.args)
+            except StopIteration:
+                self.exhausted = True
+                break
+            if self.prepare is not None:
+                a = self.prepare(a)
+            f = self.executor.submit(self.func, a)
+            self.outstanding += 1
+            f.add_done_callback(self.done.put)
     def next(self, timeout=None):
-        if len(self.futures) == 0:
+        import queue
+        import multiprocessing
+        if self.outstanding == 0:
             raise StopIteration()
-        # Have any of the elements completed?
-        for f in self.futures:
-            if f.done():
-                self.futures.remove(f)
-                return f.result()
-        # Wait for the first one to complete, with timeout
-        done,_ = cfwait(self.futures, timeout=timeout,
-                        return_when=FIRST_COMPLETED)
-        if len(done):
-            f = done.pop()
-            self.futures.remove(f)
-            return f.result()
-        raise TimeoutError()
+        try:
+            f = self.done.get(timeout=timeout)
+        except queue.Empty:
+            raise multiprocessing.TimeoutError()
+        self.outstanding -= 1
+        # Keep the workers busy before handing back the result.
+        self._submit()
+        r = f.result()
+        if self.finish is not None:
+            r = self.finish(r)
+        return r
     # implement iterator interface
     def __iter__(self):
         return self
@@ -61,16 +95,85 @@ class result_iter(object):
     def __len__(self):
         return self.n
 
+def _timed_call(X):
+    '''
+    Runs on an MPI worker: unpickles a (function, argument) pair, calls
+    the function, and returns the pickled result along with the CPU and
+    wall time the worker spent on the task.
+    '''
+    import time
+    import pickle
+    t0 = time.time()
+    c0 = time.process_time()
+    func,arg = pickle.loads(X)
+    R = pickle.dumps(func(arg), protocol=pickle.HIGHEST_PROTOCOL)
+    return R, time.process_time() - c0, time.time() - t0
+
 # Wrapper over MPIPoolExecutor to make it look like a multiprocessing.Pool
 # (actually, an astrometry.util.timingpool!)
+#
+# Like TimingPool, it keeps track of the CPU and wall time spent in the
+# workers and the pickle traffic between the root and the workers:
+# arguments are pickled (and results unpickled) here, and tasks are run
+# via _timed_call.
 class MyMPIPool(object):
-    def __init__(self, **kwargs):
-        from mpi4py.futures import MPIPoolExecutor
-        self.real = MPIPoolExecutor(**kwargs)
+    # imap_unordered keeps at most this many tasks per worker outstanding.
+    window_per_worker = 4
+    # runbrick: report the pickle traffic in the stage timing
+    track_pickle_traffic = True
+
+    def __init__(self, executor=None, **kwargs):
+        if executor is None:
+            from mpi4py.futures import MPIPoolExecutor
+            executor = MPIPoolExecutor(**kwargs)
+        self.real = executor
+        # number of workers; set by the caller after bootup()
+        self._processes = None
+        self.worker_cpu = 0.
+        self.worker_wall = 0.
+        self.traffic = dict(pickle_objs=0, pickle_bytes=0, pickle_cputime=0.,
+                            unpickle_objs=0, unpickle_bytes=0, unpickle_cputime=0.)
+
+    def _pickle_arg(self, X):
+        import time
+        import pickle
+        func,arg = X
+        t0 = time.process_time()
+        P = pickle.dumps((func, arg), protocol=pickle.HIGHEST_PROTOCOL)
+        self.traffic['pickle_cputime'] += time.process_time() - t0
+        self.traffic['pickle_objs'] += 1
+        self.traffic['pickle_bytes'] += len(P)
+        return P
+
+    def _unpickle_result(self, X):
+        import time
+        import pickle
+        P,cpu,wall = X
+        self.worker_cpu += cpu
+        self.worker_wall += wall
+        t0 = time.process_time()
+        R = pickle.loads(P)
+        self.traffic['unpickle_cputime'] += time.process_time() - t0
+        self.traffic['unpickle_objs'] += 1
+        self.traffic['unpickle_bytes'] += len(P)
+        return R
+
     def map(self, func, args, chunksize=1):
-        return list(self.real.map(func, args, chunksize=chunksize))
+        P = (self._pickle_arg((func, a)) for a in args)
+        return [self._unpickle_result(r) for r in
+                self.real.map(_timed_call, P, chunksize=chunksize)]
     def imap_unordered(self, func, args, chunksize=1):
-        return result_iter([self.real.submit(func, a) for a in args])
+        window = None
+        if self._processes:
+            window = self.window_per_worker * self._processes
+        R = result_iter(self.real, _timed_call, ((func, a) for a in args),
+                        window=window, prepare=self._pickle_arg,
+                        finish=self._unpickle_result)
+        try:
+            R.n = len(args)
+        except TypeError:
+            pass
+        return R
     def bootup(self, **kwargs):
         return self.real.bootup(**kwargs)
     def shutdown(self, **kwargs):
@@ -84,14 +187,21 @@ class MyMPIPool(object):
     def apply_async(self, *args, **kwargs):
         raise RuntimeError('APPLY_ASYNC NOT IMPLEMENTED IN MyMPIPool')
     def get_worker_cpu(self):
-        return 0.
+        return self.worker_cpu
     def get_worker_wall(self):
-        return 0.
+        return self.worker_wall
     def get_pickle_traffic(self):
-        return None
+        t = self.traffic.copy()
+        t.update(pickle_megabytes=t['pickle_bytes'] * 1e-6,
+                 unpickle_megabytes=t['unpickle_bytes'] * 1e-6)
+        return t
     def get_pickle_traffic_string(self):
-        return 'nope'
-    
+        t = self.get_pickle_traffic()
+        return (('  Total of %i objects pickled, %.1f MB.  Time spent pickling %.1f sec\n' +
+                 '  Total of %i objects unpickled, %.1f MB.  Time spent unpickling %.1f sec') %
+                (t['pickle_objs'], t['pickle_megabytes'], t['pickle_cputime'],
+                 t['unpickle_objs'], t['unpickle_megabytes'], t['unpickle_cputime']))
+
 def main(args=None):
     import os
     import datetime
@@ -6,7 +6,6 @@ import time
 from astrometry.util.ttime import Time
 from astrometry.util.resample import resample_with_wcs, OverlapError
 from astrometry.util.fits import fits_table
-from astrometry.util.plotutils import dimshow
 
 from tractor import Tractor, PointSource, Image, Catalog, Patch
 from tractor.galaxy import (DevGalaxy, ExpGalaxy,
@@ -17,11 +16,20 @@ from tractor.sersic import SersicGalaxy
 from legacypipe.survey import (RexGalaxy,
                                LegacyEllipseWithPriors, LegacySersicIndex, get_rgb)
 from legacypipe.bits import IN_BLOB
+from legacypipe.catalog import get_source_params
 from legacypipe.coadds import quick_coadds
-from legacypipe.runbrick_plots import _plot_mods
 
 rgbkwargs_resid = dict(resids=True)
 
+# The plotting modules import matplotlib; only do that when plotting.
+def dimshow(*args, **kwargs):
+    from astrometry.util.plotutils import dimshow
+    return dimshow(*args, **kwargs)
+
+def _plot_mods(*args, **kwargs):
+    from legacypipe.runbrick_plots import _plot_mods
+    return _plot_mods(*args, **kwargs)
+
 import logging
 logger = logging.getLogger('legacypipe.oneblob')
 def info(*args):
@@ -623,12 +631,20 @@ class OneBlob(object):
 
         N = len(cat)
         B.dchisq = np.zeros((N, 5), np.float32)
-        B.all_models    = np.array([{} for i in range(N)])
-        B.all_model_ivs = np.array([{} for i in range(N)])
-        B.all_model_cpu = np.array([{} for i in range(N)])
-        B.all_model_hit_limit     = np.array([{} for i in range(N)])
-        B.all_model_hit_r_limit   = np.array([{} for i in range(N)])
-        B.all_model_opt_steps     = np.array([{} for i in range(N)])
+        # Results for each of the models tried for each source, as
+        # (N x len(MODEL_NAMES)) arrays; zero for models not fit.
+        nm = len(MODEL_NAMES)
+        for iv in ['', '_ivar']:
+            for k in ['ra', 'dec']:
+                B.set('all_model_%s%s' % (k, iv), np.zeros((N, nm)))
+            for k in ['shape_r', 'shape_e1', 'shape_e2', 'sersic']:
+                B.set('all_model_%s%s' % (k, iv), np.zeros((N, nm), np.float32))
+            B.set('all_model_flux%s' % iv,
+                  np.zeros((N, nm, len(self.bands)), np.float32))
+        B.all_model_cpu = np.zeros((N, nm), np.float32)
+        B.all_model_hit_limit   = np.zeros((N, nm), bool)
+        B.all_model_hit_r_limit = np.zeros((N, nm), bool)
+        B.all_model_opt_steps   = np.zeros((N, nm), np.int16) - 1
 
         # Model selection for sources, in decreasing order of brightness
         for numi,srci in enumerate(Ibright):
@@ -1538,9 +1554,12 @@ class OneBlob(object):
                 ivars = _compute_invvars(allderivs)
                 assert(len(ivars) == nsrcparams)
 
-            B.all_model_ivs[srci][name] = np.array(ivars).astype(np.float32)
-            B.all_models[srci][name] = newsrc.copy()
-            assert(B.all_models[srci][name].numberOfParams() == nsrcparams)
+            imod = MODEL_NAMES.index(name)
+            P = get_source_params([newsrc], self.bands,
+                                  ivars=[np.array(ivars).astype(np.float32)])
+            del P['type']
+            for k,v in P.items():
+                B.get('all_model_' + k)[srci, imod] = v[0]
 
             # Now revert the ellipses!
             if isinstance(newsrc, (DevGalaxy, ExpGalaxy, SersicGalaxy)):
@@ -1551,11 +1570,11 @@ class OneBlob(object):
             ch = _per_band_chisqs(srctractor, self.bands)
             chisqs[name] = _chisq_improvement(newsrc, ch, chisqs_none)
             cpum1 = time.process_time()
-            B.all_model_cpu[srci][name] = cpum1 - cpum0
+            B.all_model_cpu[srci, imod] = cpum1 - cpum0
             cputimes[name] = cpum1 - cpum0
-            B.all_model_hit_limit  [srci][name] = hit_limit
-            B.all_model_hit_r_limit[srci][name] = hit_r_limit
-            B.all_model_opt_steps  [srci][name] = opt_steps
+            B.all_model_hit_limit  [srci, imod] = hit_limit
+            B.all_model_hit_r_limit[srci, imod] = hit_r_limit
+            B.all_model_opt_steps  [srci, imod] = opt_steps
             if name == 'ser':
                 B.hit_ser_limit[srci] = hit_ser_limit
 
@@ -1586,8 +1605,13 @@ class OneBlob(object):
             debug('Best dchisq is 0 -- dropping source')
             keepsrc = None
 
-        B.hit_limit    [srci] = B.all_model_hit_limit    [srci].get(keepmod, False)
-        B.hit_r_limit  [srci] = B.all_model_hit_r_limit  [srci].get(keepmod, False)
+        if keepmod in MODEL_NAMES:
+            imod = MODEL_NAMES.index(keepmod)
+            B.hit_limit  [srci] = B.all_model_hit_limit  [srci, imod]
+            B.hit_r_limit[srci] = B.all_model_hit_r_limit[srci, imod]
+        else:
+            B.hit_limit  [srci] = False
+            B.hit_r_limit[srci] = False
         if keepmod != 'ser':
             B.hit_ser_limit[srci] = False
 
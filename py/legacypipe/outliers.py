@@ -129,16 +129,25 @@ def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_heade
         # Radius to mask around Gaia stars, in arcsec
         radius = 1.0
         pixrad = radius / targetwcs.pixel_scale()
-        for x,y in zip(bx,by):
-            xlo = int(np.clip(np.floor(x - pixrad), 0, W-1))
-            xhi = int(np.clip(np.ceil (x + pixrad), 0, W-1))
-            ylo = int(np.clip(np.floor(y - pixrad), 0, H-1))
-            yhi = int(np.clip(np.ceil (y + pixrad), 0, H-1))
-            if xlo == xhi or ylo == yhi:
-                continue
-            r2 = (((np.arange(ylo,yhi+1) - y)**2)[:,np.newaxis] +
-                  ((np.arange(xlo,xhi+1) - x)**2)[np.newaxis,:])
-            star_veto[ylo:yhi+1, xlo:xhi+1] |= (r2 < pixrad)
+        # All stars at once: stack of bounding boxes of the same size.
+        xlo = np.floor(bx - pixrad).astype(int)
+        xhi = np.ceil (bx + pixrad).astype(int)
+        ylo = np.floor(by - pixrad).astype(int)
+        yhi = np.ceil (by + pixrad).astype(int)
+        # (stars whose clipped box collapses are skipped)
+        keep = ((np.clip(xlo, 0, W-1) != np.clip(xhi, 0, W-1)) *
+                (np.clip(ylo, 0, H-1) != np.clip(yhi, 0, H-1)))
+        S = int(np.ceil(2 * pixrad)) + 2
+        d = np.arange(S)
+        px = xlo[keep,np.newaxis] + d[np.newaxis,:]
+        py = ylo[keep,np.newaxis] + d[np.newaxis,:]
+        okx = (px <= xhi[keep,np.newaxis]) * (px >= 0) * (px < W)
+        oky = (py <= yhi[keep,np.newaxis]) * (py >= 0) * (py < H)
+        r2 = (((py - by[keep,np.newaxis])**2)[:,:,np.newaxis] +
+              ((px - bx[keep,np.newaxis])**2)[:,np.newaxis,:])
+        vetoed = (r2 < pixrad) * oky[:,:,np.newaxis] * okx[:,np.newaxis,:]
+        K,iy,ix = np.nonzero(vetoed)
+        star_veto[py[K,iy], px[K,ix]] = True
 
     # if plots:
     #     import pylab as plt
@@ -177,11 +186,11 @@ def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_heade
             for tim,r in zip(btims, R):
                 if r is None:
                     continue
-                Yo,Xo,iacc,wacc,macc = r
-                coimg[Yo,Xo] += iacc
-                cow  [Yo,Xo] += wacc
-                masks[Yo,Xo] |= macc
-                del Yo,Xo,iacc,wacc,macc
+                rmap,iacc,wacc,macc = r
+                rmap.scatter_add(coimg, iacc)
+                rmap.scatter_add(cow,   wacc)
+                rmap.scatter(masks, macc, np.bitwise_or)
+                del rmap,iacc,wacc,macc
             del r,R
 
             #
@@ -432,20 +441,21 @@ def compare_one(X):
 
 def blur_resample_one(X):
     from scipy.ndimage.filters import gaussian_filter
-    from astrometry.util.resample import resample_with_wcs,OverlapError
+    from astrometry.util.resample import OverlapError
+    from legacypipe.resampmap import resample_map_with_wcs
 
     tim,sig,targetwcs = X
 
     img = gaussian_filter(tim.getImage(), sig)
     try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
+        rmap,[rimg] = resample_map_with_wcs(
             targetwcs, tim.subwcs, [img], intType=np.int16)
     except OverlapError:
         return None
     del img
     blurnorm = 1./(2. * np.sqrt(np.pi) * sig)
-    wt = tim.getInvvar()[Yi,Xi] / (blurnorm**2)
-    return (Yo, Xo, rimg*wt, wt, tim.dq[Yi,Xi])
+    wt = rmap.gather_in(tim.getInvvar()) / (blurnorm**2)
+    return (rmap, rimg*wt, wt, rmap.gather_in(tim.dq))
 
 def patch_from_coadd(coimgs, targetwcs, bands, tims, mp=None):
     H,W = targetwcs.shape
@@ -0,0 +1,122 @@
+'''
+A node-local cache of decompressed image pixels.
+
+Reading an fpack-compressed CCD image (or its weight map or DQ mask)
+with fitsio decompresses the whole HDU, and neighbouring bricks
+processed on the same node read many of the same CCDs.  This cache
+stores each decompressed HDU once, as a ".npy" file in a (node-local)
+directory; later reads memory-map the file and copy out only the
+requested slice.
+
+Files are keyed by the input filename, its size and modification time,
+and the HDU.  They are written to a temporary file and renamed into
+place, so concurrent processes can share the cache directory safely.
+The total size of the cache is kept under a limit by deleting the
+least-recently-used files.
+'''
+import os
+import hashlib
+import numpy as np
+import fitsio
+
+import logging
+logger = logging.getLogger('legacypipe.pixcache')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class PixelCache(object):
+    '''
+    *cache_dir*: directory in which to store the cached ".npy" files.
+    *max_bytes*: size limit for the cache directory, or None for no limit.
+    '''
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __str__(self):
+        return 'PixelCache(%s, max %s bytes)' % (self.cache_dir, self.max_bytes)
+
+    def get_cache_filename(self, fn, hdu):
+        st = os.stat(fn)
+        key = '%s:%s:%i:%i' % (os.path.abspath(fn), hdu, st.st_size,
+                               st.st_mtime_ns)
+        h = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, h + '.npy')
+
+    def read(self, fn, hdu, slice=None, header=None):
+        '''
+        Reads (a slice of) FITS file *fn* HDU *hdu*, like
+        fitsio.read / fitsio.FITS(fn)[hdu][slice].
+        '''
+        cfn = self.get_cache_filename(fn, hdu)
+        try:
+            pix = np.load(cfn, mmap_mode='r')
+            # Touch, for LRU bookkeeping (atime is often disabled)
+            os.utime(cfn)
+            debug('Pixel cache hit:', fn, 'hdu', hdu, '->', cfn)
+        except (IOError, ValueError):
+            pix = self._add(fn, hdu, cfn)
+        if slice is not None:
+            pix = pix[slice]
+        # Copy out of the memory map -- callers modify the pixels.
+        pix = np.array(pix)
+        if header:
+            return pix, fitsio.read_header(fn, ext=hdu)
+        return pix
+
+    def _add(self, fn, hdu, cfn):
+        debug('Pixel cache miss:', fn, 'hdu', hdu, '->', cfn)
+        pix = fitsio.read(fn, ext=hdu)
+        # Store in native byte order
+        pix = pix.astype(pix.dtype.newbyteorder('='), copy=False)
+        tmpfn = cfn + '.tmp-%i' % os.getpid()
+        try:
+            with open(tmpfn, 'wb') as f:
+                np.save(f, pix)
+            os.replace(tmpfn, cfn)
+        except OSError as e:
+            # eg, out of space: just don't cache.
+            info('Failed to write pixel cache file', cfn, ':', e)
+            if os.path.exists(tmpfn):
+                os.remove(tmpfn)
+            return pix
+        self.trim()
+        return pix
+
+    def trim(self):
+        '''
+        Deletes least-recently-used files until the cache is under its
+        size limit.
+        '''
+        if self.max_bytes is None:
+            return
+        files = []
+        total = 0
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # deleted by another process
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        if total <= self.max_bytes:
+            return
+        files.sort()
+        for _,size,path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                debug('Pixel cache: removed', path)
+            except OSError:
+                pass
+            total -= size
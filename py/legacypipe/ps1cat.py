@@ -61,14 +61,46 @@ class HealpixedCatalog(object):
         # Read catalog in those healpixes
         cat = self.get_healpix_catalogs(healpixes)
         # Cut to sources actually within the CCD.
-        _,xx,yy = wcs.radec2pixelxy(cat.ra, cat.dec)
-        cat.x = xx
-        cat.y = yy
-        onccd = np.flatnonzero((xx >= 1.-margin) * (xx <= W+margin) *
-                               (yy >= 1.-margin) * (yy <= H+margin))
-        cat.cut(onccd)
+        return cut_catalog_to_wcs(cat, wcs, margin=margin)
+
+    def get_catalog_radec_radius(self, ra, dec, radius, step=0.1):
+        '''
+        Reads the catalog entries within *radius* degrees of *ra*, *dec*.
+        '''
+        from astrometry.util.starutil_numpy import degrees_between
+        # Grid the bounding box to find the healpixes
+        declo = max(-90., dec - radius)
+        dechi = min( 90., dec + radius)
+        if declo <= -90. or dechi >= 90.:
+            # contains a pole
+            ralo,rahi = 0., 360.
+        else:
+            cosdec = np.cos(np.deg2rad(max(abs(declo), abs(dechi))))
+            dra = min(180., radius / cosdec)
+            ralo,rahi = ra - dra, ra + dra
+        rr,dd = np.meshgrid(np.linspace(ralo,  rahi,  2+int((rahi -ralo )/step)),
+                            np.linspace(declo, dechi, 2+int((dechi-declo)/step)))
+        healpixes = set()
+        for r,d in zip(rr.ravel() % 360., dd.ravel()):
+            healpixes.add(self.healpix_for_radec(r, d))
+        cat = self.get_healpix_catalogs(healpixes)
+        cat.cut(degrees_between(ra, dec, cat.ra, cat.dec) <= radius)
         return cat
 
+def cut_catalog_to_wcs(cat, wcs, margin=10):
+    '''
+    Cuts *cat* to the entries within the image *wcs* (plus *margin*
+    pixels), adding their (1-indexed) pixel positions *x*, *y*.
+    '''
+    W,H = wcs.get_width(), wcs.get_height()
+    _,xx,yy = wcs.radec2pixelxy(cat.ra, cat.dec)
+    cat.x = xx
+    cat.y = yy
+    onccd = np.flatnonzero((xx >= 1.-margin) * (xx <= W+margin) *
+                           (yy >= 1.-margin) * (yy <= H+margin))
+    cat.cut(onccd)
+    return cat
+
 class ps1cat(HealpixedCatalog):
     ps1band = dict(g=0,r=1,i=2,z=3,Y=4)
     def __init__(self,expnum=None,ccdname=None,ccdwcs=None):
@@ -77,6 +109,7 @@ class ps1cat(HealpixedCatalog):
         Args:
             expnum, ccdname: select catalogue with these
             ccdwcs: or select catalogue with this
+            (or neither, to use only the generic HealpixedCatalog methods)
 
         """
         self.ps1catdir = os.getenv('PS1CAT_DIR')
@@ -85,7 +118,7 @@ class ps1cat(HealpixedCatalog):
         fnpattern = os.path.join(self.ps1catdir, 'ps1-%(hp)05d.fits')
         super(ps1cat, self).__init__(fnpattern)
 
-        if ccdwcs is None:
+        if ccdwcs is None and expnum is not None:
             from legacypipe.survey import LegacySurveyData
             survey = LegacySurveyData()
             ccd = survey.find_ccds(expnum=expnum,ccdname=ccdname)[0]
@@ -703,7 +703,7 @@ def main(args):
 
         if opt.command:
             if opt.byexp:
-                s = '--expnum %i' % (T.expnum[i])
+                s = '--expnum %i --by-exposure' % (T.expnum[i])
             else:
                 s = '%i-%s' % (T.expnum[i], T.ccdname[i])
             prefix = 'python legacypipe/run-calib.py '
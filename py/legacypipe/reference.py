@@ -22,6 +22,34 @@ def get_reference_sources(survey, targetwcs, pixscale, bands,
                           gaia_margin=None,
                           galaxy_margin=None):
     # If bands = None, does not create sources.
+    refs = read_reference_catalogs(survey, targetwcs, pixscale, bands,
+                                   tycho_stars=tycho_stars,
+                                   gaia_stars=gaia_stars,
+                                   large_galaxies=large_galaxies,
+                                   star_clusters=star_clusters,
+                                   clean_columns=clean_columns,
+                                   plots=plots, ps=ps,
+                                   gaia_margin=gaia_margin,
+                                   galaxy_margin=galaxy_margin)
+    if refs is None:
+        return None,None
+    return cut_reference_sources(refs, targetwcs, pixscale)
+
+def read_reference_catalogs(survey, targetwcs, pixscale, bands,
+                            tycho_stars=True,
+                            gaia_stars=True,
+                            large_galaxies=True,
+                            star_clusters=True,
+                            clean_columns=True,
+                            plots=False, ps=None,
+                            gaia_margin=None,
+                            galaxy_margin=None):
+    '''
+    Reads the reference catalogs (Tycho-2, Gaia, star clusters, large
+    galaxies) around *targetwcs* and merges them into one table, with
+    a 'sources' column; returns None if there are none.  These are
+    not yet cut to the *targetwcs* bounds -- see cut_reference_sources.
+    '''
     from astrometry.libkd.spherematch import match_radec
 
     H,W = targetwcs.shape
@@ -142,33 +170,48 @@ def get_reference_sources(survey, targetwcs, pixscale, bands,
         refs = merge_tables([r for r in refs if r is not None],
                             columns='fillzero')
     if len(refs) == 0:
-        return None,None
+        return None
 
     # these x,y are in the margin-padded WCS; not useful.
-    # See ibx,iby computed below instead.
+    # See ibx,iby computed in cut_reference_sources instead.
     for c in ['x','y']:
         if c in refs.get_columns():
             refs.delete_column(c)
+    return refs
 
-    # radius / radius_pix are used to set the MASKBITS shapes;
-    # keep_radius determines which sources are kept (because we subtract
-    # stellar halos out to N x their radii)
-    refs.radius_pix = np.ceil(refs.radius * 3600. / pixscale).astype(int)
+def cut_reference_sources(refs, targetwcs, pixscale):
+    '''
+    Cuts the reference-catalog table *refs* (from
+    read_reference_catalogs) to the sources touching *targetwcs*,
+    adding pixel-space columns.  *refs* itself is not modified, so it
+    can be cut to several WCSes.
+
+    Returns (refs, sources).
+    '''
+    H,W = targetwcs.shape
+    H,W = int(H),int(W)
 
     debug('Increasing radius for', np.sum(refs.keep_radius > refs.radius),
           'ref sources based on keep_radius')
+    # keep_radius determines which sources are kept (because we subtract
+    # stellar halos out to N x their radii)
     keeprad = np.maximum(refs.keep_radius, refs.radius)
     # keeprad to pix
     keeprad = np.ceil(keeprad * 3600. / pixscale).astype(int)
 
     _,xx,yy = targetwcs.radec2pixelxy(refs.ra, refs.dec)
+    # cut ones whose position + radius are outside the brick bounds.
+    I = np.flatnonzero((xx > -keeprad) * (xx < W+keeprad) *
+                       (yy > -keeprad) * (yy < H+keeprad))
+    refs = refs[I]
+    xx = xx[I]
+    yy = yy[I]
+
+    # radius / radius_pix are used to set the MASKBITS shapes
+    refs.radius_pix = np.ceil(refs.radius * 3600. / pixscale).astype(int)
     # ibx = integer brick coords
     refs.ibx = np.round(xx-1.).astype(np.int32)
     refs.iby = np.round(yy-1.).astype(np.int32)
-
-    # cut ones whose position + radius are outside the brick bounds.
-    refs.cut((xx > -keeprad) * (xx < W+keeprad) *
-             (yy > -keeprad) * (yy < H+keeprad))
     # mark ones that are actually inside the brick area.
     refs.in_bounds = ((refs.ibx >= 0) * (refs.ibx < W) *
                       (refs.iby >= 0) * (refs.iby < H))
@@ -311,8 +354,40 @@ def mask_radius_for_mag(mag):
     # This is in degrees, and is from Rongpu in the thread [decam-chatter 12099].
     return 1630./3600. * 1.396**(-mag)
 
+# Process-wide cache of opened reference-catalog kd-trees,
+# (filename, tree name) -> kd-tree, so that long-lived processes
+# (eg, runbrick_daemon.py) do not re-open them for every brick.
+_kdtree_cache = {}
+
+def _open_kdtree(fn, treenames):
+    '''
+    Opens (or returns from cache) the first of the named kd-trees in
+    the given file.
+    '''
+    from astrometry.libkd.spherematch import tree_open
+    for name in treenames:
+        key = (fn, name)
+        if key in _kdtree_cache:
+            return _kdtree_cache[key]
+    err = None
+    for name in treenames:
+        try:
+            kd = tree_open(fn, name)
+        except Exception as e:
+            err = e
+            continue
+        _kdtree_cache[(fn, name)] = kd
+        return kd
+    raise err
+
+def clear_reference_cache():
+    '''
+    Drops the cached reference-catalog kd-trees.
+    '''
+    _kdtree_cache.clear()
+
 def read_tycho2(survey, targetwcs, bands):
-    from astrometry.libkd.spherematch import tree_open, tree_search_radec
+    from astrometry.libkd.spherematch import tree_search_radec
     from legacypipe.survey import GaiaSource
     tycho2fn = survey.find_file('tycho2')
     radius = 1.
@@ -332,14 +407,13 @@ def read_tycho2(survey, targetwcs, bands):
     # startree -P -k -n stars -T -i /tmp/tycho2-astrom.fits \
     #  -o /global/project/projectdirs/cosmo/staging/tycho2/tycho2.kd.fits
 
-    kd = tree_open(tycho2fn, 'stars')
+    kd = _open_kdtree(tycho2fn, ['stars'])
     I = tree_search_radec(kd, ra, dec, radius)
     debug(len(I), 'Tycho-2 stars within', radius, 'deg of RA,Dec (%.3f, %.3f)' % (ra,dec))
     if len(I) == 0:
         return None
     # Read only the rows within range.
     tycho = fits_table(tycho2fn, rows=I)
-    del kd
     if 'isgalaxy' in tycho.get_columns():
         tycho.cut(tycho.isgalaxy == 0)
         debug('Cut to', len(tycho), 'Tycho-2 stars on isgalaxy==0')
@@ -441,7 +515,7 @@ def read_large_galaxies(survey, targetwcs, bands, clean_columns=True,
                         extra_columns=None,
                         max_radius=2.):
     # Note, max_radius must include the brick radius!
-    from astrometry.libkd.spherematch import tree_open, tree_search_radec
+    from astrometry.libkd.spherematch import tree_search_radec
     galfn = survey.find_file('large-galaxies')
     if galfn is None:
         debug('No large-galaxies catalog file')
@@ -450,10 +524,7 @@ def read_large_galaxies(survey, targetwcs, bands, clean_columns=True,
     rc,dc = targetwcs.radec_center()
 
     debug('Reading', galfn)
-    try:
-        kd = tree_open(galfn, 'stars')
-    except:
-        kd = tree_open(galfn, 'largegals')
+    kd = _open_kdtree(galfn, ['stars', 'largegals'])
     I = tree_search_radec(kd, rc, dc, radius)
     debug('%i large galaxies within %.3g deg of RA,Dec (%.3f, %.3f)' %
           (len(I), radius, rc,dc))
@@ -461,7 +532,6 @@ def read_large_galaxies(survey, targetwcs, bands, clean_columns=True,
         return None
     # Read only the rows within range.
     galaxies = fits_table(galfn, rows=I)
-    del kd
 
     refcat, preburn = get_large_galaxy_version(galfn)
     debug('Large galaxies version: "%s", preburned?' % refcat, preburn)
@@ -667,36 +737,67 @@ def get_reference_map(wcs, refs):
         _,xx,yy = wcs.radec2pixelxy(thisrefs.ra, thisrefs.dec)
         xx -= 1.
         yy -= 1.
-        for x,y,rpix,ref in zip(xx,yy,radius_pix,thisrefs):
+        bitval = np.uint8(IN_BLOB[bit])
+        if not ellipse:
+            _paint_refs(refmap, xx, yy, radius_pix, bitval)
+        else:
+            # *should* have ba and pa if we got here...
+            pa = thisrefs.pa.copy()
+            pa[np.logical_not(np.isfinite(pa))] = 0.
+            _paint_refs(refmap, xx, yy, radius_pix, bitval,
+                        cd=cd, pa=pa, ba=thisrefs.ba)
+    return refmap
+
+def _paint_refs(refmap, xx, yy, radius_pix, bitval, cd=None, pa=None, ba=None,
+                max_pixels=4000000):
+    '''
+    ORs *bitval* into *refmap* within circles (or, if *cd* is given,
+    ellipses with position angles *pa* and axis ratios *ba*) of
+    integer radius *radius_pix* pixels centered on pixel positions
+    *xx*, *yy*.
+
+    References are grouped by radius, so that each group is
+    rasterized with one vectorized distance computation over a stack
+    of identically-sized bounding boxes.
+    '''
+    H,W = refmap.shape
+    for rpix in np.unique(radius_pix):
+        I = np.flatnonzero(radius_pix == rpix)
+        # bounding-box size (clipped to the image size)
+        S = 2*rpix + 2
+        Sx = min(S, W)
+        Sy = min(S, H)
+        chunk = max(1, max_pixels // (Sx*Sy))
+        for i0 in range(0, len(I), chunk):
+            J = I[i0:i0+chunk]
+            x = xx[J]
+            y = yy[J]
             # Cut to bounding square
-            xlo = int(np.clip(np.floor(x   - rpix), 0, W))
-            xhi = int(np.clip(np.ceil (x+1 + rpix), 0, W))
-            ylo = int(np.clip(np.floor(y   - rpix), 0, H))
-            yhi = int(np.clip(np.ceil (y+1 + rpix), 0, H))
-            if xlo == xhi or ylo == yhi:
-                continue
-            bitval = np.uint8(IN_BLOB[bit])
-            if not ellipse:
-                rr = ((np.arange(ylo,yhi)[:,np.newaxis] - y)**2 +
-                      (np.arange(xlo,xhi)[np.newaxis,:] - x)**2)
-                masked = (rr <= rpix**2)
+            xlo = np.floor(x   - rpix).astype(int)
+            xhi = np.ceil (x+1 + rpix).astype(int)
+            ylo = np.floor(y   - rpix).astype(int)
+            yhi = np.ceil (y+1 + rpix).astype(int)
+            px = np.maximum(xlo, 0)[:,np.newaxis] + np.arange(Sx)[np.newaxis,:]
+            py = np.maximum(ylo, 0)[:,np.newaxis] + np.arange(Sy)[np.newaxis,:]
+            okx = (px < xhi[:,np.newaxis]) * (px >= 0) * (px < W)
+            oky = (py < yhi[:,np.newaxis]) * (py >= 0) * (py < H)
+            dx = (px - x[:,np.newaxis])[:,np.newaxis,:]
+            dy = (py - y[:,np.newaxis])[:,:,np.newaxis]
+            if cd is None:
+                masked = (dy**2 + dx**2 <= rpix**2)
             else:
-                # *should* have ba and pa if we got here...
-                xgrid,ygrid = np.meshgrid(np.arange(xlo,xhi), np.arange(ylo,yhi))
-                dx = xgrid - x
-                dy = ygrid - y
                 # Rotate to "intermediate world coords" via the unit-scaled CD matrix
                 du = cd[0][0] * dx + cd[0][1] * dy
                 dv = cd[1][0] * dx + cd[1][1] * dy
-                debug('Object: PA', ref.pa, 'BA', ref.ba, 'Radius', ref.radius, 'pix', rpix)
-                if not np.isfinite(ref.pa):
-                    ref.pa = 0.
-                ct = np.cos(np.deg2rad(90.+ref.pa))
-                st = np.sin(np.deg2rad(90.+ref.pa))
+                ct = np.cos(np.deg2rad(90.+pa[J]))[:,np.newaxis,np.newaxis]
+                st = np.sin(np.deg2rad(90.+pa[J]))[:,np.newaxis,np.newaxis]
                 v1 = ct * du + -st * dv
                 v2 = st * du +  ct * dv
                 r1 = rpix
-                r2 = rpix * ref.ba
-                masked = (v1**2 / r1**2 + v2**2 / r2**2 < 1.)
-            refmap[ylo:yhi, xlo:xhi] |= (bitval * masked)
-    return refmap
+                r2 = rpix * ba[J][:,np.newaxis,np.newaxis]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    masked = (v1**2 / r1**2 + v2**2 / r2**2 < 1.)
+            masked *= oky[:,:,np.newaxis]
+            masked *= okx[:,np.newaxis,:]
+            K,iy,ix = np.nonzero(masked)
+            np.bitwise_or.at(refmap, (py[K,iy], px[K,ix]), bitval)
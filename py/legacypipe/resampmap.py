@@ -0,0 +1,261 @@
+'''
+Run-length encoded resampling index maps.
+
+astrometry.util.resample.resample_with_wcs returns the mapping between
+output and input pixels as four index arrays (Yo,Xo,Yi,Xi), with one
+entry per overlapping pixel.  For a CCD resampled onto a brick (or the
+reverse), these are almost entirely made up of runs along output rows
+(Yo constant, Xo stepping by one) over which the input pixel moves by a
+constant step: (0, +1) when the CCD is aligned with the brick, but
+eg (+1, 0) or (-1, 0) for CCDs that are transposed relative to the
+brick (DECam, Mosaic, 90prime), or (0, -1) for flipped ones.  A
+ResampleMap stores each such run as (yo, xo, yi, xi, dyi, dxi,
+length), at a small fraction of the memory and pickle size of the
+full index arrays.  (If the runs are short on average, it keeps the
+index arrays instead.)
+
+Gather and scatter operations are applied run-by-run with slices; the
+full index arrays are only expanded (vectorized) when the runs are too
+short for that to pay off, or when a caller asks for them.  Iterating
+over a ResampleMap yields the expanded (Yo, Xo, Yi, Xi), so
+
+    Yo,Xo,Yi,Xi = rmap
+
+works as it does for the tuple from resample_with_wcs.
+'''
+import numpy as np
+
+class ResampleMap(object):
+    '''
+    Runs of pixels: output pixels (yo[i], xo[i] + k) map to input
+    pixels (yi[i] + k * dyi[i], xi[i] + k * dxi[i]), for k in [0,
+    n[i]).  The map's pixel ordering (for gathered and scattered
+    values) is the ordering of the index arrays it was built from.
+
+    Alternatively (*indices* = (Yo, Xo, Yi, Xi), and no runs), the
+    index arrays themselves.
+
+    *dtype*: integer type of the expanded index arrays.
+    '''
+    # If the mean run is shorter than this, operations expand the
+    # index arrays rather than looping over runs, and from_indices()
+    # keeps the index arrays.
+    min_run = 16
+
+    def __init__(self, yo=None, xo=None, yi=None, xi=None, n=None,
+                 dyi=None, dxi=None, dtype=np.int32, indices=None):
+        self.dtype = np.dtype(dtype)
+        self.indices = indices
+        if indices is not None:
+            self.npix = len(indices[0])
+            return
+        self.yo = yo
+        self.xo = xo
+        self.yi = yi
+        self.xi = xi
+        self.n = n
+        if dyi is None:
+            dyi = np.zeros(len(n), np.int8)
+        if dxi is None:
+            dxi = np.ones(len(n), np.int8)
+        self.dyi = dyi
+        self.dxi = dxi
+        self.npix = int(np.sum(n))
+
+    @classmethod
+    def from_indices(cls, Yo, Xo, Yi, Xi, min_run=None):
+        if min_run is None:
+            min_run = cls.min_run
+        dtype = np.asarray(Yo).dtype
+        indices = (Yo, Xo, Yi, Xi)
+        Yo = np.asarray(Yo, np.int32)
+        Xo = np.asarray(Xo, np.int32)
+        Yi = np.asarray(Yi, np.int32)
+        Xi = np.asarray(Xi, np.int32)
+        N = len(Yo)
+        # Input step from the previous pixel, and whether it can
+        # continue a run: the output steps along the row, and the
+        # input by at most one pixel in each direction.
+        dy = np.zeros(N, np.int32)
+        dx = np.zeros(N, np.int32)
+        dy[1:] = Yi[1:] - Yi[:-1]
+        dx[1:] = Xi[1:] - Xi[:-1]
+        cont = np.zeros(N, bool)
+        cont[1:] = ((Yo[1:] == Yo[:-1]) & (Xo[1:] == Xo[:-1] + 1) &
+                    (np.abs(dy[1:]) <= 1) & (np.abs(dx[1:]) <= 1))
+        # A pixel also starts a new run if its step differs from the
+        # previous pixel's.  (This leaves a one-pixel run where the
+        # step changes, but keeps the step constant within runs.)
+        start = np.logical_not(cont)
+        start[2:] |= (cont[1:-1] & ((dy[2:] != dy[1:-1]) | (dx[2:] != dx[1:-1])))
+        I = np.flatnonzero(start)
+        n = np.diff(np.append(I, N)).astype(np.int32)
+        if len(I) * min_run > N:
+            return cls(dtype=dtype, indices=tuple(np.asarray(a) for a in indices))
+        # The step of each run is that of its second pixel.
+        J = np.minimum(I + 1, N - 1)
+        dyi = np.where(n > 1, dy[J], 0).astype(np.int8)
+        dxi = np.where(n > 1, dx[J], 1).astype(np.int8)
+        return cls(Yo[I], Xo[I], Yi[I], Xi[I], n, dyi=dyi, dxi=dxi, dtype=dtype)
+
+    def __len__(self):
+        return self.npix
+
+    def __iter__(self):
+        return iter(self.expand())
+
+    def __str__(self):
+        if self.indices is not None:
+            return 'ResampleMap(%i pixels)' % self.npix
+        return 'ResampleMap(%i pixels in %i runs)' % (self.npix, len(self.n))
+
+    @property
+    def nbytes(self):
+        if self.indices is not None:
+            return sum(a.nbytes for a in self.indices)
+        return sum(a.nbytes for a in [self.yo, self.xo, self.yi, self.xi,
+                                      self.n, self.dyi, self.dxi])
+
+    def _use_runs(self):
+        return (self.indices is None and
+                self.npix >= self.min_run * len(self.n))
+
+    def _runs(self, y, x):
+        # (y, x, offset into map order, length) for each run
+        off = np.cumsum(self.n) - self.n
+        return zip(y.tolist(), x.tolist(), off.tolist(), self.n.tolist())
+
+    def _offsets(self):
+        # position of each pixel within its run
+        return (np.arange(self.npix, dtype=np.int32) -
+                np.repeat(np.cumsum(self.n) - self.n, self.n))
+
+    def _expand(self, y, x, dy, dx, dtype=None):
+        if dtype is None:
+            dtype = self.dtype
+        k = self._offsets()
+        if np.ndim(dy):
+            dy = np.repeat(dy, self.n)
+            dx = np.repeat(dx, self.n)
+        return ((np.repeat(y, self.n) + dy * k).astype(dtype),
+                (np.repeat(x, self.n) + dx * k).astype(dtype))
+
+    def expand(self, dtype=None):
+        '''
+        Returns the full (Yo, Xo, Yi, Xi) index arrays.
+        '''
+        return self.out_indices(dtype=dtype) + self.in_indices(dtype=dtype)
+
+    def out_indices(self, dtype=None):
+        '''
+        Returns the full (Yo, Xo) index arrays.
+        '''
+        if self.indices is not None:
+            return tuple(a.astype(dtype or self.dtype) for a in self.indices[:2])
+        return self._expand(self.yo, self.xo, 0, 1, dtype=dtype)
+
+    def in_indices(self, dtype=None):
+        '''
+        Returns the full (Yi, Xi) index arrays.
+        '''
+        if self.indices is not None:
+            return tuple(a.astype(dtype or self.dtype) for a in self.indices[2:])
+        return self._expand(self.yi, self.xi, self.dyi, self.dxi, dtype=dtype)
+
+    @staticmethod
+    def _in_run(img, yi, xi, dy, dx, k):
+        # img[yi + j*dy, xi + j*dx] for j in [0, k), by slicing if we can
+        if dy == 0 and dx != 0:
+            return img[yi, _slice(xi, dx, k)]
+        if dx == 0 and dy != 0:
+            return img[_slice(yi, dy, k), xi]
+        j = np.arange(k)
+        return img[yi + j*dy, xi + j*dx]
+
+    def gather_in(self, img):
+        '''
+        Returns img[Yi,Xi], for an input-shaped image.
+        '''
+        if not self._use_runs():
+            Y,X = self.in_indices()
+            return img[Y,X]
+        if self.npix == 0:
+            return np.zeros(0, img.dtype)
+        return np.concatenate([self._in_run(img, yy, xx, dy, dx, k)
+                               for yy,xx,dy,dx,k in zip(
+                                       self.yi.tolist(), self.xi.tolist(),
+                                       self.dyi.tolist(), self.dxi.tolist(),
+                                       self.n.tolist())])
+
+    def gather_out(self, img):
+        '''
+        Returns img[Yo,Xo], for an output-shaped image.
+        '''
+        if not self._use_runs():
+            Y,X = self.out_indices()
+            return img[Y,X]
+        if self.npix == 0:
+            return np.zeros(0, img.dtype)
+        return np.concatenate([img[yy, xx:xx+k] for yy,xx,_,k
+                               in self._runs(self.yo, self.xo)])
+
+    def scatter(self, out, vals, op=None):
+        '''
+        Sets out[Yo,Xo] = vals, or, with a numpy ufunc *op* (eg,
+        np.add, np.bitwise_or), out[Yo,Xo] = op(out[Yo,Xo], vals).
+        *vals* is an array in map order, or a scalar.
+        '''
+        scalar = (np.ndim(vals) == 0)
+        if not self._use_runs():
+            Y,X = self.out_indices()
+            if op is None:
+                out[Y,X] = vals
+            else:
+                out[Y,X] = op(out[Y,X], vals)
+            return
+        for yy,xx,off,k in self._runs(self.yo, self.xo):
+            v = vals if scalar else vals[off:off+k]
+            if op is None:
+                out[yy, xx:xx+k] = v
+            else:
+                s = out[yy, xx:xx+k]
+                op(s, v, out=s)
+
+    def scatter_add(self, out, vals):
+        '''
+        out[Yo,Xo] += vals
+        '''
+        self.scatter(out, vals, op=np.add)
+
+    def resample(self, img, out):
+        '''
+        Sets out[Yo,Xo] = img[Yi,Xi] (nearest-neighbour resampling).
+        '''
+        if not self._use_runs():
+            Yo,Xo,Yi,Xi = self.expand()
+            out[Yo,Xo] = img[Yi,Xi]
+            return
+        for yo,xo,yi,xi,dy,dx,k in zip(self.yo.tolist(), self.xo.tolist(),
+                                       self.yi.tolist(), self.xi.tolist(),
+                                       self.dyi.tolist(), self.dxi.tolist(),
+                                       self.n.tolist()):
+            out[yo, xo:xo+k] = self._in_run(img, yi, xi, dy, dx, k)
+
+def _slice(a, step, k):
+    # the slice a, a+step, ..., a+(k-1)*step
+    stop = a + k * step
+    if stop < 0:
+        stop = None
+    return slice(a, stop, step)
+
+def resample_map_with_wcs(targetwcs, wcs, Limages=None, L=3, **kwargs):
+    '''
+    Like astrometry.util.resample.resample_with_wcs, but returns
+    (ResampleMap, resampled images).  Raises OverlapError if there is
+    no overlap.
+    '''
+    from astrometry.util.resample import resample_with_wcs
+    if Limages is None:
+        Limages = []
+    Yo,Xo,Yi,Xi,rims = resample_with_wcs(targetwcs, wcs, Limages, L, **kwargs)
+    return ResampleMap.from_indices(Yo, Xo, Yi, Xi), rims
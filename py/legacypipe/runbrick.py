@@ -42,9 +42,6 @@ from legacypipe.bits import DQ_BITS, MASKBITS, FITBITS
 from legacypipe.utils import RunbrickError, NothingToDoError, iterwrapper, find_unique_pixels
 from legacypipe.coadds import make_coadds, write_coadd_images, quick_coadds
 
-from legacypipe.fit_on_coadds import stage_fit_on_coadds
-from legacypipe.galex import stage_galex_forced
-
 import logging
 logger = logging.getLogger('legacypipe.runbrick')
 def info(*args):
@@ -54,6 +51,51 @@ def debug(*args):
     from legacypipe.utils import log_debug
     log_debug(logger, args)
 
+# The optional stages live in their own modules, imported only when
+# the stage is run.
+def stage_fit_on_coadds(**kwargs):
+    from legacypipe.fit_on_coadds import stage_fit_on_coadds
+    return stage_fit_on_coadds(**kwargs)
+
+def stage_galex_forced(**kwargs):
+    from legacypipe.galex import stage_galex_forced
+    return stage_galex_forced(**kwargs)
+
+# stage name -> module of the real stage function, for the stages above
+lazy_stage_modules = dict(fit_on_coadds='legacypipe.fit_on_coadds',
+                          galex_forced='legacypipe.galex')
+
+def stage_function(stage):
+    '''
+    Returns the function for *stage* -- for the lazily-imported stages,
+    the real one, not the wrapper -- or None.
+    '''
+    modname = lazy_stage_modules.get(stage)
+    if modname is not None:
+        import importlib
+        return getattr(importlib.import_module(modname), 'stage_%s' % stage)
+    return globals().get('stage_%s' % stage)
+
+class LazyPlotSequence(object):
+    '''
+    A stand-in for astrometry.util.plotutils.PlotSequence that only
+    creates it (importing matplotlib) if it is actually used.
+    '''
+    def __init__(self, basefn, **kwargs):
+        self.basefn = basefn
+        self.kwargs = kwargs
+        self.ps = None
+
+    def __getattr__(self, name):
+        # (only called for attributes not found normally; the guard
+        # keeps unpickling from recursing)
+        if name in ['basefn', 'kwargs', 'ps']:
+            raise AttributeError(name)
+        if self.ps is None:
+            from astrometry.util.plotutils import PlotSequence
+            self.ps = PlotSequence(self.basefn, **self.kwargs)
+        return getattr(self.ps, name)
+
 def runbrick_global_init():
     from tractor.galaxy import disable_galaxy_cache
     info('Starting process', os.getpid(), Time()-Time())
@@ -672,6 +714,7 @@ def stage_srcs(pixscale=None, targetwcs=None,
                mp=None, nsigma=None,
                saddle_fraction=None,
                saddle_min=None,
+               single_pass_detection=False,
                survey=None, brick=None,
                refcat=None, refstars=None,
                T_clusters=None,
@@ -784,12 +827,14 @@ def stage_srcs(pixscale=None, targetwcs=None,
         SEDs, bands, detmaps, detivs, (avoid_x,avoid_y,avoid_r), targetwcs,
         nsigma=nsigma, saddle_fraction=saddle_fraction, saddle_min=saddle_min,
         saturated_pix=saturated_pix, veto_map=avoid_map,
+        single_pass=single_pass_detection,
         plots=plots, ps=ps, mp=mp, **kwa)
 
     if Tnew is not None:
         assert(len(Tnew) == len(newcat))
         Tnew.delete_column('peaksn')
         Tnew.delete_column('apsn')
+        Tnew.delete_column('sedname')
         Tnew.ref_cat = np.array(['  '] * len(Tnew))
         Tnew.ref_id  = np.zeros(len(Tnew), np.int64)
     del detmaps
@@ -1471,6 +1516,13 @@ def _get_bailout_mask(blobmap, skipblobs, targetwcs, W, H, brick, blobslices):
     bailout_mask = bmap[blobmap+1]
     return bailout_mask
 
+def _wise_phot_or_epochs(X):
+    from legacypipe.unwise import unwise_phot, unwise_epochs_phot
+    key,_ = X
+    if key[0] == 'epochs':
+        return unwise_epochs_phot(X)
+    return unwise_phot(X)
+
 def _write_checkpoint(R, checkpoint_filename):
     from astrometry.util.file import pickle_to_file, trymakedirs
     d = os.path.dirname(checkpoint_filename)
@@ -1674,21 +1726,22 @@ def _get_mod(X):
     return mod
 
 def _get_both_mods(X):
-    from astrometry.util.resample import resample_with_wcs, OverlapError
+    from astrometry.util.resample import OverlapError
     from astrometry.util.miscutils import get_overlapping_region
+    from legacypipe.resampmap import resample_map_with_wcs
     (tim, srcs, srcblobs, blobmap, targetwcs, frozen_galaxies, ps, plots) = X
     mod = np.zeros(tim.getModelShape(), np.float32)
     blobmod = np.zeros(tim.getModelShape(), np.float32)
     assert(len(srcs) == len(srcblobs))
     ### modelMasks during fitblobs()....?
     try:
-        Yo,Xo,Yi,Xi,_ = resample_with_wcs(tim.subwcs, targetwcs)
+        rmap,_ = resample_map_with_wcs(tim.subwcs, targetwcs)
     except OverlapError:
         return None,None
     timblobmap = np.empty(mod.shape, blobmap.dtype)
     timblobmap[:,:] = -1
-    timblobmap[Yo,Xo] = blobmap[Yi,Xi]
-    del Yo,Xo,Yi,Xi
+    rmap.resample(blobmap, timblobmap)
+    del rmap
 
     srcs_blobs = list(zip(srcs, srcblobs))
 
@@ -2184,7 +2237,7 @@ def get_fiber_fluxes(cat, T, targetwcs, H, W, pixscale, bands,
     from tractor.tractortime import TAITime
     from tractor.image import Image
     from tractor.basics import LinearPhotoCal
-    import photutils
+    from legacypipe.apphot import aperture_stencils, stencil_sum, aperture_photometry
 
     # Create a fake tim for each band to construct the models in 1" seeing
     # For Gaia stars, we need to give a time for evaluating the models.
@@ -2201,8 +2254,6 @@ def get_fiber_fluxes(cat, T, targetwcs, H, W, pixscale, bands,
 
     # A model image (containing all sources) for each band
     modimgs = [np.zeros((H,W), np.float32) for b in bands]
-    # A blank image that we'll use for rendering the flux from a single model
-    onemod = data
 
     # Results go here!
     fiberflux    = np.zeros((len(cat),len(bands)), np.float32)
@@ -2211,8 +2262,11 @@ def get_fiber_fluxes(cat, T, targetwcs, H, W, pixscale, bands,
     # Fiber diameter in arcsec -> radius in pix
     fiberrad = (fibersize / pixscale) / 2.
 
+    # Aperture weights for all sources at once
+    apx0,apy0,apw = aperture_stencils(T.bx, T.by, fiberrad)
+
     # For each source, compute and measure its model, and accumulate
-    for isrc,(src,sx,sy) in enumerate(zip(cat, T.bx, T.by)):
+    for isrc,src in enumerate(cat):
         if src is None:
             continue
         # This works even if bands[0] has zero flux (or no overlapping
@@ -2222,6 +2276,10 @@ def get_fiber_fluxes(cat, T, targetwcs, H, W, pixscale, bands,
         patch = ums[0]
         if patch is None:
             continue
+        # Fiber flux of the unit-flux model
+        x0,_,y0,_ = patch.getExtent()
+        unitfiber = stencil_sum(apx0[isrc], apy0[isrc], apw[isrc],
+                                patch.patch, x0=x0, y0=y0, W=W, H=H)
         br = src.getBrightness()
         for iband,(modimg,band) in enumerate(zip(modimgs,bands)):
             flux = br.getFlux(band)
@@ -2230,26 +2288,16 @@ def get_fiber_fluxes(cat, T, targetwcs, H, W, pixscale, bands,
                 continue
             # Accumulate into image containing all models
             patch.addTo(modimg, scale=flux)
-            # Add to blank image & photometer
-            patch.addTo(onemod, scale=flux)
-            aper = photutils.CircularAperture((sx, sy), fiberrad)
-            p = photutils.aperture_photometry(onemod, aper)
-            f = p.field('aperture_sum')[0]
+            f = flux * unitfiber
             if not np.isfinite(f):
                 # If the source is off the brick (eg, ref sources), can be NaN
                 continue
             fiberflux[isrc,iband] = f
-            # Blank out the image again
-            x0,x1,y0,y1 = patch.getExtent()
-            onemod[y0:y1, x0:x1] = 0.
 
     # Now photometer the accumulated images
     # Aperture photometry locations
     apxy = np.vstack((T.bx, T.by)).T
-    aper = photutils.CircularAperture(apxy, fiberrad)
-    for iband,modimg in enumerate(modimgs):
-        p = photutils.aperture_photometry(modimg, aper)
-        f = p.field('aperture_sum')
+    for iband,(f,_) in enumerate(aperture_photometry(modimgs, apxy, fiberrad)):
         # If the source is off the brick (eg, ref sources), can be NaN
         I = np.isfinite(f)
         if len(I):
@@ -2332,6 +2380,7 @@ def stage_wise_forced(
     unwise_modelsky_dir=None,
     brick=None,
     wise_ceres=True,
+    wise_epoch_patches=False,
     unwise_coadds=True,
     version_header=None,
     maskbits=None,
@@ -2346,7 +2395,8 @@ def stage_wise_forced(
     After the model fits are finished, we can perform forced
     photometry of the unWISE coadds.
     '''
-    from legacypipe.unwise import unwise_phot, collapse_unwise_bitmask, unwise_tiles_touching_wcs
+    from legacypipe.unwise import (unwise_phot, unwise_epochs_phot,
+                                   collapse_unwise_bitmask, unwise_tiles_touching_wcs)
     from legacypipe.survey import wise_apertures_arcsec
     from tractor import NanoMaggies
 
@@ -2463,6 +2513,17 @@ def stage_wise_forced(
 
     runargs = args + eargs
     info('unWISE forced phot: total of', len(runargs), 'images to photometer')
+    phot_func = unwise_phot
+    if wise_epoch_patches and len(eargs):
+        # One task per band for all the time-resolved epochs, reusing
+        # the sources' model patches between epochs.
+        from collections import OrderedDict
+        bandargs = OrderedDict()
+        for ekey,a in eargs:
+            _,band = ekey
+            bandargs.setdefault(('epochs',band), []).append((ekey,a))
+        runargs = args + list(bandargs.items())
+        phot_func = _wise_phot_or_epochs
     photresults = {}
     # Check for existing checkpoint file.
     if wise_checkpoint_filename and os.path.exists(wise_checkpoint_filename):
@@ -2484,12 +2545,12 @@ def stage_wise_forced(
     #phots = mp.map(unwise_phot, args + eargs)
 
     if wise_checkpoint_filename is None or mp is None:
-        res = mp.map(unwise_phot, runargs)
+        res = mp.map(phot_func, runargs)
         for k,v in res:
             photresults[k] = v
         del res
     elif len(runargs) > 0:
-        res = mp.imap_unordered(unwise_phot, runargs)
+        res = mp.imap_unordered(phot_func, runargs)
         from astrometry.util.ttime import CpuMeas
         import multiprocessing
         import concurrent.futures
@@ -2546,6 +2607,10 @@ def stage_wise_forced(
         _write_checkpoint(photresults, wise_checkpoint_filename)
         info('Computed', n_finished_total, 'new results; wrote', len(photresults), 'to checkpoint')
 
+    # Unpack the per-band batches of time-resolved epochs.
+    for k in list(photresults.keys()):
+        if k[0] == 'epochs':
+            photresults.update(photresults.pop(k))
     phots = [photresults[k] for k,a in (args + eargs)]
     record_event and record_event('stage_wise_forced: results')
 
@@ -2979,6 +3044,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               nsigma=6,
               saddle_fraction=0.1,
               saddle_min=2.,
+              single_pass_detection=False,
               subsky_radii=None,
               reoptimize=False,
               iterative=False,
@@ -3012,6 +3078,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               bail_out=False,
               ceres=True,
               wise_ceres=True,
+              wise_epoch_patches=False,
               unwise_dir=None,
               unwise_tr_dir=None,
               unwise_modelsky_dir=None,
@@ -3027,6 +3094,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               pickle_pat='pickles/runbrick-%(brick)s-%%(stage)s.pickle',
               stages=None,
               force=None, forceall=False, write_pickles=True,
+              stage_store=False,
               checkpoint_filename=None,
               checkpoint_period=None,
               wise_checkpoint_filename=None,
@@ -3101,6 +3169,10 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     - *nsigma*: float; detection threshold in sigmas.
 
+    - *single_pass_detection*: boolean; run source detection once, on
+      the maximum S/N over the SED-matched filters, rather than once
+      per SED.
+
     - *wise*: boolean; run WISE forced photometry?
 
     - *do_calibs*: boolean; run the calibration preprocessing steps?
@@ -3125,6 +3197,10 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     - *wise_ceres*: boolean; use Ceres Solver for unWISE forced photometry?
 
+    - *wise_epoch_patches*: boolean; for the time-resolved unWISE
+      epochs, render the sources' model patches once per tile and
+      solve each epoch's fluxes directly?
+
     - *unwise_dir*: string; where to look for unWISE coadd files.
       This may be a colon-separated list of directories to search in
       order.
@@ -3156,6 +3232,9 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
       even if pickle files exist.
     - *forceall*: boolean; run all stages, ignoring all pickle files.
     - *write_pickles*: boolean; write pickle files after each stage?
+    - *stage_store*: boolean; save stages as per-key stage stores
+      (see stagestore.py) rather than pickles, and pass each stage
+      only the keys it takes as arguments.
 
     Raises
     ------
@@ -3167,7 +3246,6 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
     '''
     from astrometry.util.stages import CallGlobalTime, runstage
     from astrometry.util.multiproc import multiproc
-    from astrometry.util.plotutils import PlotSequence
 
     # *initargs* are passed to the first stage (stage_tims)
     # so should be quantities that shouldn't get updated from their pickled
@@ -3215,7 +3293,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
     plot_base_default = 'brick-%(brick)s'
     if plot_base is None:
         plot_base = plot_base_default
-    ps = PlotSequence(plot_base % dict(brick=brick))
+    ps = LazyPlotSequence(plot_base % dict(brick=brick))
     initargs.update(ps=ps)
     if plot_number:
         ps.skipto(plot_number)
@@ -3234,6 +3312,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     kwargs.update(ps=ps, nsigma=nsigma, saddle_fraction=saddle_fraction,
                   saddle_min=saddle_min,
+                  single_pass_detection=single_pass_detection,
                   subsky_radii=subsky_radii,
                   survey_blob_mask=survey_blob_mask,
                   gaussPsf=gaussPsf, pixPsf=pixPsf, hybridPsf=hybridPsf,
@@ -3257,6 +3336,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
                   cache_outliers=cache_outliers,
                   use_ceres=ceres,
                   wise_ceres=wise_ceres,
+                  wise_epoch_patches=wise_epoch_patches,
                   unwise_coadds=unwise_coadds,
                   bailout=bail_out,
                   minimal_coadds=minimal_coadds,
@@ -3284,12 +3364,20 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
         if wise_checkpoint_period is not None:
             kwargs.update(wise_checkpoint_period=wise_checkpoint_period)
 
+    # Reset, in case run_brick is called repeatedly in one process
+    # (eg, runbrick_daemon.py).
+    StageTime.measurements = []
+    # Only shut down the pool at the end if we created it here.
+    own_pool = False
     if pool or (threads and threads > 1):
         from astrometry.util.timingpool import TimingPool, TimingPoolMeas
         if pool is None:
             pool = TimingPool(threads, initializer=runbrick_global_init,
                               initargs=[])
-        poolmeas = TimingPoolMeas(pool, pickleTraffic=False)
+            own_pool = True
+        # (the MPI pool adapter in mpi_runbrick.py tracks pickle traffic)
+        poolmeas = TimingPoolMeas(pool, pickleTraffic=getattr(
+            pool, 'track_pickle_traffic', False))
         StageTime.add_measurement(poolmeas)
         mp = multiproc(None, pool=pool)
     else:
@@ -3411,6 +3499,18 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
         info('Resources for stage', stage, ':', StageTime()-staget0)
         return R
 
+    if stage_store:
+        from legacypipe.stagestore import runstage as store_runstage
+        from legacypipe.stagestore import stage_arg_names
+        def stage_inputs(stage):
+            # The keys consumed by the default stage functions are their
+            # arguments; a custom *stagefunc* gets all keys.
+            if not isinstance(stagefunc, CallGlobalTime):
+                return None
+            return stage_arg_names(stage_function(stage))
+        kwargs.update(stage_inputs=stage_inputs)
+        runstage = store_runstage
+
     t0 = StageTime()
     R = None
     for stage in stages:
@@ -3419,7 +3519,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     info('All done:', StageTime()-t0)
 
-    if pool is not None:
+    if own_pool:
         pool.close()
         pool.join()
     return R
@@ -3466,6 +3566,8 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
                         action='store_false')
     parser.add_argument('-w', '--write-stage', action='append', default=None,
                         help='Write a pickle for a given stage: eg "tims", "image_coadds", "srcs"')
+    parser.add_argument('--stage-store', action='store_true', default=False,
+                        help='Save stages as directories with one file per key (loaded lazily), rather than as pickles')
     parser.add_argument('-v', '--verbose', dest='verbose', action='count',
                         default=0, help='Make more verbose')
 
@@ -3511,6 +3613,10 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
 
     parser.add_argument('--cache-dir', type=str, default=None,
                         help='Directory to search for cached files')
+    parser.add_argument('--pixel-cache-dir', type=str, default=None,
+                        help='Node-local directory in which to cache decompressed image pixels')
+    parser.add_argument('--pixel-cache-size', type=float, default=None,
+                        help='Size limit for --pixel-cache-dir, in GB')
 
     parser.add_argument('--threads', type=int, help='Run multi-threaded')
     parser.add_argument('-p', '--plots', dest='plots', action='store_true',
@@ -3534,6 +3640,8 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
     parser.add_argument('--no-wise-ceres', dest='wise_ceres', default=True,
                         action='store_false',
                         help='Do not use Ceres Solver for unWISE forced phot')
+    parser.add_argument('--wise-epoch-patches', default=False, action='store_true',
+                        help='Time-resolved unWISE forced phot: render model patches once per tile and reuse them for all epochs')
 
     parser.add_argument('--nblobs', type=int,help='Debugging: only fit N blobs')
     parser.add_argument('--blob', type=int, help='Debugging: start with blob #')
@@ -3579,6 +3687,9 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
     parser.add_argument('--saddle-min', type=float, default=2.0,
                         help='Saddle-point depth from existing sources down to new sources (sigma).')
 
+    parser.add_argument('--single-pass-detection', action='store_true', default=False,
+                        help='Run source detection once, on the maximum S/N over the SED-matched filters, rather than once per SED.')
+
     parser.add_argument(
         '--reoptimize', action='store_true', default=False,
         help='Do a second round of model fitting after all model selections')
@@ -3692,6 +3803,8 @@ def get_runbrick_kwargs(survey=None,
                         survey_dir=None,
                         output_dir=None,
                         cache_dir=None,
+                        pixel_cache_dir=None,
+                        pixel_cache_size=None,
                         check_done=False,
                         skip=False,
                         skip_coadd=False,
@@ -3720,6 +3833,14 @@ def get_runbrick_kwargs(survey=None,
                             cache_dir=cache_dir)
         info(survey)
 
+    if pixel_cache_dir is not None:
+        from legacypipe.pixcache import PixelCache
+        max_bytes = None
+        if pixel_cache_size is not None:
+            max_bytes = int(pixel_cache_size * 1e9)
+        survey.pixel_cache = PixelCache(pixel_cache_dir, max_bytes=max_bytes)
+        info('Using', survey.pixel_cache)
+
     blobdir = opt.pop('blob_mask_dir', None)
     if blobdir is not None:
         from legacypipe.survey import LegacySurveyData
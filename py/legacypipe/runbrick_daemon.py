@@ -0,0 +1,254 @@
+'''
+A long-lived version of runbrick.py that runs many bricks in one
+process.
+
+Each runbrick.py invocation pays the same start-up costs: importing
+tractor, astropy and scipy, opening the survey-ccds kd-trees and the
+bricks table, opening the reference catalogs, and forking a worker
+pool.  This script pays those once; it keeps the LegacySurveyData
+object (with its cached CCD kd-trees and bricks table), the cached
+reference-catalog kd-trees, and the worker pool alive, and calls
+run_brick() for each brick it is given.
+
+Brick names are read either from a local (Unix-domain) socket,
+
+    python legacypipe/runbrick_daemon.py --socket /tmp/rb.sock --threads 32 [runbrick args]
+    python legacypipe/runbrick_daemon.py --socket /tmp/rb.sock --submit 1102p240 1102p237
+
+(one brick name per line; the daemon replies with "<brick> <status>"
+per brick), or from a task queue -- a local SQLite queue file (see
+taskqueue.py) or a QDO queue name:
+
+    python legacypipe/runbrick_daemon.py --queue bricks.sqlite --threads 32 [runbrick args]
+
+All other arguments are as for runbrick.py and apply to every brick.
+'''
+import sys
+import os
+
+import logging
+logger = logging.getLogger('legacypipe.runbrick_daemon')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class BrickRunner(object):
+    '''
+    Holds the state that is shared between bricks (survey object,
+    worker pool), and runs one brick at a time.
+    '''
+    def __init__(self, optdict, survey=None, pool=None):
+        self.optdict = optdict
+        if survey is None:
+            from legacypipe.runs import get_survey
+            survey = get_survey(optdict.get('run'),
+                                survey_dir=optdict.get('survey_dir'),
+                                output_dir=optdict.get('output_dir'),
+                                cache_dir=optdict.get('cache_dir'))
+            info(survey)
+        self.survey = survey
+
+        threads = optdict.get('threads', None)
+        self.own_pool = False
+        if pool is None and threads is not None and threads > 1:
+            from astrometry.util.timingpool import TimingPool
+            from legacypipe.runbrick import runbrick_global_init
+            pool = TimingPool(threads, initializer=runbrick_global_init,
+                              initargs=[])
+            self.own_pool = True
+        self.pool = pool
+
+    def reset_brick_state(self):
+        '''
+        Clears the per-brick state held in the survey object.
+        '''
+        from collections import OrderedDict
+        self.survey.output_file_hashes = OrderedDict()
+
+    def run(self, brick):
+        '''
+        Runs one brick; returns 0 on success (or nothing to do), -1 on
+        failure.
+        '''
+        import gc
+        import traceback
+        from legacypipe.runbrick import (get_runbrick_kwargs, run_brick,
+                                         NothingToDoError, RunbrickError)
+        self.reset_brick_state()
+
+        opt = self.optdict.copy()
+        opt.update(brick=brick, radec=None, survey=self.survey,
+                   stage=list(opt.get('stage') or []))
+        survey, kwargs = get_runbrick_kwargs(**opt)
+        if kwargs in [-1, 0]:
+            return kwargs
+        kwargs.update(command_line='runbrick_daemon.py --brick %s' % brick)
+        if self.pool is not None:
+            kwargs.update(pool=self.pool)
+
+        rtn = -1
+        try:
+            run_brick(brick, survey, **kwargs)
+            rtn = 0
+        except NothingToDoError as e:
+            print()
+            print(e)
+            print()
+            rtn = 0
+        except RunbrickError as e:
+            print()
+            print(e)
+            print()
+        except Exception:
+            # Keep the daemon alive for the next brick.
+            print('Brick', brick, 'failed:')
+            traceback.print_exc()
+        sys.stdout.flush()
+        # Drop the per-brick results before the next brick.
+        gc.collect()
+        return rtn
+
+    def close(self):
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+
+def serve_socket(runner, sockname):
+    '''
+    Runs bricks whose names are sent (one per line) over the
+    Unix-domain socket *sockname*.  A line "quit" shuts down the daemon.
+    '''
+    import socket
+    if os.path.exists(sockname):
+        os.unlink(sockname)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(sockname)
+    sock.listen(1)
+    info('Listening on', sockname)
+    try:
+        while True:
+            conn,_ = sock.accept()
+            with conn, conn.makefile('rw') as f:
+                for line in f:
+                    brick = line.strip()
+                    if len(brick) == 0:
+                        continue
+                    if brick == 'quit':
+                        f.write('quit ok\n')
+                        f.flush()
+                        return
+                    info('Starting brick', brick)
+                    rtn = runner.run(brick)
+                    f.write('%s %s\n' % (brick, 'ok' if rtn == 0 else 'failed'))
+                    f.flush()
+    finally:
+        sock.close()
+        os.unlink(sockname)
+
+def serve_queue(runner, queuename, timeout=10):
+    '''
+    Runs bricks from a task queue (local SQLite file or QDO) until it
+    is empty.
+    '''
+    from legacypipe.taskqueue import connect_queue
+    q,Task = connect_queue(queuename)
+    while True:
+        task = q.get(timeout=timeout)
+        if task is None:
+            break
+        brick = task.task
+        info('Starting brick', brick)
+        rtn = runner.run(brick)
+        if rtn == 0:
+            task.set_state(Task.SUCCEEDED)
+        else:
+            task.set_state(Task.FAILED, err=1)
+
+def submit(sockname, bricks):
+    '''
+    Sends brick names to a running daemon and waits for the results.
+    Returns the number of failed bricks.
+    '''
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sockname)
+    nfailed = 0
+    with sock, sock.makefile('rw') as f:
+        for brick in bricks:
+            f.write(brick + '\n')
+            f.flush()
+            reply = f.readline().strip()
+            print(reply)
+            if not reply.endswith('ok'):
+                nfailed += 1
+    return nfailed
+
+def main(args=None):
+    import datetime
+    from legacypipe.survey import get_git_version
+    from legacypipe.runbrick import get_parser
+
+    print()
+    print('runbrick_daemon.py starting at', datetime.datetime.now().isoformat())
+    print('legacypipe git version:', get_git_version())
+    print()
+
+    parser = get_parser()
+    parser.add_argument('--socket', help='Read brick names from this Unix-domain socket')
+    parser.add_argument('--queue', help='Read brick names from this task queue (SQLite queue filename or QDO queue name)')
+    parser.add_argument('--queue-timeout', type=float, default=10.,
+                        help='Exit after the queue has been empty for this many seconds')
+    parser.add_argument('--submit', nargs='+',
+                        help='Client mode: send these brick names to the daemon listening on --socket')
+    opt = parser.parse_args(args=args)
+
+    if opt.submit:
+        if opt.socket is None:
+            parser.print_help()
+            return -1
+        return submit(opt.socket, opt.submit)
+
+    if (opt.socket is None) == (opt.queue is None):
+        print('Exactly one of --socket and --queue must be given.')
+        return -1
+    if opt.brick is not None or opt.radec is not None:
+        print('Bricks are read from --socket or --queue; do not give --brick or --radec.')
+        return -1
+
+    optdict = vars(opt)
+    sockname = optdict.pop('socket')
+    queuename = optdict.pop('queue')
+    queue_timeout = optdict.pop('queue_timeout')
+    optdict.pop('submit')
+    verbose = optdict.pop('verbose')
+
+    if verbose == 0:
+        lvl = logging.INFO
+    else:
+        lvl = logging.DEBUG
+    logging.basicConfig(level=lvl, format='%(message)s', stream=sys.stdout)
+    # tractor logging is *soooo* chatty
+    logging.getLogger('tractor.engine').setLevel(lvl + 10)
+
+    if opt.plots:
+        import matplotlib
+        matplotlib.use('Agg')
+
+    runner = BrickRunner(optdict)
+    try:
+        if sockname is not None:
+            serve_socket(runner, sockname)
+        else:
+            serve_queue(runner, queuename, timeout=queue_timeout)
+    finally:
+        runner.close()
+    return 0
+
+if __name__ == '__main__':
+    from astrometry.util.ttime import Time, MemMeas
+    Time.add_measurement(MemMeas)
+    sys.exit(main())
@@ -0,0 +1,256 @@
+'''
+Per-key stage stores: an alternative to one pickle file per runbrick
+stage.
+
+astrometry.util.stages.runstage saves the whole result dict of a stage
+(tims with their pixels, blobmap, catalog, coadds, ...) as a single
+pickle, so resuming a brick -- or reading just "T" or "blobmap" from a
+stage -- means unpickling all of it.  A stage store is instead a
+directory with one file per top-level key:
+
+- numpy arrays (not object arrays) are saved as KEY.npy, and are
+  memory-mapped (copy-on-write) when loaded;
+- everything else is pickled, as KEY.pickle.
+
+A StageStore is a lazy dict: a key is only read when it is accessed.
+The *runstage* function here works like astrometry's runstage, but
+reads and writes stage stores.  When it is given *stage_inputs*,
+it passes each stage only the keys that stage consumes (plus the
+explicit keyword arguments).  Keys that a stage did not touch are
+hard-linked (or copied) from the previous stage's store rather than
+being loaded and written again.  An existing stage pickle is still
+read if there is no stage store, so pickles from earlier runs can be
+resumed.
+'''
+import os
+import pickle
+import shutil
+from collections.abc import MutableMapping
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.stagestore')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+_unloaded = object()
+
+def stage_store_dirname(picklefn):
+    '''
+    Returns the stage-store directory name for stage pickle filename
+    *picklefn*.
+    '''
+    if picklefn.endswith('.pickle'):
+        picklefn = picklefn[:-len('.pickle')]
+    return picklefn + '.store'
+
+def _is_npy(val):
+    # (arrays we loaded are np.memmap instances)
+    return type(val) in [np.ndarray, np.memmap] and not val.dtype.hasobject
+
+class StageStore(MutableMapping):
+    '''
+    A dict of stage results, backed by (optionally) a stage-store
+    directory *dirname*.  Values are loaded from the directory when
+    first accessed; values that are set are held in memory.
+    '''
+    def __init__(self, dirname=None):
+        self.dirname = dirname
+        self.vals = {}
+        if dirname is not None:
+            for fn in os.listdir(dirname):
+                key,ext = os.path.splitext(fn)
+                if ext in ['.npy', '.pickle']:
+                    self.vals[key] = _unloaded
+
+    def _filename(self, key):
+        for ext in ['.npy', '.pickle']:
+            fn = os.path.join(self.dirname, key + ext)
+            if os.path.exists(fn):
+                return fn
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        val = self.vals[key]
+        if val is _unloaded:
+            fn = self._filename(key)
+            debug('Stage store: loading', fn)
+            if fn.endswith('.npy'):
+                val = np.load(fn, mmap_mode='c')
+            else:
+                with open(fn, 'rb') as f:
+                    val = pickle.load(f)
+            self.vals[key] = val
+        return val
+
+    def __setitem__(self, key, val):
+        self.vals[key] = val
+
+    def __delitem__(self, key):
+        del self.vals[key]
+
+    def __iter__(self):
+        return iter(self.vals)
+
+    def __len__(self):
+        return len(self.vals)
+
+    def __repr__(self):
+        return 'StageStore(%s: %s)' % (self.dirname, ', '.join(
+            k + ('' if v is _unloaded else '*') for k,v in self.vals.items()))
+
+    def is_loaded(self, key):
+        return self.vals[key] is not _unloaded
+
+    def copy(self):
+        S = StageStore()
+        S.dirname = self.dirname
+        S.vals = self.vals.copy()
+        return S
+
+    def subset(self, keys):
+        '''
+        Returns a plain dict of the given *keys* (those that exist),
+        loading them if necessary.
+        '''
+        return dict([(k, self[k]) for k in keys if k in self.vals])
+
+    def write(self, dirname):
+        '''
+        Writes this store to directory *dirname*, replacing it if it
+        exists.  Values that have not been loaded are linked or copied
+        from this store's directory.
+        '''
+        tmpdir = dirname + '.tmp-%i' % os.getpid()
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+        for key,val in self.vals.items():
+            if val is _unloaded:
+                src = self._filename(key)
+                dst = os.path.join(tmpdir, os.path.basename(src))
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copyfile(src, dst)
+            elif _is_npy(val):
+                np.save(os.path.join(tmpdir, key + '.npy'), np.asarray(val))
+            else:
+                with open(os.path.join(tmpdir, key + '.pickle'), 'wb') as f:
+                    pickle.dump(val, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(dirname):
+            old = dirname + '.old-%i' % os.getpid()
+            os.rename(dirname, old)
+            os.rename(tmpdir, dirname)
+            shutil.rmtree(old)
+        else:
+            os.rename(tmpdir, dirname)
+        # All our keys are now in *dirname*.
+        self.dirname = dirname
+
+def read_stage(picklefn):
+    '''
+    Returns the saved results of a stage: a StageStore if the stage
+    store for *picklefn* exists, or else the unpickled dict; or None.
+    '''
+    dirname = stage_store_dirname(picklefn)
+    if os.path.isdir(dirname):
+        info('Reading stage store', dirname)
+        return StageStore(dirname)
+    if os.path.exists(picklefn):
+        from astrometry.util.file import unpickle_from_file
+        info('Reading pickle', picklefn)
+        return unpickle_from_file(picklefn)
+    return None
+
+def stage_arg_names(func):
+    '''
+    Returns the set of named parameters of stage function *func* --
+    the keys it consumes -- or None if they can't be determined.
+    '''
+    import inspect
+    try:
+        sig = inspect.signature(func)
+    except (TypeError, ValueError):
+        return None
+    names = set([p.name for p in sig.parameters.values()
+                 if p.kind in [p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY]])
+    if len(names) == 0:
+        return None
+    return names
+
+def runstage(stage, picklepat, stagefunc, force=None, forceall=False,
+             prereqs=None, update=True, write=True, initial_args=None,
+             stage_inputs=None, **kwargs):
+    '''
+    Like astrometry.util.stages.runstage, but saving stage results as
+    stage stores.
+
+    *stage_inputs*: None, or a function stage -> set of keys consumed
+     by the stage (or None for all keys).
+    '''
+    if force is None:
+        force = []
+    if prereqs is None:
+        prereqs = {}
+    if initial_args is None:
+        initial_args = {}
+
+    picklefn = picklepat % dict(stage=stage)
+    if not (forceall or stage in force):
+        R = read_stage(picklefn)
+        if R is not None:
+            return R
+    elif os.path.exists(stage_store_dirname(picklefn)):
+        info('Ignoring stage store for', stage, 'and forcing stage')
+
+    prereq = prereqs.get(stage, None)
+    if prereq is None:
+        P = StageStore()
+        P.update(initial_args)
+    else:
+        P = runstage(prereq, picklepat, stagefunc, force=force,
+                     forceall=forceall, prereqs=prereqs, update=update,
+                     write=write, initial_args=initial_args,
+                     stage_inputs=stage_inputs, **kwargs)
+        if not isinstance(P, StageStore):
+            # (read from a pickle)
+            S = StageStore()
+            S.update(P)
+            P = S
+
+    keys = None
+    if stage_inputs is not None:
+        keys = stage_inputs(stage)
+    if keys is None:
+        Px = P.subset(P.keys())
+    else:
+        Px = P.subset(keys)
+        debug('Stage', stage, 'consumes', ', '.join(sorted(Px.keys())))
+    Px.update(kwargs)
+    info('Running stage', stage)
+    R = stagefunc(stage, **Px)
+    info('Stage', stage, 'finished')
+
+    if update:
+        P = P.copy()
+        if R is not None:
+            P.update(R)
+        R = P
+
+    if write is True or (hasattr(write, '__contains__') and stage in write):
+        if not isinstance(R, StageStore):
+            S = StageStore()
+            S.update(R)
+            R = S
+        dirname = stage_store_dirname(picklefn)
+        info('Writing stage store', dirname)
+        d = os.path.dirname(dirname)
+        if len(d):
+            os.makedirs(d, exist_ok=True)
+        R.write(dirname)
+    return R
@@ -407,30 +407,48 @@ def get_version_header(program_name, survey_dir, release, git_version=None):
                         comment='SLURM job array id'))
     return hdr
 
+class _InstalledPackage(object):
+    '''
+    Stands in for a package module, for get_dependency_versions, with
+    the version from the installed package's metadata.
+    '''
+    def __init__(self, name):
+        from importlib.metadata import version
+        self.__version__ = version(name)
+
+def _dependency_module(name):
+    # The package module if it is already imported; else its installed
+    # version, so that recording the versions of large packages (eg,
+    # matplotlib, photutils) does not import them.
+    import sys
+    import importlib
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        return _InstalledPackage(name)
+    except Exception:
+        return importlib.import_module(name)
+
 def get_dependency_versions(unwise_dir, unwise_tr_dir, unwise_modelsky_dir, galex_dir):
     import astrometry
-    import astropy
-    import matplotlib
     try:
         import mkl_fft
     except ImportError:
         mkl_fft = None
-    import photutils
     import tractor
-    import scipy
     import unwise_psf
 
     depvers = []
     headers = []
     default_ver = 'UNAVAILABLE'
     for name,pkg in [('astrometry', astrometry),
-                     ('astropy', astropy),
+                     ('astropy', _dependency_module('astropy')),
                      ('fitsio', fitsio),
-                     ('matplotlib', matplotlib),
+                     ('matplotlib', _dependency_module('matplotlib')),
                      ('mkl_fft', mkl_fft),
                      ('numpy', np),
-                     ('photutils', photutils),
-                     ('scipy', scipy),
+                     ('photutils', _dependency_module('photutils')),
+                     ('scipy', _dependency_module('scipy')),
                      ('tractor', tractor),
                      ('unwise_psf', unwise_psf),
                      ]:
@@ -491,18 +509,23 @@ def get_dependency_versions(unwise_dir, unwise_tr_dir, unwise_modelsky_dir, gale
     return headers
 
 def tim_get_resamp(tim, targetwcs):
-    from astrometry.util.resample import resample_with_wcs,OverlapError
+    '''
+    Returns a ResampleMap (which unpacks as Yo,Xo,Yi,Xi) from *tim*
+    to *targetwcs*, or None if they do not overlap.
+    '''
+    from astrometry.util.resample import OverlapError
+    from legacypipe.resampmap import resample_map_with_wcs
 
     if hasattr(tim, 'resamp'):
         return tim.resamp
     try:
-        Yo,Xo,Yi,Xi,_ = resample_with_wcs(targetwcs, tim.subwcs, intType=np.int16)
+        R,_ = resample_map_with_wcs(targetwcs, tim.subwcs, intType=np.int16)
     except OverlapError:
         debug('No overlap between tim', tim.name, 'and target WCS')
         return None
-    if len(Yo) == 0:
+    if len(R) == 0:
         return None
-    return Yo,Xo,Yi,Xi
+    return R
 
 
 def sdss_rgb(imgs, bands, scales=None, m=0.03, Q=20, mnmx=None):
@@ -772,6 +795,10 @@ class LegacySurveyData(object):
 
         self.psfex_conf = None
 
+        # Optional node-local cache of decompressed image pixels
+        # (a legacypipe.pixcache.PixelCache object)
+        self.pixel_cache = None
+
         # Cached CCD kd-tree --
         # - initially None, then a list of (fn, kd)
         self.ccd_kdtrees = None
@@ -1635,6 +1662,20 @@ def run_calibs(X):
         if not noraise:
             raise
 
+def run_exposure_calibs(X):
+    from legacypipe.image import run_exposure_calibs as run_exp
+    survey, ccds, kwargs = X
+    noraise = kwargs.pop('noraise', False)
+    debug('run_exposure_calibs for expnum', ccds.expnum[0], ':', kwargs)
+    try:
+        return run_exp(survey, ccds, **kwargs)
+    except:
+        print('Exception in run_exposure_calibs:', ccds.expnum[0], kwargs)
+        import traceback
+        traceback.print_exc()
+        if not noraise:
+            raise
+
 def read_one_tim(X):
     from astrometry.util.ttime import Time
     (im, targetrd, kwargs) = X
@@ -0,0 +1,276 @@
+'''
+A local-file task queue with the same interface that our production
+scripts (farm.py, etc) use from QDO, for running on nodes or laptops
+where the QDO PostgreSQL server is not available.
+
+The queue is a single SQLite database file.  It is opened in WAL
+(write-ahead log) mode so that readers do not block the writer, and
+tasks are claimed with an atomic "BEGIN IMMEDIATE ... UPDATE" so that
+many processes on a node can pull tasks concurrently.
+
+Usage is like QDO:
+
+    from legacypipe.taskqueue import connect, Task
+    q = connect('bricks.sqlite')
+    task = q.get(timeout=10)
+    ...
+    task.set_state(Task.SUCCEEDED)
+
+and from the command line,
+
+    python -m legacypipe.taskqueue load bricks.sqlite bricks.txt
+    python -m legacypipe.taskqueue status bricks.sqlite
+    python -m legacypipe.taskqueue retry bricks.sqlite
+
+'''
+import os
+import time
+import sqlite3
+
+class Task(object):
+    '''
+    A task (eg, a brick name) pulled from the queue; mirrors qdo.Task.
+    '''
+    WAITING   = 'Waiting'
+    PENDING   = 'Pending'
+    RUNNING   = 'Running'
+    SUCCEEDED = 'Succeeded'
+    FAILED    = 'Failed'
+    VALID_STATES = [WAITING, PENDING, RUNNING, SUCCEEDED, FAILED]
+
+    def __init__(self, queue, id, task, state, priority=0, nretry=0):
+        self.queue = queue
+        self.id = id
+        self.task = task
+        self.state = state
+        self.priority = priority
+        self.nretry = nretry
+
+    def set_state(self, state, err=0, message=None):
+        self.queue.set_task_state(self.id, state, err=err, message=message)
+        self.state = state
+
+    def __repr__(self):
+        return 'Task(%i, %r, %s)' % (self.id, self.task, self.state)
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    task     TEXT NOT NULL,
+    state    TEXT NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,
+    nretry   INTEGER NOT NULL DEFAULT 0,
+    err      INTEGER,
+    message  TEXT,
+    jobid    TEXT,
+    tstart   REAL,
+    tend     REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, priority, id);
+'''
+
+class Queue(object):
+    '''
+    A queue of tasks stored in an SQLite file; mirrors qdo.Queue.
+
+    *max_retries*: a task that is marked FAILED is put back into the
+    PENDING state until it has failed this many times.
+    '''
+    def __init__(self, filename, max_retries=0, busy_timeout=60.):
+        self.filename = filename
+        self.name = os.path.basename(filename)
+        self.max_retries = max_retries
+        # isolation_level=None: we manage transactions ourselves.
+        self.db = sqlite3.connect(filename, timeout=busy_timeout,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(_schema)
+        self.jobid = _get_jobid()
+
+    def close(self):
+        self.db.close()
+
+    def add(self, task, priority=0, state=Task.PENDING):
+        return self.add_multiple([task], priority=priority, state=state)[0]
+
+    def add_multiple(self, tasks, priority=0, state=Task.PENDING):
+        assert(state in Task.VALID_STATES)
+        ids = []
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for t in tasks:
+                c = db.execute('INSERT INTO tasks (task, state, priority) '
+                               'VALUES (?,?,?)', (t, state, priority))
+                ids.append(c.lastrowid)
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        return ids
+
+    def get(self, timeout=None, poll=1.):
+        '''
+        Claims the highest-priority PENDING task and marks it RUNNING.
+        If no task is pending, waits up to *timeout* seconds for one to
+        appear; returns None if there are none.
+        '''
+        t0 = time.time()
+        while True:
+            task = self._claim()
+            if task is not None:
+                return task
+            if timeout is None or time.time() - t0 >= timeout:
+                return None
+            time.sleep(poll)
+
+    def _claim(self):
+        db = self.db
+        # BEGIN IMMEDIATE takes the write lock up front, so the
+        # SELECT + UPDATE below cannot race with another process.
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT id, task, priority, nretry FROM tasks '
+                             'WHERE state=? ORDER BY priority DESC, id LIMIT 1',
+                             (Task.PENDING,)).fetchone()
+            if row is not None:
+                db.execute('UPDATE tasks SET state=?, jobid=?, tstart=?, tend=NULL '
+                           'WHERE id=?',
+                           (Task.RUNNING, self.jobid, time.time(), row[0]))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        tid, task, priority, nretry = row
+        return Task(self, tid, task, Task.RUNNING, priority=priority,
+                    nretry=nretry)
+
+    def set_task_state(self, taskid, state, err=0, message=None):
+        assert(state in Task.VALID_STATES)
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if state == Task.FAILED:
+                (nretry,) = db.execute('SELECT nretry FROM tasks WHERE id=?',
+                                       (taskid,)).fetchone()
+                nretry += 1
+                if nretry <= self.max_retries:
+                    state = Task.PENDING
+                db.execute('UPDATE tasks SET state=?, nretry=?, err=?, message=?, '
+                           'tend=? WHERE id=?',
+                           (state, nretry, err, message, time.time(), taskid))
+            else:
+                db.execute('UPDATE tasks SET state=?, err=?, message=?, tend=? '
+                           'WHERE id=?',
+                           (state, err, message, time.time(), taskid))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def _move(self, fromstate, tostate):
+        c = self.db.execute('UPDATE tasks SET state=? WHERE state=?',
+                            (tostate, fromstate))
+        return c.rowcount
+
+    def retry(self):
+        '''Resets FAILED tasks to PENDING; returns the number reset.'''
+        return self._move(Task.FAILED, Task.PENDING)
+
+    def recover(self):
+        '''Resets RUNNING tasks (eg, from killed jobs) to PENDING.'''
+        return self._move(Task.RUNNING, Task.PENDING)
+
+    def tasks(self, state=None):
+        q = 'SELECT id, task, state, priority, nretry FROM tasks'
+        args = ()
+        if state is not None:
+            q += ' WHERE state=?'
+            args = (state,)
+        return [Task(self, *row) for row in
+                self.db.execute(q + ' ORDER BY id', args)]
+
+    def status(self):
+        '''Returns a dict of state -> number of tasks.'''
+        counts = dict([(s,0) for s in Task.VALID_STATES])
+        for state,n in self.db.execute('SELECT state, COUNT(*) FROM tasks '
+                                       'GROUP BY state'):
+            counts[state] = n
+        return counts
+
+def _get_jobid():
+    import socket
+    jid = os.environ.get('SLURM_JOB_ID', '')
+    return '%s_%s_pid%i' % (jid, socket.gethostname(), os.getpid())
+
+def connect(filename, max_retries=0, create_ok=True):
+    '''
+    Opens (and by default creates) the SQLite task queue *filename*.
+    '''
+    if not create_ok and not os.path.exists(filename):
+        raise ValueError('Queue file does not exist: %s' % filename)
+    return Queue(filename, max_retries=max_retries)
+
+def is_local_queue(name):
+    '''
+    Returns True if the given queue name refers to a local SQLite
+    queue file (rather than a QDO queue name).
+    '''
+    return (name.endswith('.sqlite') or name.endswith('.db') or
+            os.sep in name)
+
+def connect_queue(queuename, max_retries=0):
+    '''
+    Returns (queue, Task) for either a local SQLite queue file or a
+    QDO queue, which share the same interface.
+    '''
+    if is_local_queue(queuename):
+        return connect(queuename, max_retries=max_retries), Task
+    import qdo
+    return qdo.connect(queuename), qdo.Task
+
+def main():
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description='Local SQLite task queue')
+    parser.add_argument('command', choices=['load', 'status', 'retry', 'recover', 'list'])
+    parser.add_argument('queue', help='Queue filename')
+    parser.add_argument('taskfile', nargs='?',
+                        help='For "load": file of tasks, one per line ("-" for stdin)')
+    parser.add_argument('--priority', type=float, default=0,
+                        help='For "load": task priority')
+    parser.add_argument('--state', default=None,
+                        help='For "list": only list tasks in this state')
+    opt = parser.parse_args()
+
+    q = connect(opt.queue, create_ok=(opt.command == 'load'))
+    if opt.command == 'load':
+        if opt.taskfile is None:
+            parser.print_help()
+            return -1
+        if opt.taskfile == '-':
+            f = sys.stdin
+        else:
+            f = open(opt.taskfile)
+        tasks = [line.strip() for line in f]
+        tasks = [t for t in tasks if len(t) and not t.startswith('#')]
+        q.add_multiple(tasks, priority=opt.priority)
+        print('Added', len(tasks), 'tasks to', opt.queue)
+    elif opt.command == 'status':
+        for state,n in q.status().items():
+            print('%-10s %i' % (state, n))
+    elif opt.command == 'retry':
+        print('Reset', q.retry(), 'failed tasks')
+    elif opt.command == 'recover':
+        print('Reset', q.recover(), 'running tasks')
+    elif opt.command == 'list':
+        for t in q.tasks(state=opt.state):
+            print(t.id, t.task, t.state, t.nretry)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
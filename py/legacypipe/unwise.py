@@ -28,13 +28,19 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
                       pixelized_psf=False,
                       get_masks=None,
                       move_crpix=False,
-                      modelsky_dir=None):
+                      modelsky_dir=None,
+                      patch_cache=None):
     '''
     Given a list of tractor sources *cat*
     and a list of unWISE tiles *tiles* (a fits_table with RA,Dec,coadd_id)
     runs forced photometry, returning a FITS table the same length as *cat*.
 
     *get_masks*: the WCS to resample mask bits into.
+
+    *patch_cache*: a dict; if given (and no model images are wanted),
+    solve for the fluxes directly using unit-flux model patches that
+    are rendered once per tile and kept in this dict, for reuse by
+    later calls on the same tiles (see unwise_epochs_phot).
     '''
     from tractor import PointSource, Tractor, ExpGalaxy, DevGalaxy
     from tractor.sersic import SersicGalaxy
@@ -398,37 +404,40 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             src.halfsize = int(np.hypot(R, galrad * 5 / pixscale))
     debug('Set WISE source sizes:', nbig, 'big', nmedium, 'medium', nsmall, 'small')
 
-    tractor = Tractor(tims, cat)
-    if use_ceres:
-        from tractor.ceres_optimizer import CeresOptimizer
-        tractor.optimizer = CeresOptimizer(BW=ceres_block, BH=ceres_block)
-    tractor.freezeParamsRecursive('*')
-    tractor.thawPathsTo(wanyband)
-
-    t0 = Time()
-    R = tractor.optimize_forced_photometry(
-        fitstats=True, variance=True, shared_params=False, wantims=wantims)
-    info('unWISE forced photometry took', Time() - t0)
-
-    if use_ceres:
-        term = R.ceres_status['termination']
-        # Running out of memory can cause failure to converge and term
-        # status = 2.  Fail completely in this case.
-        if term != 0:
-            info('Ceres termination status:', term)
-            raise RuntimeError('Ceres terminated with status %i' % term)
-
-    if wantims:
-        ims1 = R.ims1
-        # can happen if empty source list (we still want to generate coadds)
-        if ims1 is None:
-            ims1 = R.ims0
-
-    flux_invvars = R.IV
-    if R.fitstats is not None:
-        for k in fskeys:
-            x = getattr(R.fitstats, k)
-            fitstats[k] = np.array(x).astype(np.float32)
+    if patch_cache is not None and not wantims:
+        t0 = Time()
+        nm,flux_invvars,fitstats = _forced_phot_cached_patches(
+            tims, cat, wanyband, patch_cache)
+        info('unWISE forced photometry (cached patches) took', Time() - t0)
+    else:
+        t0 = Time()
+        R = None
+        if use_ceres:
+            try:
+                R = _unwise_optimize(tims, cat, wanyband, wantims,
+                                     ceres_block=ceres_block)
+            except:
+                import traceback
+                print('unWISE forced photometry with Ceres failed:')
+                traceback.print_exc()
+                # Keep the tims; just re-solve without Ceres.
+                info('Re-solving without Ceres...')
+        if R is None:
+            R = _unwise_optimize(tims, cat, wanyband, wantims)
+        info('unWISE forced photometry took', Time() - t0)
+
+        if wantims:
+            ims1 = R.ims1
+            # can happen if empty source list (we still want to generate coadds)
+            if ims1 is None:
+                ims1 = R.ims0
+
+        flux_invvars = R.IV
+        if R.fitstats is not None:
+            for k in fskeys:
+                x = getattr(R.fitstats, k)
+                fitstats[k] = np.array(x).astype(np.float32)
+        nm = np.array([src.getBrightness().getBand(wanyband) for src in cat])
 
     if save_fits:
         for i,tim in enumerate(tims):
@@ -495,7 +504,6 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             plt.title('%s: chi' % tag)
             ps.savefig()
 
-    nm = np.array([src.getBrightness().getBand(wanyband) for src in cat])
     nm_ivar = flux_invvars
     # Sources out of bounds, eg, never change from their initial
     # fluxes.  Zero them out instead.
@@ -521,6 +529,148 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
 class wphotduck(object):
     pass
 
+def _unwise_optimize(tims, cat, band, wantims, ceres_block=None):
+    '''
+    Runs forced photometry of *cat* (the fluxes in *band*) on *tims*,
+    with the Ceres optimizer if *ceres_block* is set.  If the
+    optimization fails, the initial fluxes are restored before
+    raising, so that the caller can re-solve with another optimizer.
+    '''
+    from tractor import Tractor
+    tractor = Tractor(tims, cat)
+    if ceres_block:
+        from tractor.ceres_optimizer import CeresOptimizer
+        tractor.optimizer = CeresOptimizer(BW=ceres_block, BH=ceres_block)
+    tractor.freezeParamsRecursive('*')
+    tractor.thawPathsTo(band)
+    p0 = tractor.getParams()
+    try:
+        R = tractor.optimize_forced_photometry(
+            fitstats=True, variance=True, shared_params=False, wantims=wantims)
+        if ceres_block:
+            term = R.ceres_status['termination']
+            # Running out of memory can cause failure to converge and term
+            # status = 2.  Fail completely in this case.
+            if term != 0:
+                info('Ceres termination status:', term)
+                raise RuntimeError('Ceres terminated with status %i' % term)
+    except:
+        tractor.setParams(p0)
+        raise
+    return R
+
+def _render_unit_patches(tim, cat, band):
+    '''
+    Renders the unit-flux model of each source in *cat* into *tim*.
+    Returns (pix, isrc, val, counts): flat pixel indices, source
+    indices, and model values of the non-zero model pixels, and the
+    counts for unit flux.
+    '''
+    h,w = tim.shape
+    pix,isrc,val = [],[],[]
+    counts = 1.
+    for i,src in enumerate(cat):
+        src.getBrightness().setBand(band, 1.)
+        if i == 0:
+            counts = tim.getPhotoCal().brightnessToCounts(src.getBrightness())
+        p = src.getModelPatch(tim)
+        if p is None or p.patch is None:
+            continue
+        iy,ix = np.nonzero(p.patch)
+        v = p.patch[iy,ix]
+        ix += p.x0
+        iy += p.y0
+        K = np.flatnonzero((ix >= 0) * (ix < w) * (iy >= 0) * (iy < h))
+        pix.append(iy[K] * w + ix[K])
+        isrc.append(np.zeros(len(K), np.int32) + i)
+        val.append(v[K])
+    if len(pix) == 0:
+        return (np.zeros(0, int), np.zeros(0, np.int32), np.zeros(0), counts)
+    return (np.concatenate(pix), np.concatenate(isrc), np.concatenate(val),
+            counts)
+
+def _forced_phot_cached_patches(tims, cat, band, patch_cache):
+    '''
+    Forced photometry of the sources *cat* in *tims*, solved directly
+    as a sparse linear least-squares problem for the fluxes, using
+    unit-flux model patches from (or rendered into) *patch_cache*,
+    keyed by tile and region.  The patches do not depend on the pixel
+    values, so they can be reused for other images on the same pixel
+    grid with the same PSF (the time-resolved epochs of a tile).
+
+    Returns (flux, flux_ivar, fitstats) like
+    Tractor.optimize_forced_photometry.
+    '''
+    from scipy.sparse import csc_matrix
+    from scipy.sparse.linalg import lsqr
+
+    N = len(cat)
+    rows,cols,vals,b = [],[],[],[]
+    timpatches = []
+    npix = 0
+    for tim in tims:
+        key = (tim.tile.coadd_id, tuple(tim.roi))
+        P = patch_cache.get(key)
+        if P is None:
+            P = _render_unit_patches(tim, cat, band)
+            patch_cache[key] = P
+        else:
+            debug('Reusing model patches for tile', tim.tile.coadd_id)
+        pix,isrc,val,_ = P
+        h,w = tim.shape
+        ie = tim.getInvError().ravel()
+        sky = np.zeros(tim.shape, np.float32)
+        tim.getSky().addTo(sky)
+        resid = tim.getImage().ravel() - sky.ravel()
+        wt = ie[pix]
+        K = np.flatnonzero(wt > 0)
+        rows.append(npix + pix[K])
+        cols.append(isrc[K])
+        vals.append(val[K] * wt[K])
+        b.append(resid * ie)
+        timpatches.append((resid, ie, P))
+        npix += h*w
+
+    flux = np.zeros(N)
+    flux_ivar = np.zeros(N, np.float32)
+    fitstats = {}
+    if N == 0 or npix == 0:
+        return flux, flux_ivar, fitstats
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    vals = np.concatenate(vals)
+    b = np.concatenate(b)
+
+    iv = np.bincount(cols, weights=vals**2, minlength=N)
+    J = np.flatnonzero(iv > 0)
+    if len(J):
+        # Solve for the fluxes of the sources that touch any pixels,
+        # with the columns scaled to unit norm for conditioning.
+        jmap = np.zeros(N, int)
+        jmap[J] = np.arange(len(J))
+        scale = 1. / np.sqrt(iv[J])
+        A = csc_matrix((vals * scale[jmap[cols]], (rows, jmap[cols])),
+                       shape=(npix, len(J)))
+        x = lsqr(A, b, atol=1e-12, btol=1e-12, iter_lim=10*len(J))[0]
+        flux[J] = x * scale
+    flux_ivar[:] = iv
+
+    # Profile-weighted chi-squared and fraction of flux from other sources
+    prochi2 = np.zeros(N)
+    profracflux = np.zeros(N)
+    for resid,ie,(pix,isrc,val,counts) in timpatches:
+        mod = np.bincount(pix, weights=val * flux[isrc], minlength=len(resid))
+        chi = (resid - mod) * ie
+        u = np.abs(val / counts)
+        prochi2 += np.bincount(isrc, weights=u * chi[pix]**2, minlength=N)
+        f = np.abs(flux[isrc] * counts)
+        K = np.flatnonzero(f > 0)
+        profracflux += np.bincount(isrc[K], weights=(np.abs(mod[pix[K]]) / f[K] - u[K]) * u[K],
+                                   minlength=N)
+    fitstats.update(prochi2=prochi2.astype(np.float32),
+                    profracflux=profracflux.astype(np.float32))
+    return flux, flux_ivar, fitstats
+
 def radec_in_unique_area(rr, dd, ra1, ra2, dec1, dec2):
     ''' Returns a boolean array. '''
     unique = (dd >= dec1) * (dd < dec2)
@@ -533,7 +683,7 @@ def radec_in_unique_area(rr, dd, ra1, ra2, dec1, dec2):
         unique[rr < 180] *= (rr[rr < 180] <  ra2)
     return unique
 
-def unwise_phot(X):
+def unwise_phot(X, patch_cache=None):
     '''
     This is the entry-point from runbrick.py, called via mp.map()
     '''
@@ -544,12 +694,16 @@ def unwise_phot(X):
                   modelsky_dir=modelsky_dir)
     if get_mods:
         kwargs.update(get_models=get_mods)
+    if patch_cache is not None:
+        kwargs.update(patch_cache=patch_cache)
 
     if wise_ceres and len(wcat) == 0:
         wise_ceres = False
 
     # DEBUG
     #kwargs.update(save_fits=True)
+    # (A Ceres failure is handled inside unwise_forcedphot, by
+    # re-solving without Ceres using the tims it has already read.)
     W = None
     try:
         W = unwise_forcedphot(wcat, tiles, use_ceres=wise_ceres, **kwargs)
@@ -557,15 +711,22 @@ def unwise_phot(X):
         import traceback
         print('unwise_forcedphot failed:')
         traceback.print_exc()
-        if wise_ceres:
-            print('Trying without Ceres...')
-            try:
-                W = unwise_forcedphot(wcat, tiles, use_ceres=False, **kwargs)
-            except:
-                print('unwise_forcedphot failed (2):')
-                traceback.print_exc()
     return key,W
 
+def unwise_epochs_phot(X):
+    '''
+    Entry-point from runbrick.py for photometering all the
+    time-resolved epochs of one band in one task: *X* is (key, list
+    of unwise_phot arguments).  The epochs of a tile share its pixel
+    grid and PSF, so each source's model patch is rendered once per
+    tile (in the first epoch that touches it, which also sets the
+    patch sizes) and only the linear flux problem is solved for each
+    epoch.  Returns (key, list of unwise_phot results).
+    '''
+    key,eargs = X
+    patch_cache = {}
+    return key, [unwise_phot(a, patch_cache=patch_cache) for a in eargs]
+
 def collapse_unwise_bitmask(bitmask, band):
     '''
     Converts WISE mask bits (in the unWISE data products) into the
@@ -40,8 +40,18 @@ def annotate(ccds, survey, mp=None, mzls=False, bass=False, normalizePsf=True,
         tileid_to_index[:] = -1
         tileid_to_index[tiles.tileid] = np.arange(len(tiles))
 
-    anns = mp.map(annotate_one_ccd, [
-        (ccd, survey, normalizePsf, carryOn) for ccd in ccds])
+    # Group the CCDs by exposure, so that each task reads the merged
+    # calibration files once for all of its CCDs.
+    exps = {}
+    for i,key in enumerate(zip(ccds.camera, ccds.expnum)):
+        exps.setdefault(key, []).append(i)
+    expinds = [np.array(I) for I in exps.values()]
+    expanns = mp.map(annotate_one_exposure, [
+        (ccds[I], survey, normalizePsf, carryOn) for I in expinds])
+    anns = [None] * len(ccds)
+    for I,ea in zip(expinds, expanns):
+        for i,ann in zip(I, ea):
+            anns[i] = ann
 
     gaussgalnorm = np.zeros(len(ccds), np.float32)
     for iccd,ann in enumerate(anns):
@@ -105,7 +115,72 @@ def annotate(ccds, survey, mp=None, mzls=False, bass=False, normalizePsf=True,
     for X in [ccds.psfdepth, ccds.galdepth, ccds.gausspsfdepth, ccds.gaussgaldepth]:
         X[np.logical_not(np.isfinite(X))] = 0.
 
-def annotate_one_ccd(X):
+def annotate_one_exposure(X):
+    '''
+    Annotates the CCDs (of one exposure) *ccds*, reading the merged
+    PsfEx and sky files once for all of them.
+    '''
+    ccds, survey, normalizePsf, carryOn = X
+    calib_tables = {}
+    try:
+        im = survey.get_image_object(ccds[0])
+        for fn in [im.merged_psffn, im.merged_skyfn]:
+            if os.path.exists(fn):
+                calib_tables[fn] = fits_table(fn)
+    except:
+        # Each CCD will try (and report) again.
+        print('Failed to read merged calibration files for expnum', ccds.expnum[0])
+        import traceback
+        traceback.print_exc()
+    return [annotate_one_ccd((ccd, survey, normalizePsf, carryOn),
+                             calib_tables=calib_tables)
+            for ccd in ccds]
+
+def psf_norms(im, tim, xx, yy):
+    '''
+    Returns the PSF norms (as from im.psf_norm() with tim.psf set to
+    the constant PSF at each position) at pixel positions *xx*, *yy*,
+    for a PsfEx PSF model, or None if that can't be done here.
+
+    The PsfEx images at all positions come from one polynomial
+    evaluation, and the sub-pixel shifts (which smooth the PSF, and so
+    reduce its norm) are done with Lanczos interpolation for all
+    positions at once.  The result is checked against im.psf_norm() at
+    one position.
+    '''
+    from legacyzpts.psfphot import psf_images_at, render_psf_models
+    from legacypipe.image import NormalizedPixelizedPsfEx
+    psf = tim.psf
+    if getattr(psf, 'psfex', None) is None:
+        return None
+    try:
+        imgs = psf_images_at(psf, xx, yy)
+    except Exception:
+        return None
+    if isinstance(psf, NormalizedPixelizedPsfEx):
+        # (the polynomial fit to the normalized images is not exact)
+        imgs = imgs / np.sum(imgs, axis=(1,2))[:,np.newaxis,np.newaxis]
+    P = imgs.shape[1]
+    if imgs.shape[2] != P:
+        return None
+    dx = xx - np.round(xx)
+    dy = yy - np.round(yy)
+    mods,_,_ = render_psf_models(imgs, P//2 + dx, P//2 + dy, P)
+    norms = np.sqrt(np.sum(mods**2, axis=(1,2)))
+
+    i = len(xx) // 2
+    tim.psf = psf.constantPsfAt(xx[i], yy[i])
+    try:
+        direct = im.psf_norm(tim, x=xx[i], y=yy[i])
+    finally:
+        tim.psf = psf
+    if not np.isclose(norms[i], direct, rtol=1e-4):
+        print('Warning: vectorized PSF norm', norms[i], 'does not match', direct,
+              '; computing per position')
+        return None
+    return norms
+
+def annotate_one_ccd(X, calib_tables=None):
     ccd, survey, normalizePsf, carryOn = X
     print('Annotating CCD', ccd.image_filename.strip(), 'expnum', ccd.expnum,
           'CCD', ccd.ccdname)
@@ -120,6 +195,8 @@ def annotate_one_ccd(X):
             return result
         else:
             raise
+    if calib_tables:
+        im.calib_tables = calib_tables
 
     X = im.get_good_image_subregion()
     reg = [-1,-1,-1,-1]
@@ -182,12 +259,22 @@ def annotate_one_ccd(X):
     xx = np.linspace(1+S, W-S, 5)
     yy = np.linspace(1+S, H-S, 5)
     xx,yy = np.meshgrid(xx, yy)
+    xx = xx.ravel()
+    yy = yy.ravel()
+    allpsfnorms = None
+    try:
+        allpsfnorms = psf_norms(im, tim, xx, yy)
+    except:
+        pass
     psfnorms = []
     galnorms = []
-    for x,y in zip(xx.ravel(), yy.ravel()):
+    for i,(x,y) in enumerate(zip(xx, yy)):
         tim.psf = psf.constantPsfAt(x, y)
         try:
-            p = im.psf_norm(tim, x=x, y=y)
+            if allpsfnorms is None:
+                p = im.psf_norm(tim, x=x, y=y)
+            else:
+                p = allpsfnorms[i]
             g = im.galaxy_norm(tim, x=x, y=y)
             psfnorms.append(p)
             galnorms.append(g)
@@ -248,6 +248,10 @@ class Measurer(object):
         sn_min,sn_max: if not None then then {min,max} S/N will be enforced from
             aperture photoemtry, where S/N = apflux/sqrt(skyflux)
     """
+    # Radius (in degrees) around the boresight that contains the whole
+    # focal plane, for reading the reference catalogs once per
+    # exposure (see read_exposure_refcats); None to read them per CCD.
+    focalplane_radius = None
 
     def __init__(self, fn, image_dir='images',
                  calibrate=False, quiet=False,
@@ -263,6 +267,9 @@ class Measurer(object):
         self.debug= kwargs.get('debug')
         self.outdir= kwargs.get('outdir')
         self.calibdir = kwargs.get('calibdir')
+        # Fit the reference stars all at once, rather than with a
+        # Tractor per star?
+        self.batch_psfphot = kwargs.get('batch_psfphot', True)
 
         self.calibrate = calibrate
 
@@ -642,7 +649,90 @@ class Measurer(object):
         # Formerly we grabbed the PsfEx FWHM; instead just use the CP value!
         ccds['fwhm'] = ccds['fwhm_cp']
 
-    def run(self, ext=None, save_xy=False, splinesky=False, survey=None):
+    def read_exposure_refcats(self, extlist):
+        '''
+        Reads the PS1 and Gaia catalogs once for the whole focal plane
+        of this exposure (within *focalplane_radius* of the
+        boresight), rather than reading the (same) catalog files for
+        every CCD, and cuts out the stars in each of the CCDs
+        *extlist*.
+
+        Returns a dict, ext -> {name: catalog}, of reference stars to
+        pass to run().  A catalog is missing if it could not be read
+        for the exposure, or the CCD is not inside the exposure
+        footprint; run() then reads it for the CCD.
+        '''
+        if self.focalplane_radius is None:
+            return {}
+        from astrometry.libkd.spherematch import tree_build_radec
+        refs = {}
+        try:
+            ps1 = ps1cat().get_catalog_radec_radius(
+                self.ra_bore, self.dec_bore, self.focalplane_radius)
+            refs['ps1'] = ps1
+            print('Read', len(ps1), 'PS1 stars for the exposure')
+        except OSError as e:
+            # eg, at the edge of the PS1 footprint; read per CCD.
+            print('Failed to read PS1 stars for the exposure:', e)
+        gaia = GaiaCatalog().get_catalog_radec_radius(
+            self.ra_bore, self.dec_bore, self.focalplane_radius)
+        refs['gaia'] = gaia
+        print('Read', len(gaia), 'Gaia stars for the exposure')
+
+        trees = dict([(name, tree_build_radec(cat.ra, cat.dec))
+                      for name,cat in refs.items() if len(cat)])
+        ccdrefs = {}
+        for ext in extlist:
+            self.set_hdu(ext)
+            ccdrefs[ext] = {}
+            for name,cat in refs.items():
+                cat = self.cut_exposure_refcat(name, cat, trees.get(name))
+                if cat is not None:
+                    ccdrefs[ext][name] = cat
+        return ccdrefs
+
+    def cut_exposure_refcat(self, name, cat, kd):
+        '''
+        Returns the stars in this CCD from exposure catalog *cat* (with
+        kd-tree *kd*, or None if it is empty), or None if the CCD is
+        not inside the exposure footprint.
+        '''
+        from astrometry.util.starutil_numpy import degrees_between
+        from astrometry.libkd.spherematch import tree_search_radec
+        from legacypipe.ps1cat import cut_catalog_to_wcs
+        margin = 10
+        W,H = self.wcs.get_width(), self.wcs.get_height()
+        rc,dc = self.wcs.pixelxy2radec((W+1)/2., (H+1)/2.)
+        # radius of the CCD, plus margin
+        rad = 1.1 * np.hypot(W + 2*margin, H + 2*margin) / 2. * self.pixscale / 3600.
+        if (degrees_between(rc, dc, self.ra_bore, self.dec_bore) + rad
+            > self.focalplane_radius):
+            print('CCD', self.ccdname, 'is not inside the exposure footprint;',
+                  'reading', name, 'stars for the CCD')
+            return None
+        if len(cat) == 0:
+            return cat.copy()
+        I = tree_search_radec(kd, rc, dc, rad)
+        cat = cut_catalog_to_wcs(cat[np.sort(I)], self.wcs, margin=margin)
+        print('Found {} {} stars in CCD {} (from exposure catalog)'.format(
+            len(cat), name, self.ccdname))
+        return cat
+
+    def get_reference_stars(self, name):
+        '''
+        Returns the *name* ('ps1' or 'gaia') reference stars in this
+        CCD: from the stars passed to run(), if any, else by reading
+        the catalog for the CCD.
+        '''
+        cat = self.ccd_refcats.get(name, None)
+        if cat is not None:
+            return cat
+        if name == 'ps1':
+            return ps1cat(ccdwcs=self.wcs).get_stars(magrange=None)
+        return GaiaCatalog().get_catalog_in_wcs(self.wcs, margin=10)
+
+    def run(self, ext=None, save_xy=False, splinesky=False, survey=None,
+            refcats=None):
 
         """Computes statistics for 1 CCD
 
@@ -650,11 +740,14 @@ class Measurer(object):
             ext: ccdname
             save_xy: save daophot x,y and x,y after various cuts to dict and save
                 to json
+            refcats: dict of reference stars in this CCD, by catalog name
+                (see read_exposure_refcats)
 
         Returns:
             ccds, stars_photom, stars_astrom
         """
         self.set_hdu(ext)
+        self.ccd_refcats = refcats if refcats is not None else {}
         #
         t0= Time()
         t0= ptime('Measuring CCD=%s from image=%s' % (self.ccdname,self.fn),t0)
@@ -745,7 +838,7 @@ class Measurer(object):
 
         ps1 = None
         try:
-            ps1 = ps1cat(ccdwcs=self.wcs).get_stars(magrange=None)
+            ps1 = self.get_reference_stars('ps1')
         except OSError as e:
             print('No PS1 stars found for this image -- outside the PS1 footprint, or in the Galactic plane?', e)
 
@@ -762,7 +855,7 @@ class Measurer(object):
                 ps1.legacy_survey_mag = self.ps1_to_observed(ps1)
                 print(len(ps1), 'PS1 stars')
 
-        gaia = GaiaCatalog().get_catalog_in_wcs(self.wcs)
+        gaia = self.get_reference_stars('gaia')
         assert(gaia is not None)
         assert(len(gaia) > 0)
         gaia = GaiaCatalog.catalog_nantozero(gaia)
@@ -919,8 +1012,12 @@ class Measurer(object):
                 continue
 
         # Run tractor fitting on the ref stars, using the PsfEx model.
-        phot = self.tractor_fit_sources(refs.ra_now, refs.dec_now, refs.flux0,
-                                        fit_img, ierr, psf)
+        if self.batch_psfphot:
+            fit_sources = self.batch_fit_sources
+        else:
+            fit_sources = self.tractor_fit_sources
+        phot = fit_sources(refs.ra_now, refs.dec_now, refs.flux0,
+                           fit_img, ierr, psf)
         print('Got photometry results for', len(phot), 'reference stars')
         if len(phot) == 0:
             return self.return_on_error('No photometry available',ccds=ccds)
@@ -1346,6 +1443,90 @@ class Measurer(object):
         cal.ra_fit,cal.dec_fit = self.wcs.pixelxy2radec(cal.x1 + 1, cal.y1 + 1)
         return cal
 
+    def batch_fit_sources(self, ref_ra, ref_dec, ref_flux, img, ierr,
+                          psf, normalize_psf=True):
+        '''
+        Like tractor_fit_sources, but fits all the stars at once (see
+        legacyzpts/psfphot.py) rather than with a Tractor per star.
+        '''
+        from legacyzpts.psfphot import psf_images_at, fit_psf_stars
+
+        print('Fitting positions & fluxes of %i stars (batched)' % len(ref_ra))
+        # Fitting radius
+        R = 10
+        sz = R + 5
+        H,W = img.shape
+        _,x,y = self.wcs.radec2pixelxy(ref_ra, ref_dec)
+        x = np.atleast_1d(x) - 1
+        y = np.atleast_1d(y) - 1
+        xlo = (x - R).astype(int)
+        ylo = (y - R).astype(int)
+        # (int() truncates toward zero, as in tractor_fit_sources)
+        onim = (xlo >= 0) * (ylo >= 0) * (xlo + R*2 < W) * (ylo + R*2 < H)
+        noffim = np.sum(np.logical_not(onim))
+        I, = np.nonzero(onim)
+        subimgs = np.array([img [yl:yl+R*2+1, xl:xl+R*2+1]
+                            for xl,yl in zip(xlo[I], ylo[I])]).reshape(-1, R*2+1, R*2+1)
+        subies  = np.array([ierr[yl:yl+R*2+1, xl:xl+R*2+1]
+                            for xl,yl in zip(xlo[I], ylo[I])]).reshape(subimgs.shape)
+        nonzero = np.array([np.any(ie != 0) for ie in subies], bool)
+        nzeroivar = np.sum(np.logical_not(nonzero))
+        I = I[nonzero]
+        subimgs = subimgs[nonzero]
+        subies = subies[nonzero]
+        if nzeroivar > 0:
+            print('Zero ivar for %d stars' % nzeroivar)
+        if noffim > 0:
+            print('Off image for %d stars' % noffim)
+
+        cal = fits_table()
+        if len(I) == 0:
+            for c in ['x0', 'y0', 'x1', 'y1', 'flux', 'dx', 'dy', 'dflux',
+                      'psfsum', 'chi2', 'fracmasked', 'ra_fit', 'dec_fit']:
+                cal.set(c, np.zeros(0))
+            cal.iref = np.zeros(0, int)
+            return cal
+
+        psfimgs = psf_images_at(psf, x[I], y[I])
+        _,ph,pw = psfimgs.shape
+        psfsum = np.sum(psfimgs, axis=(1,2))
+        if normalize_psf:
+            psfimgs /= psfsum[:,np.newaxis,np.newaxis]
+        psfimgs = psfimgs[:, ph//2-sz:ph//2+sz+1, pw//2-sz:pw//2+sz+1]
+
+        x0 = x[I] - xlo[I]
+        y0 = y[I] - ylo[I]
+        x1,y1,flux,std,mod = fit_psf_stars(subimgs, subies, psfimgs, x0, y0,
+                                           ref_flux[I])
+        # As in tractor_fit_sources, skip stars without a variance
+        # estimate (no parameter constrained at all); a single
+        # unconstrained parameter just gets zero std.
+        good = np.all(np.isfinite(std), axis=1) * np.any(std > 0, axis=1)
+        if np.sum(np.logical_not(good)):
+            print('No variance estimate available for %i stars' %
+                  np.sum(np.logical_not(good)))
+
+        chi = (subimgs - mod) * subies
+        psfmod = mod / np.sum(mod, axis=(1,2))[:,np.newaxis,np.newaxis]
+        # profile-weighted chi-squared
+        cal.chi2 = np.sum(chi**2 * psfmod, axis=(1,2))
+        # profile-weighted fraction of masked pixels
+        cal.fracmasked = np.sum(psfmod * (subies == 0), axis=(1,2))
+        cal.psfsum = psfsum
+        # These x0,y0,x1,y1 are zero-indexed coords.
+        cal.x0 = x0 + xlo[I]
+        cal.y0 = y0 + ylo[I]
+        cal.x1 = x1 + xlo[I]
+        cal.y1 = y1 + ylo[I]
+        cal.flux = flux
+        cal.iref = I
+        cal.dx = std[:,0]
+        cal.dy = std[:,1]
+        cal.dflux = std[:,2]
+        cal.cut(good)
+        cal.ra_fit,cal.dec_fit = self.wcs.pixelxy2radec(cal.x1 + 1, cal.y1 + 1)
+        return cal
+
     def get_psfex_merged_filename(self):
         basefn = os.path.basename(self.fn_base)
         basedir = os.path.dirname(self.fn_base)
@@ -1564,6 +1745,9 @@ class DecamMeasurer(Measurer):
     wanders around over time; removing it resulted in much smaller
     scatter.
     '''
+    # DECam: 2.2 deg diameter focal plane
+    focalplane_radius = 1.2
+
     def __init__(self, *args, **kwargs):
         self.camera = 'decam'
         super(DecamMeasurer, self).__init__(*args, **kwargs)
@@ -1655,6 +1839,9 @@ class DecamMeasurer(Measurer):
         return mask
 
 class MegaPrimeMeasurer(Measurer):
+    # MegaPrime: 1 x 1 deg
+    focalplane_radius = 0.8
+
     def __init__(self, *args, **kwargs):
         self.camera = 'megaprime'
         super(MegaPrimeMeasurer, self).__init__(*args, **kwargs)
@@ -1754,6 +1941,9 @@ class MegaPrimeMeasurer(Measurer):
 class Mosaic3Measurer(Measurer):
     '''Class to measure a variety of quantities from a single Mosaic3 CCD.
     UNITS: e-/s'''
+    # Mosaic3: 36 x 36 arcmin
+    focalplane_radius = 0.4
+
     def __init__(self, *args, **kwargs):
         self.camera = 'mosaic' # this has to appear before super to recompute airmass
         super(Mosaic3Measurer, self).__init__(*args, **kwargs)
@@ -1845,6 +2035,9 @@ class Mosaic3Measurer(Measurer):
 class NinetyPrimeMeasurer(Measurer):
     '''Class to measure a variety of quantities from a single 90prime CCD.
     UNITS -- CP e-/s'''
+    # 90prime: 1.16 x 1.16 deg
+    focalplane_radius = 0.8
+
     def __init__(self, *args, **kwargs):
         self.camera = '90prime'
         super(NinetyPrimeMeasurer, self).__init__(*args, **kwargs)
@@ -2079,7 +2272,13 @@ def measure_image(img_fn, mp, image_dir='images', run_calibs_only=False,
     if run_calibs_only:
         return
 
-    rtns = mp.map(run_one_ext, [(measure, ext, survey, splinesky, measureargs['debug'])
+    refcats = {}
+    if len(extlist) > 1:
+        # Read the reference catalogs once for all the CCDs; each
+        # CCD's task gets just its own stars.
+        refcats = measure.read_exposure_refcats(extlist)
+    rtns = mp.map(run_one_ext, [(measure, ext, survey, splinesky, measureargs['debug'],
+                                 refcats.get(ext))
                                 for ext in extlist])
 
     for ext,(ccds,photom) in zip(extlist,rtns):
@@ -2117,8 +2316,9 @@ def run_one_calib(X):
                               survey_zeropoints=survey_zeropoints)
 
 def run_one_ext(X):
-    measure, ext, survey, splinesky, debug = X
-    rtns = measure.run(ext, splinesky=splinesky, survey=survey, save_xy=debug)
+    measure, ext, survey, splinesky, debug, refcats = X
+    rtns = measure.run(ext, splinesky=splinesky, survey=survey, save_xy=debug,
+                       refcats=refcats)
     return rtns
 
 class outputFns(object):
@@ -2292,6 +2492,9 @@ def get_parser():
     parser.add_argument('--threads', default=None, type=int,
                         help='Multiprocessing threads (parallel by HDU)')
     parser.add_argument('--quiet', default=False, action='store_true', help='quiet down')
+    parser.add_argument('--no-batch-psfphot', dest='batch_psfphot', default=True,
+                        action='store_false',
+                        help='Fit reference stars with a Tractor per star, rather than all at once')
     parser.add_argument('--overhead', type=str, default=None, help='Print python startup time since the given date.')
     return parser
 
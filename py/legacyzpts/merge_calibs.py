@@ -40,6 +40,50 @@ def pad_arrays(A):
         padded.append(p)
     return padded
 
+def psfex_input_filename(im):
+    '''
+    Returns the single-CCD PsfEx filename for image object *im*
+    (which may be the old-style filename, if that one exists).
+    '''
+    for fn in [im.psffn, im.old_single_psffn]:
+        if os.path.exists(fn):
+            return fn
+    return im.psffn
+
+def merged_file_is_current(outfn, infns):
+    '''
+    Returns True if the merged file *outfn* exists and is newer than
+    all of the (existing) input files *infns*.
+    '''
+    if not os.path.exists(outfn):
+        return False
+    mtime = os.path.getmtime(outfn)
+    for fn in infns:
+        if os.path.exists(fn) and os.path.getmtime(fn) > mtime:
+            return False
+    return True
+
+def check_merged_table(T, expnum, C, opt):
+    '''
+    Checks that merged table *T* has one row per CCD, all from the
+    CCDs *C* (table or list) for exposure *expnum* -- and, with
+    opt.all_found, that every CCD is present.
+    '''
+    ccdnames = [ccd.ccdname.strip() for ccd in C]
+    names = [c.strip() for c in T.ccdname]
+    if len(set(names)) != len(names):
+        print('Merged table for expnum', expnum, 'has duplicate CCDs:', names)
+        return False
+    if not np.all(T.expnum == expnum) or not set(names).issubset(ccdnames):
+        print('Merged table for expnum', expnum, 'has unexpected CCDs:',
+              list(zip(T.expnum, names)))
+        return False
+    if opt.all_found and len(names) != len(ccdnames):
+        print('Merged table for expnum', expnum, 'is missing CCDs:',
+              sorted(set(ccdnames) - set(names)))
+        return False
+    return True
+
 def merge_psfex(survey, expnum, C, psfoutfn, opt):
     psfex = []
     imobjs = []
@@ -47,9 +91,7 @@ def merge_psfex(survey, expnum, C, psfoutfn, opt):
     fns = []
     for ccd in C:
         im = survey.get_image_object(ccd)
-        for fn in [im.psffn, im.old_single_psffn]:
-            if os.path.exists(fn):
-                break
+        fn = psfex_input_filename(im)
         if not os.path.exists(fn):
             print('File not found:', fn)
             if opt.all_found:
@@ -73,18 +115,34 @@ def merge_psfex(survey, expnum, C, psfoutfn, opt):
 
     if len(psfex) == 0:
         return
+    T = merge_psfex_tables(psfex)
+    if not check_merged_table(T, expnum, C, opt):
+        return 0
+    write_merged_table(T, psfoutfn)
+    return 1
+
+def merge_psfex_tables(psfex):
+    '''
+    Merges a list of single-CCD PsfEx tables into one per-exposure table.
+    '''
     padded = pad_arrays([p.psf_mask[0] for p in psfex])
     cols = psfex[0].columns()
     cols.remove('psf_mask')
     T = merge_tables(psfex, columns=cols)
     T.psf_mask = np.concatenate([[p] for p in padded])
-    fn = psfoutfn
+    return T
+
+def write_merged_table(T, fn):
+    '''
+    Writes table *T* to a temporary file and renames it to *fn*, so
+    that readers (and concurrent merge jobs) never see a partial file.
+    '''
     trymakedirs(fn, dir=True)
-    tmpfn = os.path.join(os.path.dirname(fn), 'tmp-' + os.path.basename(fn))
+    tmpfn = os.path.join(os.path.dirname(fn),
+                         'tmp-%i-' % os.getpid() + os.path.basename(fn))
     T.writeto(tmpfn)
-    os.rename(tmpfn, fn)
+    os.replace(tmpfn, fn)
     print('Wrote', fn)
-    return 1
 
 def merge_splinesky(survey, expnum, C, skyoutfn, opt):
     skies = []
@@ -116,6 +174,16 @@ def merge_splinesky(survey, expnum, C, skyoutfn, opt):
 
     if len(skies) == 0:
         return
+    T = merge_splinesky_tables(skies)
+    if not check_merged_table(T, expnum, C, opt):
+        return 0
+    write_merged_table(T, skyoutfn)
+    return 1
+
+def merge_splinesky_tables(skies):
+    '''
+    Merges a list of single-CCD splinesky tables into one per-exposure table.
+    '''
     T = fits_table()
     T.gridw = np.array([t.gridvals[0].shape[1] for t in skies])
     T.gridh = np.array([t.gridvals[0].shape[0] for t in skies])
@@ -131,13 +199,44 @@ def merge_splinesky(survey, expnum, C, skyoutfn, opt):
         cols.remove(c)
 
     T.add_columns_from(merge_tables(skies, columns=cols))
-    fn = skyoutfn
-    trymakedirs(fn, dir=True)
-    tmpfn = os.path.join(os.path.dirname(fn), 'tmp-' + os.path.basename(fn))
-    T.writeto(tmpfn)
-    os.rename(tmpfn, fn)
-    print('Wrote', fn)
-    return 1
+    return T
+
+def merge_exposure(args):
+    '''
+    Merges the PsfEx and splinesky files for one exposure, skipping
+    merged files that are newer than all their inputs.  Returns the
+    number of failed merges.
+    '''
+    survey, camera, expnum, C, opt = args
+    print(len(C), 'CCDs with expnum', expnum, 'and camera', camera)
+    ims = [survey.get_image_object(ccd) for ccd in C]
+    im0 = ims[0]
+
+    skyoutfn = im0.merged_skyfn
+    psfoutfn = im0.merged_psffn
+    todo = []
+    if merged_file_is_current(skyoutfn, [im.skyfn for im in ims]):
+        print('Merged sky file is up to date:', skyoutfn)
+    else:
+        todo.append((merge_splinesky, skyoutfn))
+    if merged_file_is_current(psfoutfn, [psfex_input_filename(im) for im in ims]):
+        print('Merged PsfEx file is up to date:', psfoutfn)
+    else:
+        todo.append((merge_psfex, psfoutfn))
+
+    nfailed = 0
+    for func,outfn in todo:
+        try:
+            func(survey, expnum, C, outfn, opt)
+        except:
+            if not opt.con:
+                raise
+            import traceback
+            traceback.print_exc()
+            print('Exposure failed:', expnum, '.  Continuing...')
+            nfailed += 1
+    sys.stdout.flush()
+    return nfailed
 
 def main():
     import argparse
@@ -150,6 +249,7 @@ def main():
                         action='store_true', default=False)
     parser.add_argument('--outdir', help='Output directory, default %(default)s',
                         default='calib')
+    parser.add_argument('--threads', type=int, help='Merge exposures in parallel with this many processes')
 
     opt = parser.parse_args()
 
@@ -159,55 +259,36 @@ def main():
         ccds = survey.cleanup_ccds_table(ccds)
         survey.ccds = ccds
 
+    args = []
     if opt.expnum is not None:
-        expnums = [(None, int(x, 10)) for x in opt.expnum.split(',')]
-    else:
-        ccds = survey.get_ccds()
-        expnums = set(zip(ccds.camera, ccds.expnum))
-        print(len(expnums), 'unique camera+expnums')
-
-    for i,(camera,expnum) in enumerate(expnums):
-        print()
-        print('Exposure', i+1, 'of', len(expnums), ':', camera, 'expnum', expnum)
-        if camera is None:
+        for expnum in [int(x, 10) for x in opt.expnum.split(',')]:
             C = survey.find_ccds(expnum=expnum)
             print(len(C), 'CCDs with expnum', expnum)
             camera = C.camera[0]
             print('Set camera to', camera)
+            C = survey.find_ccds(expnum=expnum, camera=camera)
+            args.append((survey, camera, expnum, C, opt))
+    else:
+        ccds = survey.get_ccds()
+        # Group the CCDs by exposure in one pass
+        exps = {}
+        for i,key in enumerate(zip(ccds.camera, ccds.expnum)):
+            exps.setdefault(key, []).append(i)
+        print(len(exps), 'unique camera+expnums')
+        for (camera,expnum),I in exps.items():
+            args.append((survey, camera, expnum, ccds[np.array(I)], opt))
 
-        C = survey.find_ccds(expnum=expnum, camera=camera)
-        print(len(C), 'CCDs with expnum', expnum, 'and camera', camera)
-
-        im0 = survey.get_image_object(C[0])
-
-        skyoutfn = im0.merged_skyfn
-        psfoutfn = im0.merged_psffn
-
-        print('Checking for', skyoutfn)
-        print('Checking for', psfoutfn)
-        if os.path.exists(skyoutfn) and os.path.exists(psfoutfn):
-            print('Exposure', expnum, 'is done already')
-            continue
-
-        if not os.path.exists(skyoutfn):
-            try:
-                merge_splinesky(survey, expnum, C, skyoutfn, opt)
-            except:
-                if not opt.con:
-                    raise
-                import traceback
-                traceback.print_exc()
-                print('Exposure failed:', expnum, '.  Continuing...')
-
-        if not os.path.exists(psfoutfn):
-            try:
-                merge_psfex(survey, expnum, C, psfoutfn, opt)
-            except:
-                if not opt.con:
-                    raise
-                import traceback
-                traceback.print_exc()
-                print('Exposure failed:', expnum, '.  Continuing...')
+    if opt.threads:
+        from astrometry.util.multiproc import multiproc
+        mp = multiproc(opt.threads)
+        nfailed = sum(mp.map(merge_exposure, args))
+    else:
+        nfailed = 0
+        for i,a in enumerate(args):
+            print()
+            print('Exposure', i+1, 'of', len(args), ':', a[1], 'expnum', a[2])
+            nfailed += merge_exposure(a)
+    print(nfailed, 'merges failed')
 
 if __name__ == '__main__':
     main()
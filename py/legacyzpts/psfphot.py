@@ -0,0 +1,198 @@
+'''
+Batched PSF photometry of reference stars, for legacy_zeropoints.
+
+Measurer.tractor_fit_sources fits each reference star (position and
+flux) on its own small cutout with a separate Tractor object.  The
+stars are independent, so here the same fits are done for all the
+stars on a CCD at once, with numpy:
+
+- the PsfEx PSF model, a polynomial in (x,y), is evaluated on a small
+  grid of positions and the polynomial is solved for, so that the PSF
+  images at all the star positions are a single matrix product;
+
+- each star's model is its PSF stamp, shifted to the star's position
+  with separable (normalized) Lanczos-3 interpolation, as in
+  tractor's PixelizedPSF, and scaled by its flux;
+
+- the fluxes (with the positions fixed), and then positions and
+  fluxes, are fit by Gauss-Newton steps with a line search, for all
+  stars simultaneously, with per-star convergence;
+
+- the reported errors are, as in the tractor optimizer, the diagonal
+  of the inverse-variance: 1/sqrt(sum of squared weighted derivatives).
+'''
+import numpy as np
+
+def _monomials(u, v, degree):
+    # All the terms u**i * v**j with i + j <= degree
+    return np.array([u**i * v**(d-i) for d in range(degree+1)
+                     for i in range(d+1)]).T
+
+def psf_images_at(psf, x, y):
+    '''
+    Returns the array (N x ph x pw) of psf.getImage(x[i], y[i]).
+
+    If *psf* is a PsfEx model (with a polynomial of degree
+    psf.psfex.degree), it is evaluated on a (degree+1)^2 grid of
+    positions, and the images at all positions are computed from the
+    polynomial fit to that grid.  The result is checked against a
+    direct evaluation.
+    '''
+    x = np.atleast_1d(x).astype(float)
+    y = np.atleast_1d(y).astype(float)
+    N = len(x)
+    degree = getattr(getattr(psf, 'psfex', None), 'degree', None)
+    if N == 0 or degree is None or N <= (degree+1)**2:
+        return np.array([psf.getImage(xi, yi) for xi,yi in zip(x, y)])
+    degree = int(degree)
+    # Sample grid spanning the positions; scaled to [-1,1] for conditioning.
+    xc = (x.min() + x.max()) / 2.
+    yc = (y.min() + y.max()) / 2.
+    sx = max((x.max() - x.min()) / 2., 1.)
+    sy = max((y.max() - y.min()) / 2., 1.)
+    gx,gy = np.meshgrid(xc + sx * np.linspace(-1, 1, degree+1),
+                        yc + sy * np.linspace(-1, 1, degree+1))
+    gx = gx.ravel()
+    gy = gy.ravel()
+    samples = np.array([psf.getImage(xi, yi) for xi,yi in zip(gx, gy)])
+    shape = samples.shape[1:]
+    A = _monomials((gx - xc) / sx, (gy - yc) / sy, degree)
+    coeffs,_,_,_ = np.linalg.lstsq(A, samples.reshape(len(A), -1), rcond=None)
+    imgs = np.dot(_monomials((x - xc) / sx, (y - yc) / sy, degree), coeffs)
+    imgs = imgs.reshape((N,) + shape).astype(samples.dtype)
+
+    # Check one (not a grid point) against a direct evaluation.
+    i = N // 2
+    direct = psf.getImage(x[i], y[i])
+    if not np.allclose(imgs[i], direct, rtol=1e-4,
+                       atol=1e-6 * np.max(np.abs(direct))):
+        print('Warning: PsfEx grid evaluation does not match; evaluating PSF per star')
+        return np.array([psf.getImage(xi, yi) for xi,yi in zip(x, y)])
+    return imgs
+
+def lanczos3(t):
+    t = np.asarray(t)
+    return np.where(np.abs(t) < 3., np.sinc(t) * np.sinc(t / 3.), 0.)
+
+def lanczos3_deriv(t):
+    t = np.asarray(t)
+    def dsinc(t):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d = (np.cos(np.pi * t) - np.sinc(t)) / t
+        return np.where(t == 0, 0., d)
+    d = dsinc(t) * np.sinc(t / 3.) + np.sinc(t) * dsinc(t / 3.) / 3.
+    return np.where(np.abs(t) < 3., d, 0.)
+
+def _shift_weights(x, S, P):
+    # Lanczos weights W[n, u, j] of PSF-stamp pixel j (of P, centered
+    # at P//2) for stamp pixel u (of S), for a star at position x[n];
+    # and their derivatives with respect to x.
+    # The weights are normalized to sum to one, like astrometry.net's
+    # Lanczos resampling code.
+    t = (np.arange(S)[np.newaxis,:,np.newaxis] - x[:,np.newaxis,np.newaxis]
+         - (np.arange(P)[np.newaxis,np.newaxis,:] - P//2))
+    L = lanczos3(t)
+    dL = -lanczos3_deriv(t)
+    s = np.sum(L, axis=2)[:,:,np.newaxis]
+    ds = np.sum(dL, axis=2)[:,:,np.newaxis]
+    return L / s, (dL - L * ds / s) / s
+
+def render_psf_models(psfimgs, x, y, S):
+    '''
+    Renders unit-flux point sources at stamp positions *x*, *y* (in
+    S x S stamps) from the (N x P x P) PSF stamps *psfimgs*, centered
+    on pixel P//2.
+
+    Returns (models, dmodel/dx, dmodel/dy), each N x S x S.
+    '''
+    P = psfimgs.shape[1]
+    Wx,dWx = _shift_weights(x, S, P)
+    Wy,dWy = _shift_weights(y, S, P)
+    WyP  = np.matmul(Wy,  psfimgs)
+    dWyP = np.matmul(dWy, psfimgs)
+    WxT  = np.transpose(Wx,  (0,2,1))
+    dWxT = np.transpose(dWx, (0,2,1))
+    return (np.matmul(WyP, WxT), np.matmul(WyP, dWxT), np.matmul(dWyP, WxT))
+
+def fit_psf_stars(imgs, ies, psfimgs, x, y, flux,
+                  alphas=[0.1, 0.3, 1.0], max_steps=50):
+    '''
+    Fits the positions and fluxes of point sources, one per stamp.
+
+    *imgs*, *ies*: N x S x S image and inverse-error stamps.
+    *psfimgs*: N x P x P PSF stamps.
+    *x*, *y*, *flux*: initial positions (in stamp pixel coordinates)
+     and fluxes.
+
+    First fits the fluxes with the positions fixed, then iterates
+    Gauss-Newton steps in (x, y, flux), trying step sizes *alphas* and
+    taking the best, until no step improves a star's chi-squared.
+
+    Returns (x, y, flux, std, models): fit positions and fluxes, the
+    N x 3 array of (x, y, flux) errors (zero where a parameter has no
+    constraint), and the N x S x S model stamps.
+    '''
+    S = imgs.shape[1]
+    x = np.array(x, float)
+    y = np.array(y, float)
+    flux = np.array(flux, float)
+    iv = ies.astype(float)**2
+    sumaxes = (1,2)
+
+    # Quick linear flux fit.
+    mod,_,_ = render_psf_models(psfimgs, x, y, S)
+    num = np.sum(mod * imgs * iv, axis=sumaxes)
+    den = np.sum(mod**2 * iv, axis=sumaxes)
+    ok = (den > 0)
+    flux[ok] = num[ok] / den[ok]
+
+    def chisq(x, y, flux, I):
+        mod,_,_ = render_psf_models(psfimgs[I], x, y, S)
+        return np.sum((imgs[I] - flux[:,np.newaxis,np.newaxis] * mod)**2 * iv[I],
+                      axis=sumaxes)
+
+    # Stars still being fit
+    active = np.arange(len(x))
+    chi2 = chisq(x, y, flux, active)
+    for _ in range(max_steps):
+        if len(active) == 0:
+            break
+        I = active
+        mod,dx,dy = render_psf_models(psfimgs[I], x[I], y[I], S)
+        f = flux[I][:,np.newaxis,np.newaxis]
+        # Jacobian of the model, (n, S*S, 3)
+        J = np.stack([(f * dx).reshape(len(I), -1),
+                      (f * dy).reshape(len(I), -1),
+                      mod.reshape(len(I), -1)], axis=-1)
+        w = iv[I].reshape(len(I), -1)
+        r = (imgs[I] - f * mod).reshape(len(I), -1)
+        A = np.matmul(np.transpose(J, (0,2,1)), J * w[:,:,np.newaxis])
+        b = np.sum(J * (w * r)[:,:,np.newaxis], axis=1)
+        step = np.matmul(np.linalg.pinv(A), b[:,:,np.newaxis])[:,:,0]
+
+        best = chi2[I].copy()
+        bestalpha = np.zeros(len(I))
+        for alpha in alphas:
+            c = chisq(x[I] + alpha * step[:,0], y[I] + alpha * step[:,1],
+                      flux[I] + alpha * step[:,2], I)
+            better = (c < best)
+            best[better] = c[better]
+            bestalpha[better] = alpha
+        moved = (bestalpha > 0)
+        J = I[moved]
+        a = bestalpha[moved]
+        x[J] += a * step[moved,0]
+        y[J] += a * step[moved,1]
+        flux[J] += a * step[moved,2]
+        chi2[J] = best[moved]
+        active = J
+
+    mod,dx,dy = render_psf_models(psfimgs, x, y, S)
+    f = flux[:,np.newaxis,np.newaxis]
+    colscale2 = np.vstack([np.sum((f * dx)**2 * iv, axis=sumaxes),
+                           np.sum((f * dy)**2 * iv, axis=sumaxes),
+                           np.sum(mod**2 * iv, axis=sumaxes)]).T
+    std = np.zeros_like(colscale2)
+    ok = (colscale2 > 0)
+    std[ok] = 1. / np.sqrt(colscale2[ok])
+    return x, y, flux, std, f * mod
@@ -5,7 +5,7 @@ from __future__ import print_function
 
 from astrometry.util.fits import merge_tables
 
-from legacypipe.survey import run_calibs, LegacySurveyData
+from legacypipe.survey import run_calibs, run_exposure_calibs, LegacySurveyData
 
 def main():
     """Main program.
@@ -17,6 +17,8 @@ def main():
     parser.add_argument('--survey-dir', help='Override LEGACY_SURVEY_DIR')
     parser.add_argument('--expnum', type=str, help='Cut to a single or set of exposures; comma-separated list')
     parser.add_argument('--extname', '--ccdname', help='Cut to a single extension/CCD name')
+    parser.add_argument('--by-exposure', action='store_true',
+                        help='With --expnum: run all CCDs of each exposure together, writing the merged calibration files directly')
 
     parser.add_argument('--no-psf', dest='psfex', action='store_false',
                       help='Do not compute PsfEx calibs')
@@ -68,6 +70,26 @@ def main():
     if opt.blob_mask_dir is not None:
         survey_blob_mask = LegacySurveyData(opt.blob_mask_dir)
 
+    if opt.by_exposure:
+        if T is None or not opt.splinesky:
+            print('--by-exposure requires --expnum, and does not support --no-splinesky')
+            return -1
+        kwargs = dict(psfex=opt.psfex, sky=opt.sky, ps=ps,
+                      survey_blob_mask=survey_blob_mask, force=opt.force,
+                      se=opt.run_se)
+        if opt.cont:
+            kwargs.update(noraise=True)
+        args = [(survey, T[T.expnum == e], kwargs.copy())
+                for e in sorted(set(T.expnum))]
+        if opt.threads:
+            from astrometry.util.multiproc import multiproc
+            mp = multiproc(opt.threads)
+            mp.map(run_exposure_calibs, args)
+        else:
+            for a in args:
+                run_exposure_calibs(a)
+        return 0
+
     args = []
     for a in opt.args:
         # Check for "expnum-ccdname" format.
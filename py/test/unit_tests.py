@@ -56,6 +56,887 @@ class TestOneblob(unittest.TestCase):
         mod = _select_model(chisqs, nparams, galaxy_margin)
         self.assertTrue(mod == 'dev')
 
+class TestTaskQueue(unittest.TestCase):
+
+    def test_queue(self):
+        import os
+        import tempfile
+        from legacypipe.taskqueue import connect, Task
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fn = os.path.join(tempdir, 'bricks.sqlite')
+            q = connect(fn, max_retries=1)
+            q.add_multiple(['1102p240', '1102p237'])
+            q.add('0001m002', priority=10)
+
+            t = q.get()
+            self.assertTrue(t.task == '0001m002')
+            t.set_state(Task.SUCCEEDED)
+
+            # A second connection sees the claimed state
+            q2 = connect(fn, max_retries=1)
+            t = q2.get()
+            self.assertTrue(t.task == '1102p240')
+            # First failure is re-queued...
+            t.set_state(Task.FAILED, err=1)
+            self.assertTrue(q.status()[Task.PENDING] == 2)
+            t = q.get()
+            self.assertTrue(t.task == '1102p240')
+            self.assertTrue(t.nretry == 1)
+            # ... second is not.
+            t.set_state(Task.FAILED, err=1)
+            self.assertTrue(q.status()[Task.FAILED] == 1)
+
+            t = q.get()
+            self.assertTrue(t.task == '1102p237')
+            self.assertTrue(q.get() is None)
+            self.assertTrue(q.recover() == 1)
+            self.assertTrue(q.retry() == 1)
+            self.assertTrue(q.status()[Task.PENDING] == 2)
+            q.close()
+            q2.close()
+
+class TestPixelCache(unittest.TestCase):
+
+    def test_pixcache(self):
+        import os
+        import tempfile
+        import numpy as np
+        import fitsio
+        from legacypipe.pixcache import PixelCache
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fn = os.path.join(tempdir, 'img.fits.fz')
+            img = np.random.normal(size=(100,200)).astype(np.float32)
+            dq = (np.arange(100*200).reshape(100,200) % 7).astype(np.int16)
+            with fitsio.FITS(fn, 'rw', clobber=True) as F:
+                F.write(img, extname='IMG', compress='gzip')
+                F.write(dq, extname='DQ', compress='rice')
+            cache = PixelCache(os.path.join(tempdir, 'cache'),
+                               max_bytes=100000)
+            slc = (slice(10,20), slice(30,70))
+            for i in range(2):
+                pix,hdr = cache.read(fn, 1, slice=slc, header=True)
+                self.assertTrue(np.all(pix == fitsio.FITS(fn)[1][slc]))
+                self.assertTrue(hdr['EXTNAME'].strip() == 'IMG')
+                d = cache.read(fn, 2)
+                self.assertTrue(d.dtype == np.int16)
+                self.assertTrue(np.all(d == dq))
+            # Size limit: only one of the two HDUs fits
+            self.assertTrue(len(os.listdir(cache.cache_dir)) == 1)
+
+class TestSkyTemplate(unittest.TestCase):
+
+    def test_read_sky_template(self):
+        import os
+        import tempfile
+        import numpy as np
+        import fitsio
+        from legacypipe.decam import read_sky_template
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fn = os.path.join(tempdir, 'sky_template_g_1.fits.fz')
+            rng = np.random.RandomState(42)
+            hdr = fitsio.FITSHDR()
+            hdr['SKYTMPL'] = 3
+            with fitsio.FITS(fn, 'rw', clobber=True) as F:
+                F.write(None, header=hdr)
+                for ccd in ['N4', 'S4']:
+                    F.write(rng.normal(size=(100,60)).astype(np.float32),
+                            extname=ccd, compress='rice', qlevel=16)
+            full,ver = read_sky_template(fn, 'S4')
+            self.assertEqual(ver, 3)
+            self.assertEqual(full.shape, (100,60))
+            for slc in [(slice(10,20), slice(30,60)),
+                        (slice(0,100), slice(0,1))]:
+                sub,ver = read_sky_template(fn, 'S4', slc=slc)
+                self.assertEqual(ver, 3)
+                self.assertTrue(np.all(sub == full[slc]))
+
+class TestApphot(unittest.TestCase):
+
+    def test_apphot(self):
+        import numpy as np
+        from legacypipe.apphot import aperture_photometry, aperture_stencils
+
+        # Stencil weights sum to the circle area
+        for r in [0.3, 1., 2.86, 7.5]:
+            _,_,w = aperture_stencils([10.3, 20.], [15.7, 20.5], r)
+            self.assertTrue(np.allclose(np.sum(w, axis=(1,2)), np.pi * r**2))
+
+        rng = np.random.RandomState(42)
+        H,W = 50,60
+        img = rng.normal(size=(H,W))
+        err = np.abs(rng.normal(size=(H,W))) + 0.1
+        mask = rng.uniform(size=(H,W)) < 0.1
+        xy = np.array([[0., 0.], [W-1, H-1], [25.3, 30.8], [-20., 10.]])
+        [(ap,aperr)] = aperture_photometry([img], xy, 3.5, errors=[err],
+                                           mask=mask)
+        self.assertTrue(np.all(np.isfinite(ap[:3])))
+        self.assertTrue(np.isnan(ap[3]))
+        try:
+            from photutils.aperture import CircularAperture, aperture_photometry
+        except ImportError:
+            return
+        p = aperture_photometry(img, CircularAperture(xy[:3], 3.5),
+                                error=err, mask=mask)
+        self.assertTrue(np.allclose(ap[:3], p['aperture_sum'], rtol=1e-6))
+        self.assertTrue(np.allclose(aperr[:3], p['aperture_sum_err'], rtol=1e-6))
+
+class TestReferenceMap(unittest.TestCase):
+
+    def test_paint_refs(self):
+        import numpy as np
+        from legacypipe.reference import _paint_refs
+
+        H,W = 40,50
+        xx = np.array([10.3, 45.7, -3.2, 20.])
+        yy = np.array([12.8, 38.1, 5.5, 20.])
+        rpix = np.array([3, 5, 4, 0])
+        refmap = np.zeros((H,W), np.uint8)
+        refmap[0,0] = 2
+        _paint_refs(refmap, xx, yy, rpix, np.uint8(1))
+        ygrid,xgrid = np.mgrid[:H,:W]
+        expect = np.zeros((H,W), bool)
+        for x,y,r in zip(xx, yy, rpix):
+            expect |= ((xgrid - x)**2 + (ygrid - y)**2 <= r**2)
+        self.assertTrue(np.all((refmap & 1 > 0) == expect))
+        self.assertTrue(refmap[0,0] & 2)
+
+class TestHalos(unittest.TestCase):
+
+    def test_profile_lut(self):
+        import numpy as np
+        from legacypipe.halos import halo_profile_lut, moffat
+
+        pixscale = 0.262
+        u0,step,onchip,offchip = halo_profile_lut('z', pixscale, 'N4', (0.9, 2.5))
+        r = np.array([10., 35., 100., 1000.])
+        u = np.maximum((r**2 - u0) / step, 0.)
+        iu = u.astype(int)
+        prof = onchip[iu] + (u - iu) * (onchip[iu+1] - onchip[iu])
+        ra = r * pixscale
+        expect = (0.0145 * moffat(ra, 17.650, 1.7) + moffat(ra, 0.9, 2.5)) * pixscale**2
+        # inside the inner apodization radius
+        expect[0] = 0.
+        self.assertTrue(np.allclose(prof, expect, rtol=1e-4))
+        self.assertTrue(np.all(offchip <= onchip))
+
+class TestSaddleLevels(unittest.TestCase):
+
+    def test_saddle_levels(self):
+        import numpy as np
+        from scipy.ndimage import gaussian_filter, label, find_objects
+        from scipy.ndimage import binary_fill_holes
+        from legacypipe.detection import _fill_holes, _saddle_cut, _SaddleLevels
+
+        rng = np.random.RandomState(42)
+        sn = gaussian_filter(rng.normal(size=(120,100)), 2.) * 20.
+        mask = (sn > 2.)
+        self.assertTrue(np.all(_fill_holes(mask) == binary_fill_holes(mask)))
+
+        allblobs,_ = label(sn > 1.)
+        allslices = find_objects(allblobs)
+        py,px = np.nonzero((sn > 3.) * (rng.uniform(size=sn.shape) < 0.05))
+        I = np.argsort(-sn[py,px])
+        px,py = px[I], py[I]
+        levels = np.maximum(1., sn[py,px] * 0.6)
+        saddles = _SaddleLevels(sn, allblobs, allslices, px, py, levels, 1.)
+        sx,sy = [],[]
+        ndecided = 0
+        for i,(x,y) in enumerate(zip(px, py)):
+            cut = _saddle_cut(sn, allblobs, allslices, x, y, levels[i], sx, sy)
+            c = saddles.is_cut(i)
+            if c is not None:
+                ndecided += 1
+                self.assertEqual(c, cut)
+            if not cut:
+                sx.append(x)
+                sy.append(y)
+                saddles.add_sources([x], [y])
+        self.assertTrue(ndecided > len(px) // 2)
+
+    def test_saddle_grid(self):
+        # The grid lookups must detect the same sources as running the
+        # full saddle test for every peak.
+        import numpy as np
+        from scipy.ndimage import gaussian_filter
+        from legacypipe.detection import sed_matched_detection
+
+        H,W = 120,120
+        yy,xx = np.mgrid[:H,:W].astype(float)
+        def gauss(x, y, s):
+            return np.exp(-0.5 * ((xx-x)**2 + (yy-y)**2) / s**2)
+        fields = []
+        # A frame, rising monotonically (with no peaks of its own) to a
+        # pair of peaks; the fainter one is vetoed by the brighter,
+        # but its blob, at its lower saddle level, would enclose the
+        # source in the middle of the frame.
+        frame = ((xx >= 30) * (xx <= 90) * (yy >= 30) * (yy <= 90) *
+                 np.logical_not((xx > 32) * (xx < 88) * (yy > 32) * (yy < 88)))
+        dy = np.abs(yy - 60)
+        pos = np.where(xx <= 32, dy, 0)
+        pos = np.maximum(pos, np.where((yy <= 32) | (yy >= 88), xx, 0))
+        pos = np.maximum(pos, np.where(xx >= 88, 120 - dy, 0))
+        sn = np.where(frame, 25.6 + 0.01 * pos + 0.001 * xx, 0.)
+        sn = np.maximum(sn, 30. * gauss(90, 59, 4.))
+        sn = np.maximum(sn, 28. * gauss(90, 62, 4.))
+        sn += 20. * gauss(60, 60, 1.5)
+        fields.append(sn)
+        rng = np.random.RandomState(42)
+        for i in range(10):
+            sn = gaussian_filter(rng.normal(size=(H,W)), rng.uniform(1., 3.))
+            sn *= rng.uniform(2., 8.) / np.std(sn)
+            fields.append(sn)
+
+        iv = np.ones((H,W))
+        for j,sn in enumerate(fields):
+            xomit, yomit = [60, 20], [100, 20]
+            romit = [3., 3.]
+            r1 = sed_matched_detection('x', [1.], [sn], [iv], ['r'],
+                                       xomit, yomit, romit)
+            r2 = sed_matched_detection('x', [1.], [sn], [iv], ['r'],
+                                       xomit, yomit, romit, saddle_grid=False)
+            self.assertTrue(np.all(r1[0] == r2[0]))
+            self.assertTrue(np.all(r1[1] == r2[1]))
+            self.assertTrue(np.all(r1[2] == r2[2]))
+            if j == 0:
+                # the source in the middle of the frame is found
+                self.assertEqual(sorted(zip(r1[1], r1[2])), [(60,60), (90,59)])
+
+class TestSedMatchedMaps(unittest.TestCase):
+
+    def test_sed_maps(self):
+        import numpy as np
+        from legacypipe.detection import sed_matched_maps
+
+        rng = np.random.RandomState(1)
+        detmaps = [rng.normal(size=(20,30)).astype(np.float32) for b in 'grz']
+        detivs = [rng.uniform(1., 2., size=(20,30)).astype(np.float32)
+                  for b in 'grz']
+        detivs[2][:] = 0.
+        sats = [rng.uniform(size=(20,30)) < 0.1 for b in 'grz']
+        SEDs = [('z', [0.,0.,1.]), ('g', [1.,0.,0.]), ('Red', [2.5,1.,0.4])]
+        sn,iv,satur = sed_matched_maps(SEDs, detmaps, detivs, saturated_pix=sats)
+        self.assertFalse(np.any(iv[0] > 0))
+        self.assertTrue(np.allclose(sn[1], detmaps[0] * np.sqrt(detivs[0])))
+        w = np.array(SEDs[2][1])
+        eiv = sum(d / s**2 for d,s in zip(detivs, w))
+        emap = sum(m * d / s for m,d,s in zip(detmaps, detivs, w)) / eiv
+        self.assertTrue(np.allclose(iv[2], eiv))
+        self.assertTrue(np.allclose(sn[2], emap * np.sqrt(eiv), atol=1e-5))
+        self.assertTrue(np.all(satur[1] == sats[0]))
+        self.assertTrue(np.all(satur[2] == (sats[0] | sats[1] | sats[2])))
+
+    def test_single_pass(self):
+        # On well-separated sources, detecting once on the max S/N
+        # over the SEDs finds the same peaks as running the SEDs one
+        # after another.
+        import numpy as np
+        from legacypipe.detection import run_sed_matched_filters
+
+        class PixelWcs(object):
+            def pixelxy2radec(self, x, y):
+                return x, y
+        H,W = 100,120
+        yy,xx = np.mgrid[:H,:W]
+        bands = ['g', 'r']
+        detmaps = [np.zeros((H,W), np.float32) for b in bands]
+        detivs = [np.ones((H,W), np.float32) * 4. for b in bands]
+        rng = np.random.RandomState(7)
+        # (x, y, g flux, r flux): blue, red and flat sources
+        sources = [(15, 20, 30., 0.), (50, 15, 0., 25.), (90, 25, 20., 20.),
+                   (20, 70, 10., 40.), (60, 60, 40., 5.), (100, 80, 8., 8.)]
+        for x,y,fg,fr in sources:
+            g = np.exp(-0.5 * ((xx - x)**2 + (yy - y)**2) / 2.**2)
+            detmaps[0] += fg * g
+            detmaps[1] += fr * g
+        for d in detmaps:
+            d += 0.01 * rng.normal(size=d.shape)
+        SEDs = [('g', [1., 0.]), ('r', [0., 1.]), ('Flat', [1., 1.])]
+        omit = ([100], [20], [3])
+        T1,cat1,hot1 = run_sed_matched_filters(SEDs, bands, detmaps, detivs,
+                                               omit, PixelWcs())
+        T2,cat2,hot2 = run_sed_matched_filters(SEDs, bands, detmaps, detivs,
+                                               omit, PixelWcs(),
+                                               single_pass=True)
+        self.assertEqual(sorted(zip(T1.ibx, T1.iby)),
+                         sorted((x,y) for x,y,_,_ in sources))
+        self.assertEqual(sorted(zip(T2.ibx, T2.iby)),
+                         sorted(zip(T1.ibx, T1.iby)))
+        self.assertEqual(len(cat2), len(cat1))
+        self.assertTrue(np.all(hot1 == hot2))
+        # single-pass peaks are named for the SED with the highest S/N
+        names = dict(((x,y),n) for x,y,n in zip(T2.ibx, T2.iby, T2.sedname))
+        self.assertEqual(names[(15,20)], 'g')
+        self.assertEqual(names[(50,15)], 'r')
+        self.assertEqual(names[(90,25)], 'Flat')
+
+class TestSourceParams(unittest.TestCase):
+
+    def test_source_params(self):
+        import numpy as np
+        from tractor import PointSource, RaDecPos, NanoMaggies
+        from tractor.ellipses import EllipseE
+        from tractor.sersic import SersicGalaxy, SersicIndex
+        from legacypipe.catalog import get_source_params
+
+        bands = ['g', 'r']
+        psf = PointSource(RaDecPos(10., 20.), NanoMaggies(order=bands, g=1., r=2.))
+        ser = SersicGalaxy(RaDecPos(11., -5.), NanoMaggies(order=bands, g=3., r=4.),
+                           EllipseE(1.5, 0.1, -0.2), SersicIndex(2.5))
+        params = ser.getParams()
+        ivars = [np.arange(4) + 1., None, np.arange(8) + 10.]
+        P = get_source_params([psf, None, ser], bands, ivars=ivars)
+        self.assertEqual(list(P['type']), [b'PSF', b'NUN', b'SER'])
+        self.assertTrue(np.all(P['ra'] == [10., 0., 11.]))
+        self.assertTrue(np.all(P['flux'] == [[1., 2.], [0., 0.], [3., 4.]]))
+        self.assertTrue(np.allclose(P['shape_e2'], [0., 0., -0.2]))
+        self.assertTrue(np.all(P['sersic'] == [0., 0., 2.5]))
+        self.assertTrue(np.all(P['dec_ivar'] == [2., 0., 11.]))
+        self.assertTrue(np.all(P['flux_ivar'][2] == [12., 13.]))
+        self.assertTrue(np.all(P['sersic_ivar'] == [0., 0., 17.]))
+        # parameters are restored
+        self.assertEqual(ser.getParams(), params)
+
+    def test_prepare_fits_catalog(self):
+        import numpy as np
+        from tractor import PointSource, RaDecPos, NanoMaggies, Catalog
+        from tractor.ellipses import EllipseE
+        from tractor.galaxy import ExpGalaxy
+        from astrometry.util.fits import fits_table
+        from legacypipe.catalog import prepare_fits_catalog
+
+        bands = ['g', 'r']
+        psf = PointSource(RaDecPos(-1., 20.), NanoMaggies(order=bands, g=1., r=2.))
+        exp = ExpGalaxy(RaDecPos(11., -5.), NanoMaggies(order=bands, g=3., r=4.),
+                        EllipseE(1.5, 0.1, -0.2))
+        cat = Catalog(psf, exp)
+        params = cat.getParams()
+        invvars = np.arange(cat.numberOfParams()) + 1.
+        invvars[3] = 0.
+        T = fits_table()
+        T.objid = np.arange(len(cat))
+        T = prepare_fits_catalog(cat, invvars, T, bands, allbands=['g','r','z'])
+        self.assertEqual(list(T.type), [b'PSF', b'EXP'])
+        self.assertTrue(np.all(T.ra == [359., 11.]))
+        self.assertTrue(np.all(T.ra_ivar == [1., 5.]))
+        # zero-invvar flux is zeroed out
+        self.assertTrue(np.all(T.flux == [[1., 0., 0.], [3., 4., 0.]]))
+        self.assertTrue(np.all(T.flux_ivar == [[3., 0., 0.], [7., 8., 0.]]))
+        self.assertTrue(np.allclose(T.shape_r, [0., 1.5]))
+        self.assertTrue(np.all(T.shape_e2_ivar == [0., 11.]))
+        self.assertEqual(cat.getParams(), params)
+
+    def test_source_arrays(self):
+        # The batched reads match reading via the source objects.
+        import numpy as np
+        from tractor import PointSource, RaDecPos, NanoMaggies
+        from tractor.ellipses import EllipseE
+        from tractor.galaxy import ExpGalaxy
+        from tractor.sersic import SersicGalaxy, SersicIndex
+        from legacypipe.survey import (RexGalaxy, LogRadius, GaiaSource,
+                                       GaiaPosition)
+        from legacypipe.catalog import _source_arrays, _source_arrays_slow
+
+        rng = np.random.RandomState(17)
+        bands = ['g', 'r', 'z']
+        srcs = []
+        for i in range(60):
+            order = bands if i % 2 else ['z', 'g', 'r', 'i']
+            br = NanoMaggies(order=order,
+                             **dict([(b, rng.normal()) for b in order]))
+            pos = RaDecPos(rng.uniform(0., 360.), rng.uniform(-10., 10.))
+            shape = EllipseE(rng.uniform(0.5, 2.), rng.uniform(-0.3, 0.3),
+                             rng.uniform(-0.3, 0.3))
+            t = i % 6
+            if t == 0:
+                src = PointSource(pos, br)
+            elif t == 1:
+                src = ExpGalaxy(pos, br, shape)
+            elif t == 2:
+                src = SersicGalaxy(pos, br, shape, SersicIndex(rng.uniform(1., 5.)))
+            elif t == 3:
+                src = RexGalaxy(pos, br, LogRadius(rng.uniform(-1., 1.)))
+            elif t == 4:
+                src = GaiaSource(GaiaPosition(pos.ra, pos.dec, 2015.5, 1., 2., 0.5), br)
+            else:
+                src = None
+            if src is not None and i % 4 == 0:
+                src.freezeParam('pos')
+            srcs.append(src)
+        for bb in [bands, []]:
+            A = _source_arrays(srcs, bb)
+            B = dict([(k, np.zeros_like(v)) for k,v in A.items()])
+            for i,src in enumerate(srcs):
+                if src is not None:
+                    _source_arrays_slow(B, [i], [src], type(src), bb)
+            for k in A.keys():
+                self.assertTrue(np.all(A[k] == B[k]), k)
+
+class TestUnwisePatches(unittest.TestCase):
+
+    def test_cached_patches(self):
+        import numpy as np
+        from tractor import (Image, Tractor, PointSource, PixPos, NanoMaggies,
+                             NullWCS, ConstantSky, LinearPhotoCal)
+        from tractor.psf import PixelizedPSF
+        from astrometry.util.fits import fits_table
+        from legacypipe.unwise import _forced_phot_cached_patches
+
+        rng = np.random.RandomState(42)
+        H,W = 30,40
+        yy,xx = np.mgrid[-7:8, -7:8]
+        psf = np.exp(-0.5 * (xx**2 + yy**2) / 1.5**2)
+        psf /= psf.sum()
+        tile = fits_table()
+        tile.coadd_id = np.array(['0000p000'])
+        tile = tile[0]
+        pos = [(10.3, 12.1), (13.2, 14.7), (30.5, 20.2), (45., 5.)]
+        patch_cache = {}
+        for epoch in range(2):
+            ie = np.ones((H,W), np.float32)
+            ie[rng.uniform(size=(H,W)) < 0.05] = 0.
+            img = rng.normal(size=(H,W)).astype(np.float32)
+            tim = Image(data=img, inverr=ie, psf=PixelizedPSF(psf),
+                        wcs=NullWCS(), sky=ConstantSky(0.),
+                        photocal=LinearPhotoCal(1., band='w'))
+            tim.tile = tile
+            tim.roi = (0, W, 0, H)
+            cat = [PointSource(PixPos(x, y), NanoMaggies(w=1.)) for x,y in pos]
+            flux,iv,fitstats = _forced_phot_cached_patches([tim], cat, 'w',
+                                                           patch_cache)
+            self.assertEqual(len(patch_cache), 1)
+            # source outside the image
+            self.assertEqual(iv[3], 0.)
+            tr = Tractor([tim], cat)
+            tr.freezeParamsRecursive('*')
+            tr.thawPathsTo('w')
+            R = tr.optimize_forced_photometry(variance=True, shared_params=False)
+            tflux = np.array([src.getBrightness().getBand('w') for src in cat])
+            self.assertTrue(np.allclose(flux[:3], tflux[:3], rtol=1e-4, atol=1e-4))
+            self.assertTrue(np.allclose(iv[:3], R.IV[:3], rtol=1e-4))
+            self.assertTrue(np.all(fitstats['prochi2'][:3] > 0))
+
+class TestResampleMap(unittest.TestCase):
+    def test_resample_map(self):
+        import numpy as np
+        from legacypipe.resampmap import ResampleMap
+        rng = np.random.RandomState(42)
+        H,W = 40,50
+        yy,xx = np.mgrid[5:35, 3:45]
+        Yo = yy.ravel().astype(np.int16)
+        Xo = xx.ravel().astype(np.int16)
+        # with a skip in the input pixels mid-row, as from distortion
+        Yi = (Yo + 2).astype(np.int16)
+        Xi = (Xo - 3 + (Xo > 30)).astype(np.int16)
+        img = rng.normal(size=(H,W+1)).astype(np.float32)
+        for min_run in [1, 10**9]:
+            R = ResampleMap.from_indices(Yo, Xo, Yi, Xi)
+            R.min_run = min_run
+            self.assertEqual(len(R), len(Yo))
+            self.assertEqual(len(R.n), 2 * 30)
+            for a,b in zip(R, (Yo,Xo,Yi,Xi)):
+                self.assertEqual(a.dtype, b.dtype)
+                self.assertTrue(np.all(a == b))
+            self.assertTrue(np.all(R.gather_in(img) == img[Yi,Xi]))
+            v = rng.normal(size=len(R)).astype(np.float32)
+            out1 = np.ones((H,W), np.float32)
+            out2 = out1.copy()
+            out1[Yo,Xo] += v
+            R.scatter_add(out2, v)
+            self.assertTrue(np.allclose(out1, out2))
+            m = rng.randint(0, 16, size=len(R)).astype(np.int16)
+            out1 = np.ones((H,W), np.int16)
+            out2 = out1.copy()
+            out1[Yo,Xo] |= m
+            R.scatter(out2, m, np.bitwise_or)
+            self.assertTrue(np.all(out1 == out2))
+            out1 = np.zeros((H,W), np.float32)
+            out2 = out1.copy()
+            out1[Yo,Xo] = img[Yi,Xi]
+            R.resample(img, out2)
+            self.assertTrue(np.all(out1 == out2))
+
+    def test_resample_map_transposed(self):
+        # CCDs that are transposed or flipped relative to the output
+        # must still give long runs, and never more bytes than the
+        # index arrays.
+        import numpy as np
+        from legacypipe.resampmap import ResampleMap
+        rng = np.random.RandomState(43)
+        H,W = 60,60
+        yy,xx = np.mgrid[5:35, 3:45]
+        Yo = yy.ravel().astype(np.int16)
+        Xo = xx.ravel().astype(np.int16)
+        img = rng.normal(size=(H,W)).astype(np.float32)
+        cases = [(Xo + 2, Yo + 1),        # transposed
+                 (50 - Xo, Yo),           # transposed and flipped
+                 (Yo, 50 - Xo),           # flipped
+                 (Xo + (Xo > 30), Yo),    # transposed, with a skip
+                 ]
+        for Yi,Xi in cases:
+            Yi = Yi.astype(np.int16)
+            Xi = Xi.astype(np.int16)
+            raw = sum(a.nbytes for a in (Yo,Xo,Yi,Xi))
+            R = ResampleMap.from_indices(Yo, Xo, Yi, Xi)
+            self.assertLessEqual(len(R.n), 3 * 30)
+            self.assertLessEqual(R.nbytes, raw)
+            for a,b in zip(R, (Yo,Xo,Yi,Xi)):
+                self.assertEqual(a.dtype, b.dtype)
+                self.assertTrue(np.all(a == b))
+            self.assertTrue(np.all(R.gather_in(img) == img[Yi,Xi]))
+            out1 = np.zeros((H,W), np.float32)
+            out2 = out1.copy()
+            out1[Yo,Xo] = img[Yi,Xi]
+            R.resample(img, out2)
+            self.assertTrue(np.all(out1 == out2))
+
+        # Short runs: keep the index arrays.
+        Yi = rng.randint(0, H, size=len(Yo)).astype(np.int16)
+        Xi = rng.randint(0, W, size=len(Yo)).astype(np.int16)
+        R = ResampleMap.from_indices(Yo, Xo, Yi, Xi)
+        self.assertLessEqual(R.nbytes, sum(a.nbytes for a in (Yo,Xo,Yi,Xi)))
+        self.assertTrue(np.all(R.gather_in(img) == img[Yi,Xi]))
+        out1 = np.zeros((H,W), np.float32)
+        out2 = out1.copy()
+        out1[Yo,Xo] = img[Yi,Xi]
+        R.resample(img, out2)
+        self.assertTrue(np.all(out1 == out2))
+
+class TestSharedCoadds(unittest.TestCase):
+    def test_make_coadds_pool(self):
+        # Coadding on a local process pool (into shared arrays) must
+        # give the same results as coadding serially.
+        import numpy as np
+        from multiprocessing import Pool
+        from astrometry.util.util import Tan
+        from astrometry.util.multiproc import multiproc
+        from tractor import Image, ConstantFitsWcs, NCircularGaussianPSF
+        from tractor.tractortime import TAITime
+        from legacypipe.coadds import make_coadds
+
+        rng = np.random.RandomState(7)
+        ps = 0.262 / 3600.
+        H,W = 100,120
+        targetwcs = Tan(10., 0., W/2.+0.5, H/2.+0.5, -ps, 0., 0., ps,
+                        float(W), float(H))
+        bands = ['g','r','z']
+        tims = []
+        for i in range(9):
+            h,w = 60,80
+            rc,dc = targetwcs.pixelxy2radec(rng.uniform(20, 100),
+                                            rng.uniform(20, 80))
+            subwcs = Tan(rc, dc, w/2.+0.5, h/2.+0.5, -ps, 0., 0., ps,
+                         float(w), float(h))
+            ie = np.ones((h,w), np.float32)
+            ie[rng.uniform(size=(h,w)) < 0.05] = 0.
+            tim = Image(data=rng.normal(size=(h,w)).astype(np.float32),
+                        inverr=ie, wcs=ConstantFitsWcs(subwcs),
+                        psf=NCircularGaussianPSF([1.5], [1.]),
+                        name='tim%i' % i)
+            tim.subwcs = subwcs
+            tim.band = bands[i % 3]
+            tim.time = TAITime(None, mjd=57000. + rng.uniform(0., 100.))
+            tim.sig1 = rng.uniform(0.5, 2.)
+            tim.psfnorm = 0.1
+            tim.galnorm = 0.05
+            tim.dq = rng.randint(0, 4, size=(h,w)).astype(np.int16)
+            tims.append(tim)
+        ix = rng.randint(0, W, size=20)
+        iy = rng.randint(0, H, size=20)
+        mods = [0.5 * tim.getImage() for tim in tims]
+        kwargs = dict(mods=mods, xy=(ix,iy), detmaps=True, ngood=True,
+                      psfsize=True)
+
+        C1 = make_coadds(tims, bands, targetwcs, **kwargs)
+        pool = Pool(2)
+        try:
+            C2 = make_coadds(tims, bands, targetwcs,
+                             mp=multiproc(None, pool=pool), **kwargs)
+        finally:
+            pool.close()
+            pool.join()
+        for key in ['coimgs', 'cowimgs', 'comods', 'galdetivs', 'psfdetivs',
+                    'allmasks', 'maximgs']:
+            for a,b in zip(getattr(C1, key), getattr(C2, key)):
+                self.assertTrue(np.allclose(a, b, rtol=1e-5), key)
+        for col in ['nobs', 'anymask', 'allmask', 'psfsize', 'psfdepth',
+                    'galdepth', 'mjd_min', 'mjd_max']:
+            self.assertTrue(np.allclose(C1.T.get(col), C2.T.get(col)), col)
+
+class TestBatchedPsfPhot(unittest.TestCase):
+    def test_fit_psf_stars(self):
+        import numpy as np
+        from legacyzpts.psfphot import render_psf_models, fit_psf_stars
+        rng = np.random.RandomState(3)
+        N,S = 50,21
+        yy,xx = np.mgrid[-15:16, -15:16]
+        psf = np.exp(-(xx**2 + yy**2) / (2. * 2.**2))
+        psf /= psf.sum()
+        psfs = np.array([psf] * N)
+        x = 10. + rng.uniform(-0.5, 0.5, N)
+        y = 10. + rng.uniform(-0.5, 0.5, N)
+        flux = rng.uniform(1000., 5000., N)
+        mod,_,_ = render_psf_models(psfs, x, y, S)
+        # The model is centered at (x, y) (to the accuracy of Lanczos
+        # interpolation)
+        self.assertTrue(np.allclose(np.sum(mod, axis=(1,2)), 1., atol=1e-3))
+        cx = np.sum(mod * np.arange(S)[np.newaxis,np.newaxis,:], axis=(1,2))
+        self.assertTrue(np.allclose(cx, x, atol=0.03))
+        imgs = flux[:,np.newaxis,np.newaxis] * mod + rng.normal(size=mod.shape)
+        ies = np.ones_like(imgs)
+        x1,y1,f1,std,_ = fit_psf_stars(imgs, ies, psfs, x + 0.3, y - 0.3,
+                                       np.ones(N))
+        self.assertTrue(np.all(np.abs(x1 - x) < 5. * std[:,0]))
+        self.assertTrue(np.all(np.abs(y1 - y) < 5. * std[:,1]))
+        self.assertTrue(np.all(np.abs(f1 - flux) < 5. * std[:,2]))
+
+    def test_batch_fit_no_stars(self):
+        import numpy as np
+        from legacyzpts.legacy_zeropoints import Measurer
+        class PixelWcs(object):
+            def radec2pixelxy(self, ra, dec):
+                return True, ra, dec
+        class Meas(object):
+            wcs = PixelWcs()
+        img = np.zeros((50,50))
+        ierr = np.ones_like(img)
+        ierr[25:,:] = 0.
+        # stars off the image or with zero ivar
+        x = np.array([ 9.5, 45., 25.])
+        y = np.array([12.,  12., 40.])
+        cal = Measurer.batch_fit_sources(Meas(), x, y, np.ones(3), img, ierr,
+                                         None)
+        self.assertEqual(len(cal), 0)
+        self.assertEqual(len(cal.iref), 0)
+
+    def test_batch_fit_like_tractor(self):
+        # The batched fit keeps the same stars as the per-star Tractor
+        # fit, including one whose position is unconstrained (zero
+        # flux, so zero position derivatives and zero std).
+        import numpy as np
+        from tractor import PixelizedPSF
+        from legacyzpts.legacy_zeropoints import Measurer
+        class PixelWcs(object):
+            def radec2pixelxy(self, ra, dec):
+                return True, ra, dec
+            def pixelxy2radec(self, x, y):
+                return x, y
+        class Meas(object):
+            wcs = PixelWcs()
+        sig = 2.
+        yy,xx = np.mgrid[-20:21, -20:21]
+        psfimg = np.exp(-(xx**2 + yy**2) / (2. * sig**2))
+        psf = PixelizedPSF(psfimg / psfimg.sum())
+        H,W = 60,60
+        yy,xx = np.mgrid[:H, :W]
+        # (zero-indexed) star at (20.3, 20.6); blank sky at (40, 40)
+        img = 1000. * np.exp(-((xx - 20.3)**2 + (yy - 20.6)**2) / (2. * sig**2)) / (2. * np.pi * sig**2)
+        img[30:,30:] = 0.
+        ierr = np.ones_like(img)
+        x = np.array([21.3, 41.])
+        y = np.array([21.6, 41.])
+        flux = np.array([500., 500.])
+        cal1 = Measurer.tractor_fit_sources(Meas(), x, y, flux, img, ierr, psf)
+        cal2 = Measurer.batch_fit_sources(Meas(), x, y, flux, img, ierr, psf)
+        self.assertEqual(list(cal1.iref), [0, 1])
+        self.assertEqual(list(cal2.iref), list(cal1.iref))
+        self.assertEqual(cal2.dx[1], 0.)
+        self.assertTrue(np.allclose(cal1.x1, cal2.x1, atol=0.02))
+        self.assertTrue(np.allclose(cal1.y1, cal2.y1, atol=0.02))
+        self.assertTrue(np.allclose(cal1.flux, cal2.flux, rtol=0.01, atol=1e-3))
+        self.assertTrue(np.allclose(cal1.dflux, cal2.dflux, rtol=0.01))
+
+class TestMPIResultIter(unittest.TestCase):
+
+    def test_window(self):
+        import time
+        import threading
+        import multiprocessing
+        from concurrent.futures import ThreadPoolExecutor
+        from legacypipe.mpi_runbrick import result_iter
+
+        lock = threading.Lock()
+        nrunning = [0, 0]
+        def func(x):
+            with lock:
+                nrunning[0] += 1
+                nrunning[1] = max(nrunning[1], nrunning[0])
+            time.sleep(0.01)
+            with lock:
+                nrunning[0] -= 1
+            return x*x
+        consumed = []
+        def gen():
+            for i in range(20):
+                consumed.append(i)
+                yield i
+        with ThreadPoolExecutor(8) as ex:
+            R = result_iter(ex, func, gen(), window=3)
+            # only the first window's worth of arguments are taken
+            self.assertEqual(len(consumed), 3)
+            res = sorted(list(R))
+        self.assertEqual(res, [i*i for i in range(20)])
+        self.assertTrue(nrunning[1] <= 3)
+
+        with ThreadPoolExecutor(1) as ex:
+            R = result_iter(ex, time.sleep, [0.5])
+            self.assertRaises(multiprocessing.TimeoutError, R.next, 0.01)
+            self.assertEqual(R.next(), None)
+            self.assertRaises(StopIteration, R.next)
+
+    def test_pool_accounting(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from legacypipe.mpi_runbrick import MyMPIPool
+
+        pool = MyMPIPool(executor=ThreadPoolExecutor(2))
+        pool._processes = 2
+        self.assertEqual(pool.map(abs, [-1, 2, -3]), [1, 2, 3])
+        R = pool.imap_unordered(abs, [-4, 5])
+        self.assertEqual(len(R), 2)
+        self.assertEqual(sorted(R), [4, 5])
+        t = pool.get_pickle_traffic()
+        self.assertEqual(t['pickle_objs'], 5)
+        self.assertEqual(t['unpickle_objs'], 5)
+        self.assertTrue(t['pickle_bytes'] > 0)
+        self.assertTrue(pool.get_worker_wall() > 0)
+        pool.shutdown()
+
+class TestStageStore(unittest.TestCase):
+    def test_stage_store(self):
+        import os
+        import tempfile
+        import numpy as np
+        from legacypipe.stagestore import runstage, stage_arg_names
+
+        calls = []
+        def stage_a(x=None, **kwargs):
+            calls.append(('a', sorted(kwargs.keys())))
+            return dict(img=np.arange(10.), obj=dict(z=x))
+        def stage_b(img=None, **kwargs):
+            calls.append(('b', img[:2].tolist()))
+            return dict(blob=img * 2)
+        def stage_c(obj=None, blob=None, **kwargs):
+            calls.append(('c', obj, blob[:2].tolist()))
+            return dict(done=True)
+        funcs = dict(a=stage_a, b=stage_b, c=stage_c)
+        def stagefunc(stage, **kwargs):
+            return funcs[stage](**kwargs)
+        def stage_inputs(stage):
+            return stage_arg_names(funcs[stage])
+        prereqs = dict(a=None, b='a', c='b')
+
+        with tempfile.TemporaryDirectory() as d:
+            pat = os.path.join(d, 'rb-%(stage)s.pickle')
+            R = runstage('c', pat, stagefunc, prereqs=prereqs,
+                         initial_args=dict(x=5, junk=1),
+                         stage_inputs=stage_inputs, mp='mp')
+            self.assertEqual(calls, [('a', ['mp']), ('b', [0., 1.]),
+                                     ('c', dict(z=5), [0., 2.])])
+            self.assertEqual(sorted(os.listdir(os.path.join(d, 'rb-c.store'))),
+                             ['blob.npy', 'done.pickle', 'img.npy',
+                              'junk.pickle', 'obj.pickle', 'x.pickle'])
+            # Re-running stage c reads only the keys it needs from stage b.
+            del calls[:]
+            R = runstage('c', pat, stagefunc, prereqs=prereqs,
+                         stage_inputs=stage_inputs, force=['c'])
+            self.assertEqual(len(calls), 1)
+            self.assertFalse(R.is_loaded('img'))
+            self.assertTrue(R.is_loaded('blob'))
+            self.assertEqual(R['img'][3], 3.)
+            self.assertEqual(R['junk'], 1)
+            self.assertEqual(sorted(R.keys()),
+                             ['blob', 'done', 'img', 'junk', 'obj', 'x'])
+
+    def test_runbrick_stage_inputs(self):
+        # The lazily-imported stages report the real stage's arguments,
+        # not the wrapper's **kwargs.
+        from legacypipe.stagestore import stage_arg_names
+        from legacypipe.runbrick import stage_function
+        self.assertIn('tims', stage_arg_names(stage_function('fit_on_coadds')))
+        self.assertIn('cat', stage_arg_names(stage_function('galex_forced')))
+        self.assertIn('tims', stage_arg_names(stage_function('srcs')))
+
+class TestImportTime(unittest.TestCase):
+    # Modules that the core entry points must not import at start-up
+    # (they are only needed for plots or optional stages).
+    lazy_modules = ['matplotlib', 'pylab', 'photutils',
+                    'astrometry.util.plotutils', 'legacypipe.runbrick_plots',
+                    'legacypipe.galex', 'legacypipe.fit_on_coadds',
+                    'legacypipe.unwise']
+
+    # Packages whose import time we can't do anything about; they
+    # (and everything they import) are left out of the budget.
+    external_modules = ['tractor', 'astrometry', 'fitsio', 'numpy']
+    # Budget (seconds) for the rest of an entry point's imports.  This
+    # is generous -- a few times the typical cost -- so that it only
+    # catches a new heavy import at start-up.
+    import_budget = 2.0
+
+    def import_times(self, module):
+        '''
+        Imports *module* in a fresh interpreter, and returns
+        ({module: cumulative seconds}, seconds spent importing
+        *module*, excluding the external_modules).
+        '''
+        import os
+        import sys
+        import subprocess
+        env = os.environ.copy()
+        pydir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [pydir] + [p for p in [env.get('PYTHONPATH')] if p])
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                            'import ' + module],
+                           env=env, capture_output=True, text=True)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        # Lines are "import time: <self us> | <cumulative us> | <module>",
+        # with the module name indented two spaces per level of
+        # nesting, children before their parent.
+        rows = []
+        for line in p.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            words = line[len('import time:'):].split('|')
+            if len(words) != 3 or not words[1].strip().isdigit():
+                continue
+            name = words[2].rstrip()
+            depth = (len(name) - len(name.lstrip())) // 2
+            rows.append((name.strip(), depth, int(words[0]) * 1e-6,
+                         int(words[1]) * 1e-6))
+        times = dict((name, cum) for name,_,_,cum in rows)
+        # Walk the tree parent-first, skipping external subtrees.
+        own = 0.
+        inside = False
+        skip = None
+        for name,depth,selftime,_ in reversed(rows):
+            if depth == 0:
+                inside = (name == module)
+                skip = None
+            if not inside:
+                continue
+            if skip is not None:
+                if depth > skip:
+                    continue
+                skip = None
+            if name.split('.')[0] in self.external_modules:
+                skip = depth
+                continue
+            own += selftime
+        return times, own
+
+    def test_entry_point_imports(self):
+        for module in ['legacypipe.runbrick', 'legacypipe.oneblob',
+                       'legacypipe.forced_photom']:
+            times,own = self.import_times(module)
+            self.assertIn(module, times)
+            for lazy in self.lazy_modules:
+                self.assertNotIn(lazy, times,
+                                 '%s imports %s' % (module, lazy))
+            self.assertLess(own, self.import_budget,
+                            'importing %s took %.2f s (excluding %s)' %
+                            (module, own, ', '.join(self.external_modules)))
 
 if __name__ == '__main__':
     unittest.main()